@@ -0,0 +1,230 @@
+"""
+Benchmarks of the hot paths of the debugger, on tests/bench_target (make -C tests bench_target).
+Results are printed and written as JSON, with --compare the ratios against an older run are printed too.
+
+    python benchmarks/bench.py [-o results.json] [--compare old.json] [--quick] [--only mem,step,...]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from libdebug import Debugger
+from pwn import ELF
+
+TARGET = os.path.join(os.path.dirname(__file__), "..", "tests", "bench_target")
+# mapping of bench_target, see bench_target.c
+BUF_ADDRESS = 0x3aabbcc0000
+BUF_SIZE = 0x100000
+
+MIN_TIME = 0.5
+
+
+def measure(f, min_time=None):
+    """
+    Call f until min_time seconds are elapsed, doubling the number of calls of every round.
+    Return (calls, seconds) of the last round.
+    """
+    min_time = MIN_TIME if min_time is None else min_time
+    n = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(n):
+            f()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return n, elapsed
+        n *= 2
+
+
+def rate(f, min_time=None):
+    n, elapsed = measure(f, min_time)
+    return {"ops_per_s": n / elapsed, "us": elapsed / n * 1e6}
+
+
+def target(*args):
+    d = Debugger()
+    d.run(TARGET, [str(a) for a in args])
+    return d
+
+
+def bench_mem(elf):
+    d = target()
+    try:
+        d.breakpoint(elf.symbols["bench_tick"])
+        d.cont()
+        results = {"peek": rate(lambda: d.peek(BUF_ADDRESS)),
+                   "poke": rate(lambda: d.poke(BUF_ADDRESS, 0x4141414141414141))}
+        for size in (8, 0x1000, BUF_SIZE):
+            data = bytes(size)
+            r = rate(lambda: d.mem[BUF_ADDRESS: BUF_ADDRESS+size])
+            r["mb_per_s"] = r["ops_per_s"] * size / 2**20
+            results["read_%d" % size] = r
+            w = rate(lambda: d.mem.__setitem__(slice(BUF_ADDRESS, BUF_ADDRESS+size), data))
+            w["mb_per_s"] = w["ops_per_s"] * size / 2**20
+            results["write_%d" % size] = w
+        return results
+    finally:
+        d.shutdown()
+
+
+def bench_regs(elf):
+    d = target()
+    try:
+        d.breakpoint(elf.symbols["bench_tick"])
+        d.cont()
+        value = d.rax
+        def write():
+            d.rax = value
+        return {"read": rate(lambda: d.rax), "write": rate(write)}
+    finally:
+        d.shutdown()
+
+
+def bench_step(elf):
+    d = target()
+    try:
+        d.breakpoint(elf.symbols["bench_tick"])
+        d.cont()
+        d.del_bp(elf.symbols["bench_tick"])
+        return {"step": rate(d.step), "step_block": rate(d.step_block)}
+    finally:
+        d.shutdown()
+
+
+def bench_unwind(elf):
+    d = target()
+    try:
+        d.breakpoint(elf.symbols["bench_tick"])
+        d.cont()
+        r = rate(d.backtrace)
+        r["frames"] = len(d.backtrace())
+        return {"backtrace": r}
+    finally:
+        d.shutdown()
+
+
+def bench_cont(elf):
+    results = {}
+    for n in (0, 10, 500):
+        d = target()
+        try:
+            if n == 0:
+                # nothing to hit: resume and stop the process again
+                def round_trip():
+                    d.cont(blocking=False)
+                    d._enforce_stop()
+            else:
+                d.breakpoint(elf.symbols["bench_tick"])
+                for i in range(n - 1):
+                    d.breakpoint(elf.symbols["bench_cold"] + i)
+                round_trip = d.cont
+                d.cont()
+            results["breakpoints_%d" % n] = rate(round_trip)
+        finally:
+            d.shutdown()
+    return results
+
+
+def bench_maps(elf):
+    results = {}
+    for n in (10, 100, 1000, 10000):
+        d = target(n)
+        try:
+            d.breakpoint(elf.symbols["bench_tick"])
+            d.cont()
+            r = rate(d._retrieve_maps)
+            r["mappings"] = len(d.map)
+            results["maps_%d" % n] = r
+        finally:
+            d.shutdown()
+    return results
+
+
+def bench_startup(elf):
+    def run():
+        d = Debugger()
+        d.run(TARGET)
+        d.shutdown()
+    p = subprocess.Popen([TARGET])
+    def attach():
+        d = Debugger()
+        d.attach(p.pid)
+        d.detach()
+    try:
+        return {"run": rate(run), "attach": rate(attach)}
+    finally:
+        p.kill()
+        p.wait()
+
+
+BENCHES = {
+    "mem": bench_mem,
+    "regs": bench_regs,
+    "step": bench_step,
+    "unwind": bench_unwind,
+    "cont": bench_cont,
+    "maps": bench_maps,
+    "startup": bench_startup,
+}
+
+
+def environment():
+    root = os.path.join(os.path.dirname(__file__), "..")
+    try:
+        commit = subprocess.run(["git", "-C", root, "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit or None,
+        "python": platform.python_version(),
+        "kernel": platform.release(),
+        "backend": type(Debugger().ptrace).__name__,
+    }
+
+
+def compare(results, old):
+    # ratio > 1 is faster than the old run
+    for bench, ops in results.items():
+        for op, r in ops.items():
+            o = old.get(bench, {}).get(op)
+            if o is not None:
+                print("%-8s %-16s %8.2fx" % (bench, op, r["ops_per_s"] / o["ops_per_s"]))
+
+
+def main():
+    global MIN_TIME
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-o", "--output", help="write the results as JSON")
+    parser.add_argument("--compare", help="JSON of an older run")
+    parser.add_argument("--quick", action="store_true", help="shorter measures, noisier")
+    parser.add_argument("--only", help="comma separated benchmarks: " + ",".join(BENCHES))
+    args = parser.parse_args()
+    if args.quick:
+        MIN_TIME = 0.1
+    names = args.only.split(",") if args.only else list(BENCHES)
+
+    elf = ELF(TARGET, checksec=False)
+    results = {}
+    for name in names:
+        results[name] = BENCHES[name](elf)
+        for op, r in results[name].items():
+            extra = "".join(" %s:%.1f" % (k, v) for k, v in r.items() if k not in ("ops_per_s", "us"))
+            print("%-8s %-16s %12.1f ops/s %10.2f us%s" % (name, op, r["ops_per_s"], r["us"], extra))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f)["results"])
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Per call overhead of the ptrace layer.
+The legacy binding (libc ptrace wrapper, argtypes changed before every call, errno checks and a fresh buffer for
+GETREGS) is measured against libdebug.ptrace.Ptrace on the same stopped tracee.
+
+    python benchmarks/bench_ptrace.py [binary] [-n calls]
+"""
+import argparse
+import errno
+import os
+import sys
+import time
+from ctypes import CDLL, c_int, c_long, c_void_p, create_string_buffer, get_errno, set_errno
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from libdebug import Debugger
+from libdebug.ptrace import Ptrace, PTRACE_PEEKDATA, PTRACE_PEEKUSER, PTRACE_GETREGS
+from libdebug.registers import RegisterFile
+
+
+class LegacyPtrace():
+    # The binding libdebug used before the direct syscall one
+    def __init__(self):
+        self.libc = CDLL("libc.so.6", use_errno=True)
+        self.args_ptr = [c_int, c_long, c_long, c_void_p]
+        self.args_int = [c_int, c_long, c_long, c_long]
+        self.libc.ptrace.restype = c_long
+
+    def peek(self, tid, addr):
+        set_errno(0)
+        self.libc.ptrace.argtypes = self.args_int
+        data = self.libc.ptrace(PTRACE_PEEKDATA, tid, addr, 0)
+        if get_errno() == errno.EIO:
+            raise Exception("Peek Failed")
+        return data
+
+    def peek_user(self, tid, addr):
+        set_errno(0)
+        self.libc.ptrace.argtypes = self.args_int
+        data = self.libc.ptrace(PTRACE_PEEKUSER, tid, addr, 0)
+        if get_errno() == errno.EIO:
+            raise Exception("Peek User Failed")
+        return data
+
+    def getregs(self, tid, regs):
+        self.libc.ptrace.argtypes = self.args_ptr
+        buf = create_string_buffer(1000)
+        set_errno(0)
+        if self.libc.ptrace(PTRACE_GETREGS, tid, 0, buf) == -1:
+            return None
+        return buf
+
+
+def bench(name, f, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    elapsed = time.perf_counter() - start
+    return elapsed / n * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("binary", nargs="?", default=os.path.join(os.path.dirname(__file__), "..", "tests", "read_test"))
+    parser.add_argument("-n", type=int, default=100000, help="calls per operation")
+    args = parser.parse_args()
+
+    d = Debugger()
+    d.run(args.binary, sleep=0.1)
+    d._enforce_stop()
+    pid = d.pid
+    addr = d.rip
+    try:
+        legacy = LegacyPtrace()
+        lean = Ptrace()
+        regs = RegisterFile()
+        ops = [("peek", lambda p: (lambda: p.peek(pid, addr))),
+               ("peek_user", lambda p: (lambda: p.peek_user(pid, 0x80))),
+               ("getregs", lambda p: (lambda: p.getregs(pid, regs)))]
+        print("%-10s %12s %12s %8s" % ("op", "legacy us", "lean us", "speedup"))
+        for name, make in ops:
+            old = bench(name, make(legacy), args.n)
+            new = bench(name, make(lean), args.n)
+            print("%-10s %12.3f %12.3f %7.2fx" % (name, old, new, old / new))
+    finally:
+        d.shutdown()
+
+
+if __name__ == "__main__":
+    main()
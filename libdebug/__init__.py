@@ -1,4 +1,6 @@
 from .libdebug import Debugger
+from .aio import AsyncDebugger
+from .pool import DebuggerPool, Job
 
 # Set default logging handler to avoid "No handler found" warnings.
 import logging
@@ -0,0 +1,279 @@
+/*
+ * Native hot loops for libdebug.ptrace.
+ * The module is optional: libdebug.ptrace uses it when it can be imported and falls back to ctypes otherwise.
+ * Every function mirrors a method of the ctypes Ptrace class and has the same semantics.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <errno.h>
+#include <signal.h>
+#include <stdint.h>
+#include <string.h>
+#include <time.h>
+#include <sys/ptrace.h>
+#include <sys/user.h>
+#include <sys/wait.h>
+
+/* reasons returned by step_loop, same values as STEP_* in ptrace.py */
+#define STEP_COUNT      0
+#define STEP_UNTIL      1
+#define STEP_BREAKPOINT 2
+#define STEP_STOPPED    3
+#define STEP_EXITED     4
+#define STEP_TIMEOUT    5
+
+/* libdebug.ptrace.PtraceFail, registered by set_error_class */
+static PyObject *error_class = NULL;
+
+static PyObject *
+fail(const char *msg)
+{
+    int err = errno;
+    PyObject *exc;
+    if (error_class == NULL) {
+        errno = err;
+        return PyErr_SetFromErrno(PyExc_OSError);
+    }
+    exc = PyObject_CallFunction(error_class, "si", msg, err);
+    if (exc != NULL) {
+        PyErr_SetObject(error_class, exc);
+        Py_DECREF(exc);
+    }
+    return NULL;
+}
+
+static PyObject *
+set_error_class(PyObject *self, PyObject *cls)
+{
+    Py_INCREF(cls);
+    Py_XSETREF(error_class, cls);
+    Py_RETURN_NONE;
+}
+
+static int
+get_buffer(PyObject *obj, Py_buffer *view, Py_ssize_t size, const char *name)
+{
+    if (PyObject_GetBuffer(obj, view, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) < 0)
+        return -1;
+    if (view->len < size) {
+        PyErr_Format(PyExc_ValueError, "%s buffer is too small", name);
+        PyBuffer_Release(view);
+        return -1;
+    }
+    return 0;
+}
+
+static PyObject *
+peek_many(PyObject *self, PyObject *args)
+{
+    int tid;
+    unsigned long addr;
+    Py_ssize_t count, i;
+    PyObject *data;
+    long *words;
+
+    if (!PyArg_ParseTuple(args, "ikn", &tid, &addr, &count))
+        return NULL;
+    data = PyBytes_FromStringAndSize(NULL, count * sizeof(long));
+    if (data == NULL)
+        return NULL;
+    words = (long *)PyBytes_AS_STRING(data);
+    for (i = 0; i < count; i++) {
+        errno = 0;
+        words[i] = ptrace(PTRACE_PEEKDATA, tid, addr + i * sizeof(long), NULL);
+        if (words[i] == -1 && errno != 0) {
+            Py_DECREF(data);
+            return fail("Peek Failed. Are you accessing a valid address?");
+        }
+    }
+    return data;
+}
+
+static PyObject *
+wait_getregs(PyObject *self, PyObject *args)
+{
+    int tid, options, r, status = 0, ok = 0;
+    PyObject *regs_obj;
+    Py_buffer regs;
+
+    if (!PyArg_ParseTuple(args, "iiO", &tid, &options, &regs_obj))
+        return NULL;
+    if (get_buffer(regs_obj, &regs, sizeof(struct user_regs_struct), "regs") < 0)
+        return NULL;
+    Py_BEGIN_ALLOW_THREADS
+    do {
+        r = waitpid(tid, &status, options);
+    } while (r == -1 && errno == EINTR);
+    if (r > 0 && WIFSTOPPED(status))
+        ok = ptrace(PTRACE_GETREGS, r, NULL, regs.buf) == 0;
+    Py_END_ALLOW_THREADS
+    PyBuffer_Release(&regs);
+    if (r == -1)
+        return fail("Waitpid Failed");
+    return Py_BuildValue("iiO", r, status, ok ? Py_True : Py_False);
+}
+
+static int
+is_break(const uint64_t *breaks, Py_ssize_t n, uint64_t rip)
+{
+    Py_ssize_t lo = 0, hi = n;
+    while (lo < hi) {
+        Py_ssize_t mid = (lo + hi) / 2;
+        if (breaks[mid] < rip)
+            lo = mid + 1;
+        else
+            hi = mid;
+    }
+    return lo < n && breaks[lo] == rip;
+}
+
+static double
+now(void)
+{
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+/*
+ * step_loop(tid, max_steps, until, breaks, regs, status, rips, timeout) -> (steps, reason)
+ * Single step tid until one of:
+ *   max_steps steps are done (max_steps < 0 is unlimited)          STEP_COUNT
+ *   rip is equal to until after a step (None to disable)           STEP_UNTIL
+ *   rip is in the sorted uint64 buffer breaks, before stepping     STEP_BREAKPOINT
+ *   the thread stops for anything but a plain SIGTRAP              STEP_STOPPED
+ *   the thread is gone                                             STEP_EXITED
+ *   timeout seconds are elapsed (timeout < 0 is no timeout)        STEP_TIMEOUT
+ * regs must contain the registers of the current stop and are updated after every step.
+ * status is a c_int that receives the last waitpid status, rips (or None) receives the rip after every step.
+ */
+static PyObject *
+step_loop(PyObject *self, PyObject *args)
+{
+    int tid, r, status = 0, failed = 0, err = 0, reason = STEP_COUNT;
+    long long max_steps, steps = 0;
+    double timeout, deadline = 0;
+    uint64_t until = 0;
+    int has_until;
+    PyObject *until_obj, *breaks_obj, *regs_obj, *status_obj, *rips_obj;
+    Py_buffer breaks = {0}, regs, status_buf, rips = {0};
+    Py_ssize_t n_breaks = 0, n_rips = 0;
+    struct user_regs_struct *uregs;
+    uint64_t *rips_out = NULL;
+    const char *msg = NULL;
+
+    if (!PyArg_ParseTuple(args, "iLOOOOOd", &tid, &max_steps, &until_obj, &breaks_obj, &regs_obj,
+                          &status_obj, &rips_obj, &timeout))
+        return NULL;
+    has_until = until_obj != Py_None;
+    if (has_until) {
+        until = PyLong_AsUnsignedLongLongMask(until_obj);
+        if (PyErr_Occurred())
+            return NULL;
+    }
+    if (get_buffer(regs_obj, &regs, sizeof(struct user_regs_struct), "regs") < 0)
+        return NULL;
+    if (get_buffer(status_obj, &status_buf, sizeof(int), "status") < 0)
+        goto release_regs;
+    if (breaks_obj != Py_None) {
+        if (PyObject_GetBuffer(breaks_obj, &breaks, PyBUF_C_CONTIGUOUS) < 0)
+            goto release_status;
+        n_breaks = breaks.len / sizeof(uint64_t);
+    }
+    if (rips_obj != Py_None) {
+        if (get_buffer(rips_obj, &rips, 0, "rips") < 0)
+            goto release_breaks;
+        rips_out = rips.buf;
+        n_rips = rips.len / sizeof(uint64_t);
+    }
+    uregs = regs.buf;
+
+    Py_BEGIN_ALLOW_THREADS
+    if (timeout >= 0)
+        deadline = now() + timeout;
+    while (max_steps < 0 || steps < max_steps) {
+        if (n_breaks && is_break(breaks.buf, n_breaks, uregs->rip)) {
+            reason = STEP_BREAKPOINT;
+            break;
+        }
+        if (ptrace(PTRACE_SINGLESTEP, tid, NULL, NULL) == -1) {
+            failed = 1;
+            err = errno;
+            msg = "Step Failed. Do you have permisions? Running as sudo?";
+            break;
+        }
+        do {
+            r = waitpid(tid, &status, __WALL);
+        } while (r == -1 && errno == EINTR);
+        if (r == -1) {
+            failed = 1;
+            err = errno;
+            msg = "Waitpid Failed while stepping";
+            break;
+        }
+        steps++;
+        if (!WIFSTOPPED(status)) {
+            reason = STEP_EXITED;
+            break;
+        }
+        if (ptrace(PTRACE_GETREGS, tid, NULL, uregs) == -1) {
+            failed = 1;
+            err = errno;
+            msg = "GetRegs Failed while stepping";
+            break;
+        }
+        if (rips_out != NULL && steps <= n_rips)
+            rips_out[steps - 1] = uregs->rip;
+        if (WSTOPSIG(status) != SIGTRAP || (status >> 16) != 0) {
+            reason = STEP_STOPPED;
+            break;
+        }
+        if (has_until && uregs->rip == until) {
+            reason = STEP_UNTIL;
+            break;
+        }
+        if (timeout >= 0 && now() > deadline) {
+            reason = STEP_TIMEOUT;
+            break;
+        }
+    }
+    Py_END_ALLOW_THREADS
+
+    *(int *)status_buf.buf = status;
+    if (rips_obj != Py_None)
+        PyBuffer_Release(&rips);
+release_breaks:
+    if (breaks_obj != Py_None)
+        PyBuffer_Release(&breaks);
+release_status:
+    PyBuffer_Release(&status_buf);
+release_regs:
+    PyBuffer_Release(&regs);
+    if (PyErr_Occurred())
+        return NULL;
+    if (failed) {
+        errno = err;
+        return fail(msg);
+    }
+    return Py_BuildValue("Li", steps, reason);
+}
+
+static PyMethodDef accel_methods[] = {
+    {"set_error_class", set_error_class, METH_O, "Set the exception raised on ptrace errors."},
+    {"peek_many", peek_many, METH_VARARGS, "peek_many(tid, addr, count) -> bytes of count words."},
+    {"wait_getregs", wait_getregs, METH_VARARGS,
+     "wait_getregs(tid, options, regs) -> (tid, status, ok). waitpid, then GETREGS into regs if the thread stopped."},
+    {"step_loop", step_loop, METH_VARARGS,
+     "step_loop(tid, max_steps, until, breaks, regs, status, rips, timeout) -> (steps, reason)."},
+    {NULL, NULL, 0, NULL}
+};
+
+static struct PyModuleDef accel_module = {
+    PyModuleDef_HEAD_INIT, "_ptrace_accel", "Native hot loops for libdebug.ptrace", -1, accel_methods
+};
+
+PyMODINIT_FUNC
+PyInit__ptrace_accel(void)
+{
+    return PyModule_Create(&accel_module);
+}
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import signal
+import weakref
+from . import events
+from .libdebug import Debugger, DebugFail
+from .ptrace import ptrace_backend
+
+logging = logging.getLogger("libdebug")
+
+
+class _ChildWatcher():
+    """
+    SIGCHLD handler of an event loop. A tracee sends SIGCHLD to the debugger at every stop: the events ready are
+    queued in libdebug.events and every AsyncDebugger waiting on the loop looks for its own.
+    The handler is a Python one that chains the one it replaces. The handlers added with loop.add_signal_handler go on
+    working: the loop gets the signal from its wakeup fd, which is written whatever the Python handler is.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.ptrace = ptrace_backend()
+        self.waiters = []
+        self.previous = signal.getsignal(signal.SIGCHLD)
+        if self.previous is None:
+            raise DebugFail("SIGCHLD has a handler not installed from Python, it can not be chained")
+        signal.signal(signal.SIGCHLD, self._signal)
+
+    def _signal(self, signum, frame):
+        if self.loop.is_closed():
+            # the loop is gone, give the signal back to the handler that was there before
+            if signal.getsignal(signal.SIGCHLD) == self._signal:
+                signal.signal(signal.SIGCHLD, self.previous)
+        else:
+            self.loop.call_soon_threadsafe(self._sigchld)
+        if callable(self.previous):
+            self.previous(signum, frame)
+
+    def _sigchld(self):
+        # Everything is reaped before waking up the waiters, an event taken by one of them is never missed by another
+        events.reap(self.ptrace)
+        waiters, self.waiters = self.waiters, []
+        for f in waiters:
+            if not f.done():
+                f.set_result(None)
+
+    def wait(self):
+        f = self.loop.create_future()
+        self.waiters.append(f)
+        return f
+
+
+_watchers = weakref.WeakKeyDictionary()
+
+
+def _watcher(loop):
+    w = _watchers.get(loop)
+    if w is None:
+        w = _watchers[loop] = _ChildWatcher(loop)
+    return w
+
+
+class AsyncDebugger(Debugger):
+    """
+    Debugger for asyncio. cont, next, finish and syscall_trace are coroutines: the process runs while the event loop
+    does other work, so a single Python process can drive many targets. Everything else is the same as Debugger.
+    """
+
+    async def _wait_event_async(self):
+        # Same as _wait_event, the event loop runs until a SIGCHLD comes
+        watcher = _watcher(asyncio.get_running_loop())
+        while True:
+            e = events.next_event(self.ptrace, self, block=False)
+            if e is None:
+                await watcher.wait()
+                continue
+            tid, status = e
+            if self._handle_event(tid, status):
+                return tid, status
+            t = self.threads.get(tid)
+            if t is not None and not t.running:
+                self._resume(t)
+
+    async def cont(self):
+        """
+        Continue the execution until the next breakpoint is hitted or the program is stopped, as Debugger.cont.
+        If the coroutine is cancelled the process goes on running, the next access to it stops it.
+        """
+        self._enforce_stop()
+        while True:
+            tid = self._pending_tid()
+            if tid is not None:
+                status = self.threads[tid].pending
+            else:
+                self._cont_resume()
+                tid, status = await self._wait_event_async()
+                self._stop_all()
+            if self._report(tid, status):
+                break
+        logging.debug("Continue Stopped")
+
+    async def next(self):
+        ret = self._step_into_call()
+        if ret is not None:
+            with self._temporary_bp(ret):
+                await self.cont()
+
+    async def finish(self):
+        """
+        Execute until the end of the current function, the return address is found by backtrace.
+        """
+        with self._temporary_bp(self._return_address()):
+            await self.cont()
+
+    async def syscall_trace(self, syscalls=None, callback=None):
+        """
+        Continue recording every completed syscall, as Debugger.syscall_trace. Return the list of SyscallEvent.
+        """
+        with self._recording_syscalls(syscalls, callback) as recorded:
+            await self.cont()
+        return recorded
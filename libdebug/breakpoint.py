@@ -0,0 +1,50 @@
+class Breakpoint():
+    """
+    A breakpoint of the debugger.
+    Software breakpoints stay in memory as int3 from when they are set until they are deleted or disabled.
+    Hardware breakpoints and watchpoints use the debug registers, cond and length describe the access.
+    callback(d, bp) is called on every hit, the execution continues unless it returns a true value.
+    condition is a callable(d, bp) or an expression on the registers (e.g. "rdi == 0x10 and rsi > 4"). When it is
+    false the hit is ignored.
+    """
+
+    def __init__(self, address, hw=False, cond='X', length=1, callback=None, condition=None):
+        self.address = address
+        self.hw = hw
+        self.cond = cond
+        self.length = length
+        self.enabled = True
+        self.hit_count = 0
+        self.callback = callback
+        self.condition = condition
+
+    @property
+    def condition(self):
+        return self._condition
+
+    @condition.setter
+    def condition(self, condition):
+        self._condition = condition
+        # Expressions are compiled once, a hit only pays for the evaluation
+        if isinstance(condition, str):
+            self._test = compile(condition, "<breakpoint %#x>" % self.address, "eval")
+        else:
+            self._test = condition
+
+    def test(self, d, regs):
+        """
+        Evaluate the condition of the breakpoint. regs are the registers of the thread that hit it.
+        """
+        test = self._test
+        if test is None:
+            return True
+        if callable(test):
+            return bool(test(d, self))
+        return bool(eval(test, {"d": d, "bp": self}, regs))
+
+    def __repr__(self):
+        kind = "hw" if self.hw else "sw"
+        if self.cond != 'X':
+            kind = "watch %s/%d" % (self.cond, self.length)
+        state = "enabled" if self.enabled else "disabled"
+        return "<Breakpoint %#x %s %s hits:%d>" % (self.address, kind, state, self.hit_count)
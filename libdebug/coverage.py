@@ -0,0 +1,134 @@
+import bisect
+import struct
+from array import array
+
+
+class CoverageMap():
+    """
+    Basic blocks reached by the process: the set of their addresses and a bitmap of hit counts indexed by a hash of
+    the address, as AFL does, that can be compared and merged cheaply between runs.
+    """
+
+    def __init__(self, size=1 << 16):
+        if size & (size - 1) != 0:
+            raise ValueError("The size of the bitmap must be a power of 2")
+        self.bitmap = bytearray(size)
+        self.blocks = set()
+        self._mask = size - 1
+
+    def index(self, addr):
+        return (addr ^ (addr >> 16) ^ (addr >> 32)) & self._mask
+
+    def add(self, addr):
+        """
+        Record a hit of the block at addr. Return True if the block is new.
+        """
+        i = self.index(addr)
+        if self.bitmap[i] < 255:
+            self.bitmap[i] += 1
+        if addr in self.blocks:
+            return False
+        self.blocks.add(addr)
+        return True
+
+    def update(self, other):
+        """
+        Merge the blocks of other. Return the set of the blocks that were not here.
+        """
+        if len(other.bitmap) != len(self.bitmap):
+            raise ValueError("The bitmaps have different sizes")
+        new = other.blocks - self.blocks
+        self.blocks |= other.blocks
+        for i, count in enumerate(other.bitmap):
+            if count:
+                self.bitmap[i] = min(255, self.bitmap[i] + count)
+        return new
+
+    def __contains__(self, addr):
+        return addr in self.blocks
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __iter__(self):
+        return iter(sorted(self.blocks))
+
+
+class BlockCoverage():
+    """
+    Breakpoint coverage of a module: the basic blocks found in its ELF file and one bit per block, set the first time
+    the block runs. Blocks are stored as addresses of the ELF, bias is added to get the ones of the process, so
+    coverages of runs with different load addresses can be merged.
+    """
+    MAGIC = b"LDBCOV1\0"
+
+    def __init__(self, module, blocks, bias=0, bits=None):
+        self.module = module
+        self.blocks = array('Q', blocks)
+        self.bias = bias
+        self.bits = bytearray((len(self.blocks) + 7) // 8) if bits is None else bytearray(bits)
+
+    def _index(self, addr):
+        vaddr = addr - self.bias
+        i = bisect.bisect_left(self.blocks, vaddr)
+        if i < len(self.blocks) and self.blocks[i] == vaddr:
+            return i
+        return None
+
+    def hit(self, addr):
+        """
+        Record the execution of the block at the process address addr.
+        """
+        i = self._index(addr)
+        if i is not None:
+            self.bits[i >> 3] |= 1 << (i & 7)
+
+    def __contains__(self, addr):
+        # True if the block at the process address addr was executed
+        i = self._index(addr)
+        return i is not None and self.bits[i >> 3] >> (i & 7) & 1 == 1
+
+    def covered(self):
+        """
+        Return the process addresses of the blocks executed.
+        """
+        return [self.blocks[i] + self.bias for i in range(len(self.blocks)) if self.bits[i >> 3] >> (i & 7) & 1]
+
+    def __len__(self):
+        return sum(bin(b).count("1") for b in self.bits)
+
+    @property
+    def ratio(self):
+        return len(self) / len(self.blocks) if len(self.blocks) > 0 else 0
+
+    def update(self, other):
+        """
+        Merge the blocks executed in other, a coverage of the same file.
+        """
+        if other.blocks != self.blocks:
+            raise ValueError("The coverages are of different files")
+        for i, b in enumerate(other.bits):
+            self.bits[i] |= b
+
+    def save(self, path):
+        """
+        Write the blocks and the bitmap into path. load reads them back.
+        """
+        name = self.module.encode()
+        with open(path, "wb") as f:
+            f.write(self.MAGIC + struct.pack("<QQ", len(name), len(self.blocks)) + name)
+            f.write(self.blocks.tobytes())
+            f.write(self.bits)
+
+    @classmethod
+    def load(cls, path, bias=0):
+        with open(path, "rb") as f:
+            data = f.read()
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("%s is not a coverage file" % path)
+        name_len, n = struct.unpack_from("<QQ", data, len(cls.MAGIC))
+        start = len(cls.MAGIC) + 16
+        module = data[start: start + name_len].decode()
+        blocks = array('Q')
+        blocks.frombytes(data[start + name_len: start + name_len + 8 * n])
+        return cls(module, blocks, bias, data[start + name_len + 8 * n:])
@@ -0,0 +1,142 @@
+import bisect
+import collections
+import logging
+from capstone import Cs, CS_ARCH_X86, CS_MODE_64
+from .ptrace import PtraceFail
+
+logging = logging.getLogger("libdebug")
+
+PAGE_SIZE = 0x1000
+# x86 instructions are at most 15 bytes
+MAX_INSN_SIZE = 15
+# bytes read at once when decoding a block
+BLOCK_READ = 0x100
+
+Instruction = collections.namedtuple("Instruction", "address size mnemonic op_str bytes")
+
+_md = {}
+
+
+def capstone(detail=False):
+    """
+    Shared amd64 capstone instance. Building one is expensive and they have no state between calls.
+    """
+    md = _md.get(detail)
+    if md is None:
+        md = _md[detail] = Cs(CS_ARCH_X86, CS_MODE_64)
+        md.detail = detail
+    return md
+
+
+def ends_block(mnemonic):
+    # instructions after which the execution may not go on with the next one
+    return mnemonic.startswith(("j", "call", "ret", "loop", "int", "syscall", "sysenter", "iret", "hlt", "ud"))
+
+
+class InstructionCache():
+    """
+    Instructions decoded by address. A miss decodes the whole basic block starting there, from a single read.
+    read(addr, size) must return the memory without breakpoints.
+    Writes to memory must be reported with invalidate, changes of the mappings with clear.
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.insns = {}
+        # sorted addresses of insns, for invalidate
+        self._addrs = []
+
+    def _fetch(self, addr):
+        try:
+            return self.read(addr, BLOCK_READ)
+        except PtraceFail:
+            # the block is at the end of a mapping, read only what is there
+            return self.read(addr, PAGE_SIZE - (addr & (PAGE_SIZE - 1)))
+
+    def _decode_block(self, addr):
+        code = self._fetch(addr)
+        for address, size, mnemonic, op_str in capstone().disasm_lite(code, addr):
+            if address in self.insns:
+                # the rest of the block is already known
+                break
+            off = address - addr
+            insn = Instruction(address, size, mnemonic, op_str, bytes(code[off:off+size]))
+            self.insns[address] = insn
+            bisect.insort(self._addrs, address)
+            if ends_block(mnemonic):
+                break
+        if addr not in self.insns:
+            logging.debug("no instruction decoded at %#x", addr)
+
+    def get(self, addr):
+        """
+        Return the Instruction at addr, None if it can not be decoded.
+        """
+        insn = self.insns.get(addr)
+        if insn is None:
+            self._decode_block(addr)
+            insn = self.insns.get(addr)
+        return insn
+
+    def disasm(self, addr, count):
+        """
+        Return up to count Instructions, linearly from addr. The list is shorter if the bytes can not be decoded.
+        """
+        result = []
+        while len(result) < count:
+            insn = self.get(addr)
+            if insn is None:
+                break
+            result.append(insn)
+            addr += insn.size
+        return result
+
+    def invalidate(self, start, stop):
+        """
+        Forget the instructions overlapping [start, stop).
+        """
+        i = bisect.bisect_left(self._addrs, start - MAX_INSN_SIZE + 1)
+        j = bisect.bisect_left(self._addrs, stop, i)
+        if i == j:
+            return
+        kept = []
+        for a in self._addrs[i:j]:
+            if a + self.insns[a].size <= start:
+                kept.append(a)
+            else:
+                del self.insns[a]
+        self._addrs[i:j] = kept
+
+    def clear(self):
+        self.insns.clear()
+        self._addrs = []
+
+    def __len__(self):
+        return len(self.insns)
+
+
+def block_starts(code, addr):
+    """
+    Return the sorted addresses of the basic blocks of code loaded at addr, found with a linear sweep: the first
+    instruction, the ones after a branch and the targets of the direct branches inside the range.
+    Bytes that can not be decoded are skipped.
+    """
+    md = capstone()
+    size = len(code)
+    # capstone takes a writable buffer by reference, restarting after a bad byte does not copy the rest
+    view = memoryview(bytearray(code))
+    insns = set()
+    starts = {addr}
+    offset = 0
+    while offset < size:
+        last = None
+        for address, length, mnemonic, op_str in md.disasm_lite(view[offset:], addr + offset):
+            insns.add(address)
+            last = address + length
+            if ends_block(mnemonic):
+                starts.add(last)
+                if op_str.startswith("0x"):
+                    starts.add(int(op_str, 16))
+        # capstone stops at the first byte it can not decode
+        offset = offset + 1 if last is None else last - addr
+    return sorted(starts & insns)
@@ -0,0 +1,140 @@
+import collections
+import logging
+import os
+import struct
+from .disasm import block_starts
+
+logging = logging.getLogger("libdebug")
+
+ET_EXEC = 2
+ET_DYN = 3
+PT_LOAD = 1
+SHT_NOBITS = 8
+SHT_NOTE = 7
+SHT_SYMTAB = 2
+SHT_DYNSYM = 11
+SHN_UNDEF = 0
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_GNU_IFUNC = 10
+SHF_EXECINSTR = 0x4
+NT_GNU_BUILD_ID = 3
+
+ELF_HEADER = struct.Struct("<16sHHIQQQIHHHHHH")
+SECTION_HEADER = struct.Struct("<IIQQQQIIQQ")
+PROGRAM_HEADER = struct.Struct("<IIQQQQQQ")
+SYMBOL = struct.Struct("<IBBHQQ")
+
+Section = collections.namedtuple("Section", "name type flags addr offset size link info entsize")
+Segment = collections.namedtuple("Segment", "type flags offset vaddr filesz memsz")
+
+
+class ElfFile():
+    """
+    The parts of a 64 bit little endian ELF file the debugger needs: sections, segments and build-id.
+    Use load(path), it parses every file once.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = f.read()
+        if len(self.data) < ELF_HEADER.size or self.data[:4] != b"\x7fELF":
+            raise ValueError("%s is not an ELF file" % path)
+        if self.data[4] != 2 or self.data[5] != 1:
+            raise ValueError("%s is not a 64 bit little endian ELF" % path)
+        (_, self.type, self.machine, _, self.entry, phoff, shoff, _, _,
+         phentsize, phnum, shentsize, shnum, shstrndx) = ELF_HEADER.unpack_from(self.data)
+        self.segments = []
+        for i in range(phnum):
+            type, flags, offset, vaddr, _, filesz, memsz, _ = PROGRAM_HEADER.unpack_from(self.data, phoff + i * phentsize)
+            self.segments.append(Segment(type, flags, offset, vaddr, filesz, memsz))
+        headers = [SECTION_HEADER.unpack_from(self.data, shoff + i * shentsize) for i in range(shnum)]
+        names = headers[shstrndx] if shstrndx < len(headers) else None
+        self.sections = []
+        for name, type, flags, addr, offset, size, link, info, _, entsize in headers:
+            if names is not None:
+                name = self._string(names[4], name)
+            self.sections.append(Section(name, type, flags, addr, offset, size, link, info, entsize))
+        self._by_name = {s.name: s for s in self.sections}
+        self._blocks = None
+
+    def _string(self, table_offset, offset):
+        start = table_offset + offset
+        return self.data[start: self.data.index(b"\0", start)].decode(errors="replace")
+
+    def section(self, name):
+        """
+        Return the Section called name, None if there is not such a section.
+        """
+        return self._by_name.get(name)
+
+    def section_data(self, section):
+        if section.type == SHT_NOBITS:
+            return b""
+        return memoryview(self.data)[section.offset: section.offset + section.size]
+
+    def code_sections(self):
+        return [s for s in self.sections if s.flags & SHF_EXECINSTR and s.type != SHT_NOBITS]
+
+    def block_starts(self):
+        """
+        Return the sorted addresses of the basic blocks of the code sections, see disasm.block_starts.
+        """
+        if self._blocks is None:
+            blocks = []
+            for s in self.code_sections():
+                blocks.extend(block_starts(self.section_data(s), s.addr))
+            self._blocks = sorted(blocks)
+        return self._blocks
+
+    def symbols(self):
+        """
+        Yield (name, vaddr, size, is_symtab) for the functions and objects defined in .symtab and .dynsym.
+        """
+        for s in self.sections:
+            if s.type != SHT_SYMTAB and s.type != SHT_DYNSYM:
+                continue
+            strtab = self.sections[s.link].offset
+            entsize = s.entsize or SYMBOL.size
+            for off in range(s.offset, s.offset + s.size - SYMBOL.size + 1, entsize):
+                name, info, _, shndx, value, size = SYMBOL.unpack_from(self.data, off)
+                if name == 0 or shndx == SHN_UNDEF or value == 0 or info & 0xf not in (STT_OBJECT, STT_FUNC, STT_GNU_IFUNC):
+                    continue
+                yield self._string(strtab, name), value, size, s.type == SHT_SYMTAB
+
+    @property
+    def load_base(self):
+        """
+        The address the file asks to be loaded at: 0 for position independent files.
+        The process address of a vaddr of the file is vaddr - load_base + the base of its first mapping.
+        """
+        loads = [s.vaddr for s in self.segments if s.type == PT_LOAD]
+        return min(loads) & ~0xfff if len(loads) > 0 else 0
+
+    @property
+    def build_id(self):
+        s = self.section(".note.gnu.build-id")
+        if s is None:
+            return None
+        namesz, descsz, type = struct.unpack_from("<III", self.data, s.offset)
+        if type != NT_GNU_BUILD_ID:
+            return None
+        desc = s.offset + 12 + (namesz + 3) // 4 * 4
+        return self.data[desc: desc + descsz].hex()
+
+
+_cache = {}
+
+
+def load(path):
+    """
+    Return the ElfFile of path. Files are parsed once, until they change on disk.
+    """
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    elf = _cache.get(key)
+    if elf is None:
+        logging.debug("parsing %s", path)
+        elf = _cache[key] = ElfFile(path)
+    return elf
@@ -0,0 +1,176 @@
+import collections
+import errno
+import logging
+import os
+import threading
+from ctypes import c_int, byref, get_errno
+from .ptrace import WALL, WNOHANG, PtraceFail
+
+logging = logging.getLogger("libdebug")
+
+# waitid(P_ALL) sees the events of every tracee of this process: the ones of other Debugger instances too, and the
+# first stop of a new thread can come before the PTRACE_EVENT_CLONE of its parent. Events are routed by tid, the
+# ones nobody is waiting for are queued until their owner asks for them.
+# Children that are not tracees (subprocess, asyncio) are only peeked at, their status is left to whoever waits for them.
+_owners = {}
+_queued = collections.defaultdict(collections.deque)
+
+
+def register(tid, owner):
+    _owners[tid] = owner
+
+
+def unregister(tid):
+    _owners.pop(tid, None)
+    _queued.pop(tid, None)
+
+
+def _pop(tid):
+    q = _queued[tid]
+    status = q.popleft()
+    if len(q) == 0:
+        del _queued[tid]
+    return status
+
+
+def _waitpid(ptrace, tid, options):
+    status = c_int()
+    while True:
+        r = ptrace.waitpid(tid, byref(status), options)
+        if r != -1:
+            return r, status.value
+        err = get_errno()
+        if err != errno.EINTR:
+            raise PtraceFail("Waitpid Failed", err)
+
+
+# peek at the next event of any child, without consuming it
+PEEK = os.WEXITED | os.WSTOPPED | os.WNOWAIT | WALL
+
+
+def _traced_by_us(tid):
+    # a tracee not registered yet: a new thread or a forked child
+    try:
+        with open("/proc/%d/status" % tid) as f:
+            for line in f:
+                if line.startswith("TracerPid:"):
+                    return int(line.split()[1]) == os.getpid()
+    except OSError:
+        pass
+    return False
+
+
+def _poll_owned(ptrace):
+    # waitpid of every registered tid, for when another child is the first one waitid returns
+    for tid in list(_owners):
+        try:
+            r, status = _waitpid(ptrace, tid, WALL | WNOHANG)
+        except PtraceFail:
+            continue
+        if r == tid:
+            return tid, status
+    return None
+
+
+def _watch(tid):
+    # Block until tid has an event, without consuming it
+    try:
+        os.waitid(os.P_PID, tid, PEEK)
+    except ChildProcessError:
+        pass
+    with _ready:
+        del _watchers[tid]
+        _ready.notify_all()
+
+
+# a thread per tid blocked in waitid(P_PID), started when another child is ready and waitid(P_ALL) would not block
+_watchers = {}
+_ready = threading.Condition()
+
+
+def _block_on(tids):
+    # Return when one of tids has an event
+    with _ready:
+        for tid in tids:
+            if tid not in _watchers:
+                _watchers[tid] = threading.Thread(target=_watch, args=(tid,), daemon=True)
+                _watchers[tid].start()
+        while all(tid in _watchers for tid in tids):
+            _ready.wait()
+
+
+def _next_tracee_event(ptrace, owner, block):
+    # (tid, status) of the next event of a tracee of this process, None if there is none ready without block.
+    # With block, wait for an event of a thread of owner
+    while True:
+        try:
+            info = os.waitid(os.P_ALL, 0, PEEK if block else PEEK | WNOHANG)
+        except ChildProcessError:
+            raise PtraceFail("Waitpid Failed", errno.ECHILD)
+        if info is None:
+            return None
+        tid = info.si_pid
+        if tid in _owners or _traced_by_us(tid):
+            r, status = _waitpid(ptrace, tid, WALL | WNOHANG)
+            if r == tid:
+                return tid, status
+            continue
+        # a child that is not a tracee is ready and it stays there until its owner waits for it
+        logging.debug("status of %d left to its owner", tid)
+        e = _poll_owned(ptrace)
+        if e is not None or not block:
+            return e
+        tids = [t for t, o in _owners.items() if o is owner]
+        if len(tids) == 0:
+            raise PtraceFail("Waitpid Failed", errno.ECHILD)
+        _block_on(tids)
+
+
+def next_event(ptrace, owner, block=True):
+    """
+    Return (tid, status) of the next event of a thread registered by owner.
+    Without block, return None if there is no event ready.
+    """
+    for tid, q in _queued.items():
+        if _owners.get(tid) is owner:
+            return tid, _pop(tid)
+    while True:
+        e = _next_tracee_event(ptrace, owner, block)
+        if e is None:
+            return None
+        tid, status = e
+        if _owners.get(tid) is owner:
+            return tid, status
+        _queued[tid].append(status)
+
+
+def reap(ptrace):
+    """
+    Queue all the events ready without blocking, their owners take them with next_event.
+    Return the number of events queued.
+    """
+    n = 0
+    while True:
+        try:
+            e = _next_tracee_event(ptrace, None, False)
+        except PtraceFail as err:
+            if err.errno == errno.ECHILD:
+                return n
+            raise
+        if e is None:
+            return n
+        _queued[e[0]].append(e[1])
+        n += 1
+
+
+def wait_tid(ptrace, tid, regs=None):
+    """
+    Return (status, regs filled) for the next event of tid. With regs, GETREGS is done in the same call if the
+    thread stopped.
+    """
+    if tid in _queued:
+        return _pop(tid), False
+    if regs is None:
+        return _waitpid(ptrace, tid, WALL)[1], False
+    r, status, ok = ptrace.wait_getregs(tid, WALL, regs)
+    return status, ok
@@ -7,35 +7,74 @@ import os
 import signal 
 import time
 import logging
-import re
-from capstone import Cs, CS_ARCH_X86, CS_MODE_64
-from .utils import u64, u32
+import bisect
+import contextlib
+from ctypes import c_char, c_int, addressof, byref, memmove, sizeof
+from .utils import u64
+from .registers import RegisterFile, FpRegisterFile
+from .maps import MemoryMap
+from . import elf
+from .coverage import BlockCoverage
+from .symbols import symbols_of, Location
+from .disasm import InstructionCache, ends_block
+from . import unwind
+from .trace import TraceWriter, MemAccessDecoder, record_getter
+from .breakpoint import Breakpoint
+from . import events
+from .snapshot import Snapshot, layout_of, saved_mappings, clear_soft_dirty, dirty_runs
+from .syscalls import SyscallEvent, SyscallCatch, SYSCALL_ARGS, MAPS_SYSCALLS, syscall_number, install_seccomp
 
 logging = logging.getLogger("libdebug")
 
+PAGE_SIZE = 0x1000
+# longest basic block followed by the block step fallback, longer ones are executed one instruction at a time
+MAX_BLOCK_INSNS = 0x1000
+# stack read at once by backtrace, frames above it are read one word at a time
+STACK_WINDOW = 0x10000
+
 class DebugFail(Exception):
     pass
 
+def _page_groups(addrs):
+    # Group the sorted addresses by page: (first, last + 1, addresses) for each page
+    groups = []
+    for a in addrs:
+        if len(groups) > 0 and a // PAGE_SIZE == groups[-1][0] // PAGE_SIZE:
+            groups[-1][1] = a + 1
+            groups[-1][2].append(a)
+        else:
+            groups.append([a, a + 1, [a]])
+    return groups
+
 class Memory(collections.abc.MutableSequence):
 
-    def __init__(self, getter, setter):
+    def __init__(self, getter, setter, reader=None, writer=None):
         self.getword = getter
         self.setword = setter
+        # reader(addr, size) and writer(addr, data) move a whole range at once. Word access is used when they are missing
+        self.read = reader
+        self.write = writer
         self.word_size = 8
 
     def _retrive_data(self, start, stop):
-        data = b""
+        if self.read is not None:
+            return self.read(start, stop - start)
+        data = bytearray()
         for i in range(start, stop, self.word_size):
             n = self.getword(i)
             data += struct.pack("<q", n)
-        return data
+        return bytes(data)
 
     def __getitem__(self, index):
         if isinstance(index, slice):
+            if self.read is not None:
+                return self.read(index.start, index.stop - index.start)
             start = index.start // self.word_size * self.word_size
             stop = (index.stop + self.word_size) // self.word_size * self.word_size
             return self._retrive_data(start, stop)[index.start-start: index.stop-start]
         else:
+            if self.read is not None:
+                return self.read(index, 1)
             return (self.getword(index) & 0xff).to_bytes(1, 'little')
 
     def _set_data(self, start, value):
@@ -46,6 +85,10 @@ class Memory(collections.abc.MutableSequence):
             self.setword(i, data)
 
     def __setitem__(self, index, value):
+        if self.write is not None:
+            #TODO if is a slice ensure that value is not going after the end
+            self.write(index.start if isinstance(index, slice) else index, value)
+            return
         if isinstance(index, slice):
             start = index.start // self.word_size * self.word_size
             #TODO if is a slice ensure that value is not going after the end
@@ -73,12 +116,26 @@ class Memory(collections.abc.MutableSequence):
 class ThreadDebug():
     def __init__(self, tid=None):
         self.tid = tid
-        self.regs = {}
-        self.fpregs = {}
+        # Register files are allocated once and refilled in place at every stop
+        self.regs = RegisterFile()
+        self.fpregs = FpRegisterFile()
         self.regs_names = AMD64_REGS
         self.reg_size = 8
         self.running = True
-        self.ptrace = Ptrace()
+        # status of a stop not reported yet, the debugger found it while stopping all the threads
+        self.pending = None
+        # signal delivered to the thread when it resumes
+        self.signal = 0
+        # a PTRACE_INTERRUPT was sent and its stop did not come yet
+        self.interrupted = False
+        # the last stop was reported on a software breakpoint, the thread must step over it
+        self.on_breakpoint = False
+        # self.regs is valid only for the current stop. Writes are kept in self.regs and flushed before resuming
+        self.regs_valid = False
+        self.regs_dirty = False
+        self.fpregs_valid = False
+        self.fpregs_dirty = False
+        self.ptrace = ptrace_backend()
         #This is specific to intel x86_64
         self.hw_breakpoints = {'DR0': None, 'DR1': None, 'DR2': None, 'DR3': None,}
 
@@ -95,191 +152,172 @@ class ThreadDebug():
     def _get_reg(self, name):
         #This is an helping function to generate properties to access registers        
         def getter(self):
-            #reload registers
+            #reload registers only if the thread moved since the last read
             self.get_regs()
-            return self.regs[name]
+            return getattr(self.regs, name)
         def setter(self, value):
             self.get_regs()
-            self.regs[name] = value
-            self.set_regs()
+            setattr(self.regs, name, value)
+            self.regs_dirty = True
         return property(getter, setter, None, name)
 
+    def _invalidate_regs(self):
+        self.regs_valid = False
+        self.fpregs_valid = False
+
+    def _flush_regs(self):
+        # Write back the registers modified during this stop with a single SETREGS
+        if self.regs_dirty:
+            self.set_regs()
+        if self.fpregs_dirty:
+            self.set_fpregs()
+
+    def _getregs_error(self):
+        err = get_errno()
+        #We use geT_regs as test for the process if it is running we may stoppit before executing something
+        # ether the process is dead or is running
+        if err == errno.ESRCH and self.running:
+            #we should stop the process.
+            return
+        elif err == errno.ESRCH and not self.running:
+            logging.critical("The proccess %d is dead!", self.tid)
+        else:
+            logging.debug("getregs error: %d", err)
+            raise PtraceFail("GetRegs Failed. Do you have permisio? Running as sudo?")
+
     def set_regs(self):
         self._enforce_stop()
-
-        regs_values = []
-        for name in self.regs_names:
-            regs_values.append(self.regs[name])
- 
-        data = struct.pack("<" + "Q"*len(self.regs_names), *regs_values)
-        self.ptrace.setregs(self.tid, data)
+        self.ptrace.setregs(self.tid, self.regs)
+        self.regs_dirty = False
 
     def get_regs(self):
+        if self.regs_valid:
+            return self.regs
         self._enforce_stop()
-
-        buf = self.ptrace.getregs(self.tid)
-        if buf is None:
-            err = get_errno()
-            #We use geT_regs as test for the process if it is running we may stoppit before executing something
-            # ether the process is dead or is running
-            if err == errno.ESRCH and self.running:
-                #we should stop the process.
-                return None
-            elif err == errno.ESRCH and not self.running:
-                logging.critical("The proccess %d is dead!", self.tid)
-            else:
-                logging.debug("getregs error: %d", err)
-                raise PtraceFail("GetRegs Failed. Do you have permisio? Running as sudo?")
-
-        buf_size = len(self.regs_names) * self.reg_size 
-        regs = struct.unpack("<" + "Q"*len(self.regs_names), buf[:buf_size])
-
-        for name, value in zip(self.regs_names, regs):
-            self.regs[name] = value
-        logging.debug("TID[%d] %#x", self.tid, self.regs['rax'])
+        if self.regs_valid:
+            # _enforce_stop already fetched them while probing the thread
+            return self.regs
+
+        if self.ptrace.getregs(self.tid, self.regs) is None:
+            self._getregs_error()
+            return None
+        self.regs_valid = True
+        logging.debug("TID[%d] %#x", self.tid, self.regs.rax)
         return self.regs
 
     def _get_fpreg(self, name):
         #This is an helping function to generate properties to access fp registers        
         def getter(self):
-            #reload registers
+            #reload registers only if the thread moved since the last read
             self.get_fpregs()
-            return self.fpregs[name]
+            return getattr(self.fpregs, name)
         def setter(self, value):
             self.get_fpregs()
-            self.fpregs[name] = value
-            self.set_fpregs()
+            setattr(self.fpregs, name, value)
+            self.fpregs_dirty = True
         return property(getter, setter, None, name)
-   
 
     def get_fpregs(self):
+        if self.fpregs_valid:
+            return self.fpregs
         self._enforce_stop()
-        buf = self.ptrace.getfpregs(self.tid)
-        if buf is None:
-            err = get_errno()
-            #We use geT_regs as test for the process if it is running we may stoppit before executing something
-            # ether the process is dead or is running
-            if err == errno.ESRCH and self.running:
-                #we should stop the process.
-                return None
-            elif err == errno.ESRCH and not self.running:
-                logging.critical("The proccess is dead!")
-            else:
-                logging.debug("getregs error: %d", err)
-                raise PtraceFail("GetRegs Failed. Do you have permisio? Running as sudo?")
-
-        # FPREGS_SHORT = ["cwd", "swd", "ftw", "fop"]
-        # FPREGS_LONG  = ["rip", "rdp"]
-        # FPREGS_INT   = ["mxcsr", "mxcr_mask"]
-        # FPREGS_64    = ["fp%d" %i for i in range(16)]
-        # FPREGS_128   = ["xmm%d" %i for i in range(16)]
-
-        buf_start = 0
-        # SHORTS
-        buf_size = len(FPREGS_SHORT) * 2
-        regs = struct.unpack("<" + "H"*len(FPREGS_SHORT), self.buf[buf_start:buf_start+buf_size])
-        for name, value in zip(FPREGS_SHORT, regs):
-            self.fpregs[name] = value
-        buf_start += buf_size
-
-        # LONG
-        buf_size = len(FPREGS_LONG) * 8
-        regs = struct.unpack("<" + "Q"*len(FPREGS_LONG), self.buf[buf_start:buf_start+buf_size])
-        for name, value in zip(FPREGS_LONG, regs):
-            self.fpregs[name] = value
-        buf_start += buf_size
-
-        # INT
-        buf_size = len(FPREGS_INT) * 4
-        regs = struct.unpack("<" + "I"*len(FPREGS_INT), self.buf[buf_start:buf_start+buf_size])
-        for name, value in zip(FPREGS_INT, regs):
-            self.fpregs[name] = value
-        buf_start += buf_size
-
-
-        # ST 80bits
-        for r in FPREGS_80:
-            a, b =  struct.unpack("<QQ", self.buf[buf_start:buf_start+16])
-            value = (b << 64) | a
-            self.fpregs[r] = value
-            buf_start += 16
-
-        # XMM 128bits
-        for r in FPREGS_128:
-            a, b =  struct.unpack("<QQ", self.buf[buf_start:buf_start+16])
-            value = (b << 64) | a
-            self.fpregs[r] = value
-            buf_start += 16
 
+        if self.ptrace.getfpregs(self.tid, self.fpregs) is None:
+            self._getregs_error()
+            return None
+        self.fpregs_valid = True
         return self.fpregs
 
-
     def set_fpregs(self):
         self._enforce_stop()
-
-        data = b""
-        for r in FPREGS_SHORT:
-            data += struct.pack("<H", self.fpregs[r])
-        for r in FPREGS_LONG:
-            data += struct.pack("<Q", self.fpregs[r])
-        for r in FPREGS_INT:
-            data += struct.pack("<I", self.fpregs[r])
-        for r in FPREGS_80:
-            data += struct.pack("<QQ", self.fpregs[r] & 0xffffffffffffffff, self.fpregs[r] >> 64)
-        for r in FPREGS_128:
-            data += struct.pack("<QQ", self.fpregs[r] & 0xffffffffffffffff, self.fpregs[r] >> 64)
-        self.ptrace.setfpregs(data)
+        self.ptrace.setfpregs(self.tid, self.fpregs)
+        self.fpregs_dirty = False
 
     def _test_execution(self):
         # Test if the program is running or not.
         # If we are not able to get regs. The program is still running.
-        regs = self.ptrace.getregs(self.tid)
-        return not(regs is None)
-
-    def _sig_stop(self):
-        os.kill(self.tid, signal.SIGSTOP)
-
+        # When the thread is stopped the registers just read are valid for this stop.
+        if self.ptrace.getregs(self.tid, self.regs) is None:
+            return False
+        self.regs_valid = True
+        return True
 
     def _wait_process(self):
-        options = 0x40000000
-        buf = create_string_buffer(100)
-        for i in range(8):
-            buf[i] = b"\x00"
-        r = self.ptrace.waitpid(self.tid, buf, options)
-        status = u32(buf[:4])
+        status = c_int()
+        r = self.ptrace.waitpid(self.tid, byref(status), WALL)
+        status = status.value
         logging.debug("[TID %d] waitpid status: %#x, ret: %d", self.tid, status, r)
+        self._invalidate_regs()
         self.running = False
+        self.interrupted = False
 
     def _stop_process(self):
         logging.debug("[TID %d] Stopping the process", self.tid)
-        self._sig_stop()
+        self.ptrace.interrupt(self.tid)
         self._wait_process()
-        self.running = False
 
     def _enforce_stop(self):
-        # Can we trust self.running without any check?
+        # The debugger keeps self.running up to date, this is only for a thread used on its own
         if self.running and self._test_execution() == False:
-            #this should be a PTRACE_INTERRUPT # PTRACE_INTERRUPT causes issues
             self._stop_process()
 
+    def _resuming(self):
+        self._flush_regs()
+        self._invalidate_regs()
+        self.running = True
+        self.on_breakpoint = False
+        sig, self.signal = self.signal, 0
+        return sig
+
 
     def step(self):
         """
         Execute the next instruction (Step Into)
         """
         #Step can stuck running into syscalls
-        self.running = True
+        # a pending signal waits for the next cont
+        signal = self.signal
+        self._resuming()
+        self.signal = signal
         self.ptrace.singlestep(self.tid)
 
+    def int3_trap(self):
+        """
+        True if the SIGTRAP the thread is stopped for comes from an int3, not from a step, a block step or a watchpoint.
+        The address does not tell: an int3 can be right before where a step ends.
+        """
+        try:
+            # a general protection fault is a SIGSEGV with SI_KERNEL too
+            return self.ptrace.getsiginfo(self.tid) == (signal.SIGTRAP, SI_KERNEL)
+        except PtraceFail:
+            return False
+
+    def step_block(self):
+        """
+        Execute until the next taken branch (PTRACE_SINGLEBLOCK)
+        """
+        # a pending signal waits for the next cont
+        signal = self.signal
+        self._resuming()
+        self.signal = signal
+        self.ptrace.singleblock(self.tid)
+
 
     def cont(self):
         """
         Continue the execution until the next breakpoint is hitted or the program is stopped
         """
         #I need to execute at least another instruction otherwise I get always in the same bp
-        self.running = True
+        sig = self._resuming()
         # Probably should implement a timeout
-        self.ptrace.cont(self.tid)
+        self.ptrace.cont(self.tid, sig)
+
+    def syscall(self):
+        """
+        Continue the execution until the next syscall entry or exit
+        """
+        sig = self._resuming()
+        self.ptrace.syscall(self.tid, sig)
 
     #Struct User
     def _peek_user(self, addr):
@@ -300,6 +338,13 @@ class ThreadDebug():
         if self.hw_breakpoints[r] is not None:
             logging.error("Failed to set hw_bp %#lx. All hw register are used!", addr)
             return False
+        self.set_hw_bp(r, addr, cond, length)
+        return True
+
+    def set_hw_bp(self, r, addr, cond='X', length=8):
+        """
+        Set the debug register r (DR0-DR3) of the thread
+        """
         logging.debug("Setting bp %#lx in register %r", addr, r)
         #write value in the register
         self._poke_user(AMD64_DBGREGS_OFF[r], addr)
@@ -326,7 +371,6 @@ class ThreadDebug():
 
         #store that is in place        
         self.hw_breakpoints[r] = addr
-        return True
 
 
     def del_hw_bp(self, addr):
@@ -337,7 +381,14 @@ class ThreadDebug():
         if self.hw_breakpoints[r] != addr:
             logging.error("Failed to find a hw_bp for %#lx.", addr)
             return False
-        logging.debug("Stopping bp %#lx in register %r", addr, r)
+        self.clear_hw_bp(r)
+        return True
+
+    def clear_hw_bp(self, r):
+        """
+        Disable the debug register r (DR0-DR3) of the thread
+        """
+        logging.debug("Stopping bp %#lx in register %r", self.hw_breakpoints[r] or 0, r)
         #write value in the register (Not necessary to be onest)
         self._poke_user(AMD64_DBGREGS_OFF[r], 0x0)
         #enable the register from the ctrl
@@ -346,7 +397,17 @@ class ThreadDebug():
         self._poke_user(AMD64_DBGREGS_OFF['DR7'], ctrl_reg)
         #store that is in place        
         self.hw_breakpoints[r] = None
-        return True
+
+    def hw_hit(self):
+        """
+        Return the debug registers (DR0-DR3) that fired since the last call, from DR6
+        """
+        dr6 = self._peek_user(AMD64_DBGREGS_OFF['DR6'])
+        if dr6 & 0xf == 0:
+            return []
+        # the CPU never clears DR6
+        self._poke_user(AMD64_DBGREGS_OFF['DR6'], 0)
+        return [r for i, r in enumerate(AMD64_DBGREGS_HW) if dr6 & (1 << i)]
 
 class Debugger:
 
@@ -358,13 +419,48 @@ class Debugger:
         self.process = None
         #According to ptrace manual we need to keep track od the running state to discern if ESRCH is becouse the process is running or dead
         self.running = True
-        self.ptrace = Ptrace()
+        self.ptrace = ptrace_backend()
         self.regs_names = AMD64_REGS
         self.reg_size = 8
-        self.mem = Memory(self.peek, self.poke)
+        self.mem = Memory(self.peek, self.poke, self._read_mem, self._write_mem)
+        self._mem_fd = None
+        self._mem_fd_pid = None
+        self._status = c_int()
+        # address -> Breakpoint
         self.breakpoints = {}
-        self.map = {}
-        self.bases = {}
+        # address -> original byte of every int3 in memory. Reads through mem see the original bytes
+        self._shadow = {}
+        self._shadow_addrs = []
+        # address -> BlockCoverage of the one-shot int3 of the coverages being collected
+        self._oneshot = {}
+        self._coverages = []
+        # the incremental Snapshot the soft-dirty bits refer to
+        self._soft_dirty_snap = None
+        # debug register (DR0-DR3) -> Breakpoint. They are set on every thread, new ones included
+        self.hw_breakpoints = dict.fromkeys(AMD64_DBGREGS_HW)
+        # new threads that get the debug registers at their first stop
+        self._hw_new = set()
+        # syscall number (None for all) -> SyscallCatch
+        self.syscall_catches = {}
+        # tid -> SyscallEvent of the syscall the thread is in (None for execve), when its exit will stop the thread
+        self._in_syscall = {}
+        # syscall numbers of the seccomp filter installed by run
+        self._seccomp = None
+        self._last_status = 0
+        self._last_tid = None
+        # Maps are parsed lazily: only when they are marked stale or when an address misses the index.
+        # _stops counts the stops of the process so the maps are parsed at most once per stop after a miss
+        self._map = MemoryMap()
+        self._bases = {}
+        self._maps_stale = True
+        self._maps_stop = None
+        # decoded instructions, dropped when the memory under them is written or the mappings change
+        self._insns = InstructionCache(self._read_mem)
+        # pathname -> CallFrameInfo of the mapped files (None if they are not on disk), dropped with the mappings
+        self._cfi_tables = {}
+        # PTRACE_SINGLEBLOCK works (True), single steps like PTRACE_SINGLESTEP (False) or it is not known yet (None)
+        self._singleblock = None
+        self._stops = 0
         self.terminal = ['tmux', 'splitw', '-h']
 
         #create property for registers
@@ -378,101 +474,356 @@ class Debugger:
     def _get_reg(self, name):
         #This is an helping function to generate properties to access registers        
         def getter(self):
-            #reload registers
-            r = self.threads[self.cur_tid].get_regs()
-            return r[name]
+            if self.running:
+                self._enforce_stop()
+            return getattr(self.threads[self.cur_tid], name)
         def setter(self, value):
-            self.threads[self.cur_tid].get_regs()
-            self.threads[self.cur_tid].regs[name] = value
-            self.threads[self.cur_tid].set_regs()
+            if self.running:
+                self._enforce_stop()
+            setattr(self.threads[self.cur_tid], name, value)
         return property(getter, setter, None, name)
 
+    @property
+    def map(self):
+        if self._maps_stale:
+            self._retrieve_maps()
+        return self._map
+
+    @property
+    def bases(self):
+        if self._maps_stale:
+            self._retrieve_maps()
+        return self._bases
+
     def _sig_stop(self, pid):
         os.kill(pid, signal.SIGSTOP)
 
+    def _add_thread(self, tid):
+        if tid not in self.threads:
+            self.threads[tid] = ThreadDebug(tid)
+            events.register(tid, self)
+        return self.threads[tid]
+
+    def _remove_thread(self, tid):
+        self.threads.pop(tid, None)
+        self._in_syscall.pop(tid, None)
+        events.unregister(tid)
+        if self.cur_tid == tid and len(self.threads) > 0:
+            self.cur_tid = self.pid if self.pid in self.threads else next(iter(self.threads))
+
+    def _options(self):
+        #PTRACE_O_TRACEFORK, PTRACE_O_TRACEVFORK, PTRACE_O_TRACECLONE and PTRACE_O_TRACEEXIT
+        # TRACESYSGOOD marks syscall stops with SIGTRAP|0x80. TRACESECCOMP only with our filter, a filter of the
+        # process itself returning SECCOMP_RET_TRACE would stop it otherwise
+        options = PTRACE_O_TRACEFORK | PTRACE_O_TRACEVFORK | PTRACE_O_TRACECLONE | PTRACE_O_TRACEEXEC | PTRACE_O_TRACEEXIT | PTRACE_O_TRACESYSGOOD
+        if self._seccomp is not None:
+            options |= PTRACE_O_TRACESECCOMP
+        return options
+
+    def _seize(self, tid):
+        # Attach to a running thread and ask it to stop. Its threads created later are attached by the kernel
+        self.ptrace.seize(tid, self._options())
+        t = self._add_thread(tid)
+        self.ptrace.interrupt(tid)
+        t.interrupted = True
+
     def _find_new_tids(self):
-        #identify threads for the current process
+        #identify threads for the current process. The ones created after the attach come with PTRACE_EVENT_CLONE
         path = "/proc/%d/task/" % self.pid
-        tids = list(map(int, os.listdir(path)))
-        logging.debug("tids: %r", tids)
-        for t in tids:
-            if t not in self.threads:
-                logging.debug("New Thread %d", t)
-                self.threads[t] = ThreadDebug(t)
-                # self._sig_stop(t)
-                # self.attach(t)
-
-    def _wait_process(self, pid=None):
-        pid = self.pid if pid is None else pid
-        options = 0x40000000
-        buf = create_string_buffer(100)
-        r = self.ptrace.waitpid(pid, buf, options)
-        status = u32(buf[:4])
-        logging.debug("waitpid status: %#x, ret: %d", status, r)
-
-        if WIFEXITED(status):
-            logging.info("Thread %d is dead", r)
-            del self.threads[r]
+        failed = set()
+        while True:
+            tids = [t for t in map(int, os.listdir(path)) if t not in self.threads and t not in failed]
+            logging.debug("tids: %r", tids)
+            if len(tids) == 0:
+                break
+            for t in tids:
+                try:
+                    self._seize(t)
+                except PtraceFail:
+                    # the thread exited or it was created by a thread already seized
+                    if t == self.pid:
+                        raise
+                    failed.add(t)
+
+    def _handle_event(self, tid, status):
+        # Update the threads for an event of tid. Return True if the stop must be reported to the script, False for
+        # the events the debugger handles by itself (new threads, interrupts, exits)
+        self._last_status = status
+        self._last_tid = tid
+        self._stops += 1
+        t = self.threads.get(tid)
+        if not WIFSTOPPED(status):
+            logging.info("Thread %d is dead", tid)
+            self._remove_thread(tid)
             if len(self.threads) == 0:
+                self.running = False
                 raise DebugFail("All threads are dead")
-        self._retrieve_maps()
-        self._find_new_tids()
-        self.running = False
+            return False
+        if t is None:
+            return False
+        t.running = False
+        t._invalidate_regs()
+        if tid in self._hw_new:
+            self._hw_new.discard(tid)
+            self._install_hw(t)
+        # Maps and threads are refreshed only by the events that can change them
+        event = status >> 16
+        if event == PTRACE_EVENT_STOP:
+            # PTRACE_INTERRUPT, a group-stop or the first stop of a new thread
+            if WSTOPSIG(status) == signal.SIGTRAP:
+                t.interrupted = False
+            return False
+        if event == PTRACE_EVENT_CLONE:
+            new = self.ptrace.geteventmsg(tid)
+            logging.debug("New Thread %d", new)
+            # it is already traced, its first stop comes by itself
+            self._add_thread(new)
+            if self._hw_used():
+                self._hw_new.add(new)
+            return False
+        if event == PTRACE_EVENT_FORK or event == PTRACE_EVENT_VFORK:
+            self._release_child(self.ptrace.geteventmsg(tid), event == PTRACE_EVENT_VFORK)
+            return False
+        if event == PTRACE_EVENT_EXIT or event == PTRACE_EVENT_VFORK_DONE:
+            return False
+        if event == PTRACE_EVENT_EXEC:
+            self._maps_stale = True
+            self._insns.clear()
+            self._drop_int3()
+            self._soft_dirty_snap = None
+            # the other threads are gone, the one calling exec took the pid
+            for other in list(self.threads):
+                if other != tid:
+                    self._remove_thread(other)
+            # the stop is inside execve, its syscall exit is still to come
+            self._in_syscall[tid] = None
+            # exec clears the debug registers
+            t.hw_breakpoints = dict.fromkeys(AMD64_DBGREGS_HW)
+            self._install_hw(t)
+            return True
+        if event == 0 and WSTOPSIG(status) & 0x7f != signal.SIGTRAP:
+            # signal-delivery-stop, the signal is delivered when the thread resumes
+            t.signal = WSTOPSIG(status)
+        return True
 
-    def _stop_process(self):
-        logging.debug("Stopping the process")
-        self._sig_stop(self.pid)
-        self._wait_process()
+    def _release_child(self, pid, vfork):
+        # A child made by fork is traced too. It gets its original code back and it is detached.
+        # After vfork the memory is the one of the parent, the int3 stay there
+        logging.debug("detaching forked child %d", pid)
+        events.wait_tid(self.ptrace, pid)
+        if not vfork and len(self._shadow) > 0:
+            fd = os.open("/proc/%d/mem" % pid, os.O_RDWR)
+            try:
+                for addr, orig in self._shadow.items():
+                    os.pwrite(fd, bytes([orig]), addr)
+            finally:
+                os.close(fd)
+        self.ptrace.detach(pid)
+        events.unregister(pid)
+
+    def _wait_thread(self, tid):
+        # Wait for the next event of tid, the other threads must be stopped. Return its status
+        t = self.threads[tid]
+        status, regs_ok = events.wait_tid(self.ptrace, tid, None if t.regs_dirty else t.regs)
+        logging.debug("[TID %d] waitpid status: %#x", tid, status)
+        self._handle_event(tid, status)
+        # The registers are fetched in the same call, most of the stops read at least rip
+        t.regs_valid = regs_ok
+        return status
+
+    def _wait_event(self):
+        # Wait for the next stop to report and return (tid, status). The threads stopped by the events handled by
+        # the debugger are resumed, one waitpid(-1) serves all the threads
+        while True:
+            tid, status = events.next_event(self.ptrace, self)
+            logging.debug("[TID %d] waitpid status: %#x", tid, status)
+            if self._handle_event(tid, status):
+                return tid, status
+            t = self.threads.get(tid)
+            if t is not None and not t.running:
+                self._resume(t)
+
+    def _pump(self, timeout):
+        # Handle the events of the running threads for timeout seconds without blocking. The first stop to report is
+        # kept in pending and the pump stops there
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            e = events.next_event(self.ptrace, self, block=False)
+            if e is None:
+                time.sleep(0.001)
+                continue
+            tid, status = e
+            if self._handle_event(tid, status):
+                self.threads[tid].pending = status
+                return
+            t = self.threads.get(tid)
+            if t is not None and not t.running:
+                self._resume(t)
+
+    def _stop_all(self):
+        # Stop every running thread with PTRACE_INTERRUPT. A thread that stops for something else keeps the event in
+        # pending, it is reported by the next cont
+        for t in self.threads.values():
+            if t.running and not t.interrupted:
+                try:
+                    self.ptrace.interrupt(t.tid)
+                    t.interrupted = True
+                except PtraceFail:
+                    # it is exiting, waitpid reports it
+                    pass
+        while any(t.running for t in self.threads.values()):
+            tid, status = events.next_event(self.ptrace, self)
+            if self._handle_event(tid, status):
+                self.threads[tid].pending = status
         self.running = False
 
-    def _enforce_stop(self):
-        # Can we trust self.running without any check?
+    def _resume_all(self):
+        self.running = True
+        for t in self.threads.values():
+            if not t.running:
+                self._resume(t)
+
+    def _settle(self, t):
+        # A PTRACE_INTERRUPT sent while the thread was stopping for something else is still pending, it would be the
+        # next stop of the thread. Let it happen before single stepping
+        if t.interrupted:
+            t._flush_regs()
+            t.running = True
+            self.ptrace.cont(t.tid)
+            self._wait_thread(t.tid)
+
+    def _pending_tid(self):
+        t = self.threads.get(self.cur_tid)
+        if t is not None and t.pending is not None:
+            return self.cur_tid
         for tid, t in self.threads.items():
-            t._enforce_stop()
+            if t.pending is not None:
+                return tid
+        return None
+
+    def _report(self, tid, status):
+        # The stop of tid is the one the script sees. Return True if the control goes back to the script
+        self.threads[tid].pending = None
+        self.cur_tid = tid
+        self._last_status = status
+        self._last_tid = tid
+        stop = self._syscall_stop()
+        if stop is None and self._oneshot_hit():
+            # the execution goes on, without breakpoints to step over
+            return False
+        if stop is None:
+            stop = self._dispatch(self._breakpoint_hit())
+        return stop
+
+    def _oneshot_hit(self):
+        # A coverage int3: record the block, remove the int3 for good and move rip back. False for any other stop
+        status = self._last_status
+        if len(self._coverages) == 0 or status >> 16 != 0 or WSTOPSIG(status) != signal.SIGTRAP:
+            return False
+        t = self.threads[self.cur_tid]
+        addr = t.rip - 1
+        if addr not in self._oneshot and (addr in self._shadow or not any(addr in c for c in self._coverages)):
+            return False
+        # a step can end right after a coverage int3 without running it
+        if not t.int3_trap():
+            return False
+        # if there is none another thread hit the same int3 first and removed it
+        self._take_oneshot(addr)
+        t.rip = addr
+        return True
+
+    def _take_oneshot(self, addr):
+        # Record the block of the coverage int3 at addr and remove the int3 for good. False if there is none
+        cov = self._oneshot.pop(addr, None)
+        if cov is None:
+            return False
+        self._remove_int3(addr)
+        cov.hit(addr)
+        return True
+
+    def _enforce_stop(self):
+        if not self.running or self.pid is None:
+            return
+        self._stop_all()
+        # After a non blocking continue nobody checked why the process stopped.
+        # The process is already stopped, the result of the callback does not matter
+        tid = self._pending_tid()
+        if tid is not None:
+            self._report(tid, self.threads[tid].pending)
 
 
     def _is_next_instr_call(self):
-        rip = self.rip
-        #fetch 6 bytes. 5 should be enough
-        code = self.mem[rip: rip+6]
         #maybe we should check if it is 32 or 64 mode
-        md = Cs(CS_ARCH_X86, CS_MODE_64)
-        (address, size, mnemonic, op_str) = next(md.disasm_lite(code, 0x1000))
-        if mnemonic == "call":
-            return True
-        return False
+        insn = self._insns.get(self.rip)
+        return insn is not None and insn.mnemonic == "call"
 
-    def _option_setup(self):
-        #PTRACE_O_TRACEFORK, PTRACE_O_TRACEVFORK, PTRACE_O_TRACECLONE and PTRACE_O_TRACEEXIT
-        self.ptrace.setoptions(self.pid, PTRACE_O_TRACEFORK | PTRACE_O_TRACEVFORK | PTRACE_O_TRACECLONE | PTRACE_O_TRACEEXIT)
+    def disasm(self, addr=None, count=1):
+        """
+        Return a list of up to count Instructions (address, size, mnemonic, op_str, bytes) starting from addr (rip
+        by default). Breakpoints are hidden. Instructions are cached until the memory under them is written.
+        """
+        self._enforce_stop()
+        if addr is None:
+            addr = self.rip
+        return self._insns.disasm(addr, count)
 
     ### Attach/Detach
-    def run(self, path, args=[], sleep=None):
+    def run(self, path, args=[], sleep=None, seccomp=None, stdin=None):
+        """
+        Start path with args under the debugger. The process is stopped after the exec.
+        seccomp is a list of syscalls (names or numbers): a seccomp-BPF filter is installed before the exec and only
+        these syscalls stop the process for syscall catchpoints, all the other ones run at full speed.
+        stdin (bytes) is the content of the standard input of the process.
+        """
         # Gdb does tons of configuration when setting up a new process start
         # For now this is a simple as I can write it
+        self._seccomp = None if seccomp is None else [syscall_number(n) for n in seccomp]
+        stdin_fd = None
+        if stdin is not None:
+            # a memfd and not a pipe: the whole input is there before the process starts, nobody has to feed it
+            stdin_fd = os.memfd_create("stdin")
+            os.write(stdin_fd, stdin)
+            os.lseek(stdin_fd, 0, os.SEEK_SET)
         pid = os.fork()
         if pid == 0:
             #child process
-            # PTRACE ME
-            self.ptrace.traceme()
-            # logging.debug("attached %d", r)
             args = [path,] + args
             try:
+                if stdin_fd is not None:
+                    os.dup2(stdin_fd, 0)
+                    os.close(stdin_fd)
+                if self._seccomp is not None:
+                    install_seccomp(self.ptrace.libc, self._seccomp)
+                # wait for the tracer. It seizes the stopped child, so it can be interrupted later
+                os.kill(os.getpid(), signal.SIGSTOP)
                 os.execv(path, args)
             except Exception as e:
                 raise DebugFail("Exec of new process failed: %r" % e)
+        if stdin_fd is not None:
+            os.close(stdin_fd)
         self.pid = pid
         self.cur_tid = pid
-        t = ThreadDebug(pid)
-        self.threads[pid] = t
+        self.process = pid
+        self._maps_stale = True
+        self._insns.clear()
         logging.info("new process <%d> %r", self.pid, args)
         logging.debug("waiting for child process %d", self.pid)
-        self._wait_process()
-        self._option_setup()
+        self.ptrace.waitpid(pid, byref(self._status), WUNTRACED)
+        t = self._add_thread(pid)
+        self.ptrace.seize(pid, self._options())
+        os.kill(pid, signal.SIGCONT)
+        # go on until the exec. The filtered syscalls done before it are let through
+        while True:
+            self._wait_event()
+            if self._last_status >> 16 == PTRACE_EVENT_EXEC:
+                break
+            t.signal = 0
+            self._resume(t)
+        self.running = False
         if sleep is not None:
-            self.cont(blocking=False)
-            time.sleep(sleep)
-            self._sig_stop(self.pid)
+            self._cont_resume()
+            self._pump(sleep)
+            self._enforce_stop()
 
     def attach(self, pid):
         """
@@ -481,13 +832,11 @@ class Debugger:
         logging.info("attaching to pid %d", pid)      
         self.pid = pid
         self.cur_tid = pid
-
-        self.ptrace.attach(pid)
-
-        t = ThreadDebug(pid)
-        self.threads[pid] = t
-        self._wait_process()
-        self._option_setup()
+        self._maps_stale = True
+        self._insns.clear()
+        self._find_new_tids()
+        self._stop_all()
+        self._install_breakpoints()
 
     def reattach(self):
         """
@@ -500,7 +849,6 @@ class Debugger:
         while True:
             try:
                 self.attach(self.old_pid)
-                self._option_setup()
                 return
             except:
                 logging.debug("Failed to attach")
@@ -510,9 +858,24 @@ class Debugger:
         """
         Detach the current process
         """
-        for tid in self.threads:
+        self._enforce_stop()
+        for t in self.threads.values():
+            # a breakpoint hit not reported yet: the thread must execute the original instruction
+            if t.pending is not None and t.pending >> 16 == 0 and WSTOPSIG(t.pending) == signal.SIGTRAP and t.rip - 1 in self._shadow:
+                t.rip -= 1
+        # int3 left in memory would kill the process once we are not there to catch them
+        self._remove_all_int3()
+        for tid, t in self.threads.items():
             logging.info("Detach tid %d", tid)      
-            self.ptrace.detach(tid)
+            for r, addr in t.hw_breakpoints.items():
+                if addr is not None:
+                    t.clear_hw_bp(r)
+            t._flush_regs()
+            self.ptrace.detach(tid, t.signal)
+            events.unregister(tid)
+        self.threads = {}
+        self._in_syscall.clear()
+        self._close_mem_fd()
         self.old_pid = self.pid
         self.pid = None
 
@@ -522,12 +885,27 @@ class Debugger:
         This sto the execution of the process executed with `run`
         """
 
-        if self.process is not None:
-            os.kill(self.old_pid, signal.SIGKILL)
-            self.detach()
-            # self.process.terminate()
-            # self.process.kill()
-            os.kill(self.old_pid, signal.SIGKILL)
+        if self.process is None or self.pid is None:
+            return
+        # every thread stops at PTRACE_EVENT_EXIT and then reports its death
+        try:
+            if len(self.threads) > 0:
+                os.kill(self.pid, signal.SIGKILL)
+            while len(self.threads) > 0:
+                tid, status = events.next_event(self.ptrace, self)
+                self._handle_event(tid, status)
+                if WIFSTOPPED(status):
+                    try:
+                        self.ptrace.cont(tid)
+                    except PtraceFail:
+                        pass
+        except DebugFail:
+            pass
+        self._close_mem_fd()
+        self.old_pid = self.pid
+        self.pid = None
+        self.process = None
+        self.running = False
 
 
     def gdb(self, spawn=False):
@@ -536,6 +914,7 @@ class Debugger:
         """
 
         #Stop the process so you can continue exactly form where you let in the script
+        self._enforce_stop()
         for tid in self.threads:
             self._sig_stop(tid)
         #detach
@@ -574,185 +953,807 @@ class Debugger:
         self._enforce_stop()
         # according to man ptrace no difference for PTRACE_POKETEXT and PTRACE_POKEDATA on linux
         self.ptrace.poke(self.pid, addr, value)
+        self._insns.invalidate(addr, addr + 8)
+
+    def _proc_mem_fd(self):
+        # /proc/pid/mem is kept open for the whole session. It is reopened if the pid changes
+        if self._mem_fd is not None and self._mem_fd_pid != self.pid:
+            self._close_mem_fd()
+        if self._mem_fd is None:
+            try:
+                self._mem_fd = os.open("/proc/%d/mem" % self.pid, os.O_RDWR)
+                self._mem_fd_pid = self.pid
+            except OSError as e:
+                logging.debug("Failed to open /proc/%d/mem: %r", self.pid, e)
+                return None
+        return self._mem_fd
+
+    def _close_mem_fd(self):
+        if self._mem_fd is not None:
+            os.close(self._mem_fd)
+        self._mem_fd = None
+        self._mem_fd_pid = None
+
+    def _read_proc_mem(self, addr, size):
+        fd = self._proc_mem_fd()
+        if fd is None:
+            return b""
+        try:
+            return os.pread(fd, size, addr)
+        except (OSError, OverflowError) as e:
+            logging.debug("pread of /proc/%d/mem @%#x failed: %r", self.pid, addr, e)
+            return b""
+
+    def _write_proc_mem(self, addr, data):
+        fd = self._proc_mem_fd()
+        if fd is None:
+            return 0
+        try:
+            return os.pwrite(fd, data, addr)
+        except (OSError, OverflowError) as e:
+            logging.debug("pwrite of /proc/%d/mem @%#x failed: %r", self.pid, addr, e)
+            return 0
+
+    def _peek_range(self, addr, size):
+        start = addr // 8 * 8
+        data = self.ptrace.peek_many(self.pid, start, (addr + size - start + 7) // 8)
+        return data[addr-start: addr-start+size]
+
+    def _poke_range(self, addr, data):
+        start = addr // 8 * 8
+        stop = (addr + len(data) + 7) // 8 * 8
+        words = bytearray(stop - start)
+        # Only the unaligned edge words need to be read back
+        if start != addr:
+            words[:8] = struct.pack("<q", self.ptrace.peek(self.pid, start))
+        if stop != addr + len(data):
+            words[-8:] = struct.pack("<q", self.ptrace.peek(self.pid, stop - 8))
+        words[addr-start: addr-start+len(data)] = data
+        for i in range(0, len(words), 8):
+            self.ptrace.poke(self.pid, start + i, struct.unpack_from("<Q", words, i)[0])
+
+    def _read_mem_raw(self, addr, size):
+        """
+        Read size bytes starting from addr, as they are in memory.
+        The whole range is moved with process_vm_readv. Pages it refuses are read from /proc/pid/mem and,
+        if that fails too, with word peeks.
+        """
+        if size <= 0:
+            return b""
+        self._check_mem_address(addr)
+        self._enforce_stop()
+        data = bytearray(size)
+        cbuf = (c_char * size).from_buffer(data)
+        done = 0
+        while done < size:
+            r = self.ptrace.vm_readv(self.pid, addr + done, addressof(cbuf) + done, size - done)
+            if r > 0:
+                done += r
+                continue
+            # process_vm_readv stopped at this page. Move up to the next page boundary in a different way
+            page_end = min(size, (addr + done + PAGE_SIZE) // PAGE_SIZE * PAGE_SIZE - addr)
+            chunk = self._read_proc_mem(addr + done, page_end - done)
+            if len(chunk) < page_end - done:
+                chunk += self._peek_range(addr + done + len(chunk), page_end - done - len(chunk))
+            data[done:page_end] = chunk
+            done = page_end
+        return bytes(data)
+
+    def _write_mem_raw(self, addr, data):
+        """
+        Write data starting from addr, overwriting breakpoints too.
+        The whole range is moved with process_vm_writev. Pages it refuses, as read-only code, are written
+        through /proc/pid/mem and, if that fails too, with word pokes.
+        """
+        if len(data) == 0:
+            return
+        logging.debug("writing @%#x <- %s", addr, data)
+        self._check_mem_address(addr)
+        self._enforce_stop()
+        data = bytes(data)
+        size = len(data)
+        cbuf = (c_char * size).from_buffer_copy(data)
+        done = 0
+        while done < size:
+            r = self.ptrace.vm_writev(self.pid, addr + done, addressof(cbuf) + done, size - done)
+            if r > 0:
+                done += r
+                continue
+            # /proc/pid/mem writes like ptrace does, ignoring the protection of the page
+            r = self._write_proc_mem(addr + done, data[done:])
+            if r > 0:
+                done += r
+                continue
+            page_end = min(size, (addr + done + PAGE_SIZE) // PAGE_SIZE * PAGE_SIZE - addr)
+            self._poke_range(addr + done, data[done:page_end])
+            done = page_end
 
  
+    def _shadowed(self, addr, size):
+        # addresses of the int3 in [addr, addr+size)
+        i = bisect.bisect_left(self._shadow_addrs, addr)
+        j = bisect.bisect_left(self._shadow_addrs, addr + size, i)
+        return self._shadow_addrs[i:j]
+
+    def _read_mem(self, addr, size):
+        """
+        Read size bytes starting from addr. Breakpoints are hidden, their original bytes are returned.
+        """
+        data = self._read_mem_raw(addr, size)
+        shadowed = self._shadowed(addr, size)
+        if len(shadowed) == 0:
+            return data
+        data = bytearray(data)
+        for a in shadowed:
+            data[a-addr] = self._shadow[a]
+        return bytes(data)
+
+    def _write_mem(self, addr, data):
+        """
+        Write data starting from addr. Breakpoints in the range stay in place, the new bytes become their original bytes.
+        """
+        shadowed = self._shadowed(addr, len(data))
+        if len(shadowed) > 0:
+            data = bytearray(data)
+            for a in shadowed:
+                self._shadow[a] = data[a-addr]
+                data[a-addr] = 0xcc
+        self._write_mem_raw(addr, data)
+        self._insns.invalidate(addr, addr + len(data))
+
     def _base_guess(self):
-        if len(self.map) == 0:
+        if len(self._map) == 0:
             logging.warning("Failed to guess the bases.")
             return
 
-        self.bases["main"] = min([m for m in self.map if self.map[m]['file'] is not None])
-        logging.debug("new base main guessed at %#x", self.bases["main"])
-
-        for m in self.map:
-            if self.map[m]['offset'] == 0 and self.map[m]['file'] is not None:
-                name = self.map[m]['file']
-                self.bases[name] = m
-                logging.debug("new base %s guessed at %#x", name, m)
+        for name, base in self._map.bases().items():
+            if self._bases.get(name) != base:
+                logging.debug("new base %s guessed at %#x", name, base)
+            self._bases[name] = base
 
     def _retrieve_maps(self):
-        # map file example
-        # 560df069c000-560df069d000 r--p 00000000 fe:01 4859834                    /usr/bin/python3.10
-        # 55c1b7eaf000-55c1b7eb0000 r--p 00000000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test
-        # 55c1b7eb0000-55c1b7eb1000 r-xp 00001000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test
-        # 55c1b7eb1000-55c1b7eb2000 r--p 00002000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test
-        # 55c1b7eb2000-55c1b7eb3000 r--p 00002000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test
-        # 55c1b7eb3000-55c1b7eb4000 rw-p 00003000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test
-        # 7f7fd6b48000-7f7fd6b4a000 rw-p 00000000 00:00 0 
-        # 7f7fd6b4a000-7f7fd6b76000 r--p 00000000 00:19 9051255                    /usr/lib/libc.so.6
-        # 7f7fd6b76000-7f7fd6cec000 r-xp 0002c000 00:19 9051255                    /usr/lib/libc.so.6
-        # 7f7fd6cec000-7f7fd6d40000 r--p 001a2000 00:19 9051255                    /usr/lib/libc.so.6
-        # 7f7fd6d40000-7f7fd6d41000 ---p 001f6000 00:19 9051255                    /usr/lib/libc.so.6
-        # 7f7fd6d41000-7f7fd6d44000 r--p 001f6000 00:19 9051255                    /usr/lib/libc.so.6
-        # 7f7fd6d44000-7f7fd6d47000 rw-p 001f9000 00:19 9051255                    /usr/lib/libc.so.6
-        # 7f7fd6d47000-7f7fd6d56000 rw-p 00000000 00:00 0 
-        # 7f7fd6d96000-7f7fd6d98000 r--p 00000000 00:19 9051246                    /usr/lib/ld-linux-x86-64.so.2
-        # 7f7fd6d98000-7f7fd6dbf000 r-xp 00002000 00:19 9051246                    /usr/lib/ld-linux-x86-64.so.2
-        # 7f7fd6dbf000-7f7fd6dca000 r--p 00029000 00:19 9051246                    /usr/lib/ld-linux-x86-64.so.2
-        # 7f7fd6dcb000-7f7fd6dcd000 r--p 00034000 00:19 9051246                    /usr/lib/ld-linux-x86-64.so.2
-        # 7f7fd6dcd000-7f7fd6dcf000 rw-p 00036000 00:19 9051246                    /usr/lib/ld-linux-x86-64.so.2
-        # 7ffcc2eef000-7ffcc2f10000 rw-p 00000000 00:00 0                          [stack]
-        # 7ffcc2fab000-7ffcc2faf000 r--p 00000000 00:00 0                          [vvar]
-        # 7ffcc2faf000-7ffcc2fb1000 r-xp 00000000 00:00 0                          [vdso]
-        # ffffffffff600000-ffffffffff601000 --xp 00000000 00:00 0                  [vsyscall]
-        l_regx = "(?P<start>[0-9a-f]+)-(?P<stop>[0-9a-f]+)\s+(?P<read>[r-])(?P<write>[w-])(?P<exec>[x-])([p-])\s+(?P<offset>[0-9a-f]+)\s+[0-9a-f]+:[0-9a-f]+\s+(?P<inode>[0-9]+)\s+(?P<pathname>\/.*[\w:]+|\[\w+\])?"
         pid = self.pid
         logging.debug("Retrieving mem maps")
+        layout = layout_of(self._map)
         with open(f"/proc/{pid}/maps", 'r') as f:
-            self.map = {}
-            for l in f.readlines():
-                m = re.match(l_regx, l)
-                if m is None:
-                    logging.warning("Failed loading map table: %s", l)
-                    continue
-                md = m.groupdict()
-                perm = 4 if md['read']  == 'r' else 0 \
-                     + 2 if md['write'] == 'w' else 0 \
-                     + 1 if md['exec']  == 'x' else 0
-                start = int(md['start'], 16)
-                stop = int(md['stop'], 16)
-                offset = int(md['offset'], 16)
-
-                segment = {"start": start, 
-                           "stop": stop,
-                           "perms": perm,
-                           "offset": offset, 
-                           "pathname": md['pathname'],
-                           "file": os.path.basename(md['pathname'])  if md['pathname'] is not None else None}
-                self.map[start] = segment
+            self._map = MemoryMap.parse(f)
+        if layout_of(self._map) != layout:
+            self._insns.clear()
+            self._cfi_tables.clear()
+        self._maps_stale = False
+        self._maps_stop = self._stops
         self._base_guess()
 
+    def refresh_maps(self):
+        """
+        Parse again /proc/pid/maps. Maps are refreshed automatically when an address is not found in them,
+        use this if the process changed a mapping you already know about.
+        """
+        self._retrieve_maps()
+        return self._map
+
     def _check_mem_address(self, addr, warn=True):
-        for m in self.map:
-            if self.map[m]['start'] <= addr < self.map[m]['stop']:
+        if self.map.find(addr) is not None:
+            return True
+        # The index may be older than the mappings. Parse the maps again, but only once for each stop
+        if self._maps_stop != self._stops:
+            self._retrieve_maps()
+            if self._map.find(addr) is not None:
                 return True
         if warn:
             logging.warning("The address %#x is outside any memory reagion", addr)
         return False
 
     ## Control Flow
-    def _set_breakpoints(self):
-        for b in self.breakpoints:
-            self.breakpoints[b] = self.mem[b]
-            self.mem[b] = b"\xcc"
-
-    def _retore_breakpoints(self):
+    def _insert_int3(self, addr):
+        self._shadow[addr] = self._read_mem_raw(addr, 1)[0]
+        bisect.insort(self._shadow_addrs, addr)
+        self._write_mem_raw(addr, b"\xcc")
+
+    def _remove_int3(self, addr):
+        orig = self._shadow.pop(addr)
+        del self._shadow_addrs[bisect.bisect_left(self._shadow_addrs, addr)]
+        self._write_mem_raw(addr, bytes([orig]))
+
+    def _drop_int3(self):
+        # The memory with the int3 is gone (exec). Forget them without writing
+        self._shadow.clear()
+        self._shadow_addrs = []
+        self._oneshot.clear()
+        self._coverages = []
+
+    def _insert_int3_bulk(self, addrs):
+        # _insert_int3 for many sorted addresses, with one read and one write per page
+        for start, stop, group in _page_groups(addrs):
+            data = bytearray(self._read_mem_raw(start, stop - start))
+            for a in group:
+                self._shadow[a] = data[a-start]
+                data[a-start] = 0xcc
+            self._write_mem_raw(start, data)
+        self._shadow_addrs = sorted(self._shadow)
+
+    def _remove_int3_bulk(self, addrs):
+        for start, stop, group in _page_groups(addrs):
+            data = bytearray(self._read_mem_raw(start, stop - start))
+            for a in group:
+                data[a-start] = self._shadow.pop(a)
+            self._write_mem_raw(start, data)
+        self._shadow_addrs = sorted(self._shadow)
+
+    def _remove_all_int3(self):
+        self._remove_int3_bulk(list(self._shadow_addrs))
+        self._oneshot.clear()
+
+    def _install_breakpoints(self):
+        for addr, b in self.breakpoints.items():
+            if b.enabled and not b.hw and addr not in self._shadow:
+                self._insert_int3(addr)
+        for t in self.threads.values():
+            self._install_hw(t)
+
+    def _breakpoint_hit(self):
         # Some time this stop exactly before the execution of the bp some time after.
-        if self.rip not in self.breakpoints and self.rip-1 in self.breakpoints:
-            self.rip -= 1
-        for b in self.breakpoints:
-            self.mem[b] = self.breakpoints[b]
-            self.breakpoints[b] = None
+        # A software breakpoint stops after the int3, move rip back to the breakpoint and return it.
+        t = self.threads[self.cur_tid]
+        fired = []
+        if self._hw_used() and self._last_status >> 16 == 0 and WSTOPSIG(self._last_status) == signal.SIGTRAP:
+            # a watchpoint stops after the access, only DR6 tells which one it was
+            fired = [self.hw_breakpoints[r] for r in t.hw_hit() if self.hw_breakpoints[r] is not None]
+        rip = t.rip
+        # a hardware breakpoint, a watchpoint or a signal can stop right after an int3 that did not run
+        if rip-1 in self._shadow and t.int3_trap():
+            rip -= 1
+            t.rip = rip
+        b = self.breakpoints.get(rip)
+        if b is None and len(fired) > 0:
+            b = fired[0]
+        if b is not None and b.enabled:
+            t.on_breakpoint = True
+            return b
+        return None
+
+    def _dispatch(self, b):
+        # Return True if the control goes back to the script, False to continue the execution
+        if b is None:
+            return True
+        if not b.test(self, self.threads[self.cur_tid].regs):
+            return False
+        b.hit_count += 1
+        logging.debug("hit %r", b)
+        if b.callback is None:
+            return True
+        return bool(b.callback(self, b))
+
+    def _resume(self, t):
+        # PTRACE_SYSCALL when syscalls are caught: always without seccomp, only to see the exit of a syscall with it
+        catching = self._seccomp is None and self._catching_syscalls()
+        if catching or self._in_syscall.get(t.tid) is not None:
+            t.syscall()
+        else:
+            # the exit of execve matters only to the catchpoints
+            self._in_syscall.pop(t.tid, None)
+            t.cont()
+
+    def _catching_syscalls(self):
+        for c in self.syscall_catches.values():
+            if c.enabled:
+                return True
+        return False
+
+    def _syscall_stop(self):
+        # Handle the last stop if it is a syscall stop. Return None if it is not one, otherwise True if the control
+        # goes back to the script and False to continue the execution
+        status = self._last_status
+        tid = self._last_tid
+        if not WIFSTOPPED(status) or tid not in self.threads:
+            return None
+        seccomp = status >> 16 == PTRACE_EVENT_SECCOMP
+        if not seccomp and WSTOPSIG(status) != signal.SIGTRAP | 0x80:
+            return None
+        entry = seccomp or tid not in self._in_syscall
+        regs = self.threads[tid].get_regs()
+        event = SyscallEvent(tid, regs.orig_rax, tuple(getattr(regs, r) for r in SYSCALL_ARGS), None if entry else regs.rax)
+        self._in_syscall.pop(tid, None)
+        if not entry and event.number in MAPS_SYSCALLS:
+            self._maps_stale = True
+            self._insns.clear()
+        c = self.syscall_catches.get(event.number)
+        if c is None:
+            c = self.syscall_catches.get(None)
+        if entry and (not seccomp or (c is not None and c.enabled and c.exit) or event.number in MAPS_SYSCALLS):
+            # the thread will stop at the exit
+            self._in_syscall[tid] = event
+        if c is None or not c.enabled or not (c.entry if entry else c.exit):
+            return False
+        c.hit_count += 1
+        logging.debug("syscall %r", event)
+        self.cur_tid = tid
+        if c.callback is None:
+            return True
+        return bool(c.callback(self, event))
+
+    def catch_syscall(self, syscall=None, callback=None, entry=True, exit=False):
+        """
+        Stop the execution at the entry and/or at the exit of syscall (name or number, None for all the syscalls).
+        callback(d, event) is called on every stop during cont, the execution continues unless it returns a true
+        value. event is a SyscallEvent with the number, the arguments and, at the exit, the return value.
+        Return the SyscallCatch.
+        """
+        number = None if syscall is None else syscall_number(syscall)
+        if self._seccomp is not None and number not in self._seccomp:
+            logging.warning("%s is not in the seccomp filter, it will never stop the process", syscall)
+        c = SyscallCatch(number, callback, entry, exit)
+        self.syscall_catches[number] = c
+        return c
+
+    def del_catch(self, syscall):
+        """
+        Remove a syscall catchpoint. syscall can be the SyscallCatch, the name or the number.
+        """
+        if isinstance(syscall, SyscallCatch):
+            number = syscall.number
+        else:
+            number = None if syscall is None else syscall_number(syscall)
+        if self.syscall_catches.pop(number, None) is None:
+            logging.error("Failed to find a syscall catchpoint for %s.", syscall)
+
+    def syscall_trace(self, syscalls=None, callback=None):
+        """
+        Continue recording every completed syscall (only the ones in syscalls if given) until the process exits or
+        callback(d, event) returns a true value. Other catchpoints are suspended meanwhile.
+        Breakpoints still stop the execution. Return the list of SyscallEvent.
+        """
+        with self._recording_syscalls(syscalls, callback) as recorded:
+            self.cont()
+        return recorded
+
+    @contextlib.contextmanager
+    def _recording_syscalls(self, syscalls, callback):
+        recorded = []
+        def record(d, event):
+            recorded.append(event)
+            return callback is not None and callback(d, event)
+        saved = self.syscall_catches
+        self.syscall_catches = {}
+        try:
+            for s in (syscalls if syscalls is not None else [None]):
+                self.catch_syscall(s, record, entry=False, exit=True)
+            yield recorded
+        except DebugFail as e:
+            logging.info("syscall trace stopped: %s", e)
+        finally:
+            self.syscall_catches = saved
+
+    def _step_over_breakpoint(self, t):
+        # Only the breakpoint the thread is stopped on is removed, the thread steps over it and it is put back.
+        rip = t.rip
+        b = self.breakpoints.get(rip)
+        if b is None or not b.enabled:
+            return
+        self._settle(t)
+        if rip in self._shadow:
+            self._write_mem_raw(rip, bytes([self._shadow[rip]]))
+            t.step()
+            self._wait_thread(t.tid)
+            self._write_mem_raw(rip, b"\xcc")
+        else:
+            t.step()
+            self._wait_thread(t.tid)
+
+    def _step_over_breakpoints(self):
+        # The current thread and the threads reported on a breakpoint. A thread interrupted right before an int3
+        # still has to hit it
+        for t in list(self.threads.values()):
+            if t.tid == self.cur_tid or t.on_breakpoint:
+                self._step_over_breakpoint(t)
 
     def step(self):
         """
         Execute the next instruction (Step Into)
         """
         self._enforce_stop()
-        for tid, t in self.threads.items():
-            t.step()
-        self._wait_process()
+        # after a syscall entry, a step does not stop at the syscall exit
+        self._in_syscall.clear()
+        # Only the current thread moves, the other ones stay stopped
+        t = self.threads[self.cur_tid]
+        self._settle(t)
+        rip = t.rip
+        if rip in self._shadow:
+            # The current thread is on a breakpoint. Step over it
+            self._write_mem_raw(rip, bytes([self._shadow[rip]]))
+        t.step()
+        self._wait_thread(t.tid)
+        if rip in self._shadow:
+            self._write_mem_raw(rip, b"\xcc")
+
+    def _block_end(self, rip):
+        # last instruction of the basic block starting at rip, None if it can not be decoded
+        for _ in range(MAX_BLOCK_INSNS):
+            insn = self._insns.get(rip)
+            if insn is None or ends_block(insn.mnemonic):
+                return insn
+            rip += insn.size
+        return None
+
+    def _run_thread(self, t, resume):
+        # Resume only t with resume and wait for its stop, the int3 under rip is lifted meanwhile: the thread goes
+        # straight to a branch, it can not come back to it. Return True for a plain SIGTRAP
+        rip = t.rip
+        lifted = rip in self._shadow
+        if lifted:
+            self._write_mem_raw(rip, bytes([self._shadow[rip]]))
+        resume()
+        status = self._wait_thread(t.tid)
+        if lifted and rip in self._shadow:
+            self._write_mem_raw(rip, b"\xcc")
+        if not WIFSTOPPED(status):
+            raise DebugFail("The thread %d terminated while stepping" % t.tid)
+        return status >> 16 == 0 and WSTOPSIG(status) == signal.SIGTRAP
+
+    def _step_block(self, t):
+        # Move t to the first instruction of the next block. Breakpoints in the block are stepped over.
+        # Return False if the thread stopped for something else (signals, events)
+        while True:
+            start = t.rip
+            # a coverage int3 is not stepped over like a breakpoint: its block runs now
+            self._take_oneshot(start)
+            if self._singleblock is False:
+                # Run up to the last instruction of the block with a temporary int3 and step it
+                end = self._block_end(start)
+                if end is None:
+                    return self._run_thread(t, t.step)
+                if end.address != start:
+                    temporary = end.address not in self._shadow
+                    if temporary:
+                        self._insert_int3(end.address)
+                    try:
+                        plain = self._run_thread(t, t.cont)
+                        hit = t.rip - 1
+                        if not plain or hit not in self._shadow or not t.int3_trap():
+                            return False
+                    finally:
+                        if temporary and end.address in self._shadow:
+                            self._remove_int3(end.address)
+                    t.rip = hit
+                    if hit != end.address or hit in self._oneshot:
+                        # a breakpoint or a coverage int3 in the block
+                        continue
+                return self._run_thread(t, t.step)
+            first = self._insns.get(start)
+            if not self._run_thread(t, t.step_block):
+                return False
+            if t.rip - 1 in self._shadow and t.rip - 1 != start and t.int3_trap():
+                # a breakpoint or a coverage int3 in the block
+                t.rip -= 1
+                continue
+            if self._singleblock is None and first is not None and not ends_block(first.mnemonic):
+                # Only a branch can stop a real block step right after the first instruction
+                self._singleblock = t.rip != start + first.size
+                if not self._singleblock:
+                    logging.info("PTRACE_SINGLEBLOCK single steps here, block steps are done with breakpoints")
+                    continue
+            return True
 
-    def next(self):
+    def step_block(self):
+        """
+        Execute until the first instruction of the next basic block (Step Block). Return its address.
+        PTRACE_SINGLEBLOCK stops only after taken branches. Where the CPU does not support it (e.g. virtual machines)
+        the block is disassembled and the thread runs to its last branch with a temporary breakpoint: there, not
+        taken conditional jumps end a block too. Only the current thread moves, breakpoints are stepped over.
+        """
         self._enforce_stop()
-        if not self._is_next_instr_call():
-            return self.step()
+        # after a syscall entry, a step does not stop at the syscall exit
+        self._in_syscall.clear()
+        t = self.threads[self.cur_tid]
+        self._settle(t)
+        try:
+            self._step_block(t)
+        finally:
+            self._stops += 1
+        return t.rip
+
+    def _step_into_call(self):
+        # Step and return the return address if the instruction was a call, None otherwise
+        self._enforce_stop()
+        call = self._is_next_instr_call()
         self.step()
+        if not call:
+            return None
         #if 32 bits this do not works
         saved_rip = u64(self.mem[self.rsp:self.rsp+self.reg_size])
         logging.debug("next on a call instruction, executing until %#x", saved_rip)
-        #should we have a separate set of breakpoints?
-        bp = self.breakpoint(saved_rip)
-        self.cont()
-        #this will couse the remove of an old break point placed in that part
-        self.del_bp(bp)
-        # input("next real done")
+        return saved_rip
+
+    @contextlib.contextmanager
+    def _temporary_bp(self, addr):
+        # a breakpoint already there is kept
+        temporary = addr not in self.breakpoints
+        bp = self.bp(addr)
+        try:
+            yield bp
+        finally:
+            # cont may have raised or been cancelled: an int3 nobody owns would stop the process later
+            if temporary and addr in self.breakpoints and len(self.threads) > 0:
+                running = self.running
+                self.del_bp(addr)
+                if running:
+                    # cancelled while the process runs, it goes on running
+                    self._cont_resume()
 
-    def step_until(self, rip):
+    def next(self):
+        ret = self._step_into_call()
+        if ret is not None:
+            with self._temporary_bp(ret):
+                self.cont()
+
+    def _step_loop(self, stop, max_steps=None, timeout=None):
+        # Tight single step engine for the current thread. Every step is one SINGLESTEP, one waitpid and
+        # one GETREGS into the register file of the thread. Maps, threads and breakpoints are not touched between steps.
+        self._enforce_stop()
+        self._in_syscall.clear()
+        t = self.threads[self.cur_tid]
+        self._settle(t)
+        t._flush_regs()
+        tid = t.tid
+        regs = t.regs
+        ptrace = self.ptrace
+        status = self._status
+        deadline = None if timeout is None else time.monotonic() + timeout
+        steps = 0
+        start = time.monotonic()
+        shadow = self._shadow
+        t.running = False
+        t.get_regs()
+        try:
+            while max_steps is None or steps < max_steps:
+                if regs.rip in shadow:
+                    # step over the breakpoint, the int3 goes back as soon as the instruction is executed
+                    rip = regs.rip
+                    self._write_mem_raw(rip, bytes([shadow[rip]]))
+                    ptrace.singlestep(tid)
+                    ptrace.waitpid(tid, byref(status), WALL)
+                    if WIFSTOPPED(status.value):
+                        self._write_mem_raw(rip, b"\xcc")
+                else:
+                    ptrace.singlestep(tid)
+                    ptrace.waitpid(tid, byref(status), WALL)
+                steps += 1
+                if not WIFSTOPPED(status.value):
+                    logging.info("Thread %d is dead", tid)
+                    self._remove_thread(tid)
+                    raise DebugFail("The process terminated while stepping")
+                if status.value >> 16 != 0 or WSTOPSIG(status.value) != signal.SIGTRAP:
+                    # new threads, exec, signals
+                    self._handle_event(tid, status.value)
+                if ptrace.getregs(tid, regs) is None:
+                    raise PtraceFail("GetRegs Failed while stepping")
+                t.regs_valid = True
+                if WSTOPSIG(status.value) != signal.SIGTRAP:
+                    logging.info("Stepping interrupted by signal %d", WSTOPSIG(status.value))
+                    break
+                if stop():
+                    break
+                # the stop condition may have changed some registers
+                if t.regs_dirty:
+                    t.set_regs()
+                if deadline is not None and time.monotonic() > deadline:
+                    logging.info("Stepping timeout after %d steps", steps)
+                    break
+        finally:
+            self._stops += 1
+            self.running = False
+        elapsed = time.monotonic() - start
+        logging.debug("%d steps in %fs (%d steps/s)", steps, elapsed, steps / elapsed if elapsed > 0 else 0)
+        return steps
+
+    def _native_step_loop(self, max_steps=None, until=None, timeout=None, rips=None):
+        # Same as _step_loop for the stop conditions that do not need Python: the whole loop runs in
+        # Ptrace.step_loop, natively with the accelerated backend. It returns here only to step over breakpoints.
+        self._enforce_stop()
+        self._in_syscall.clear()
+        t = self.threads[self.cur_tid]
+        self._settle(t)
+        t._flush_regs()
+        t.get_regs()
+        tid = t.tid
+        regs = t.regs
+        ptrace = self.ptrace
+        status = self._status
+        max_steps = -1 if max_steps is None else max_steps
+        deadline = None if timeout is None else time.monotonic() + timeout
+        rips = None if rips is None else memoryview(rips).cast('B').cast('Q')
+        steps = 0
+        reason = STEP_COUNT
+        t.running = False
+        try:
+            while max_steps < 0 or steps < max_steps:
+                remaining = -1 if max_steps < 0 else max_steps - steps
+                left = -1 if deadline is None else max(deadline - time.monotonic(), 0)
+                view = None if rips is None else rips[steps:]
+                n, reason = ptrace.step_loop(tid, remaining, until, self._shadow_addrs, regs, status, view, left)
+                steps += n
+                if reason == STEP_BREAKPOINT:
+                    # step over the breakpoint, the int3 goes back as soon as the instruction is executed
+                    rip = regs.rip
+                    self._write_mem_raw(rip, bytes([self._shadow[rip]]))
+                    try:
+                        n, reason = ptrace.step_loop(tid, 1, until, (), regs, status, view, -1)
+                    finally:
+                        if reason != STEP_EXITED:
+                            self._write_mem_raw(rip, b"\xcc")
+                    steps += n
+                    if reason == STEP_COUNT:
+                        continue
+                break
+        finally:
+            self._stops += 1
+            self.running = False
+            t.regs_valid = reason != STEP_EXITED
+        if reason == STEP_EXITED:
+            logging.info("Thread %d is dead", tid)
+            self._remove_thread(tid)
+            raise DebugFail("The process terminated while stepping")
+        if reason == STEP_STOPPED:
+            # new threads, exec, signals. The registers were read by the loop for this stop
+            self._handle_event(tid, status.value)
+            t.regs_valid = True
+            if status.value >> 16 == 0:
+                logging.info("Stepping interrupted by signal %d", WSTOPSIG(status.value))
+        elif reason == STEP_TIMEOUT:
+            logging.info("Stepping timeout after %d steps", steps)
+        return steps
+
+    def step_n(self, n, rips=None):
         """
-        Execute using single step until the value of rip is equal to the argument
+        Execute n instructions using single step. Return the number of steps executed.
+        rips, if given, is a writable buffer of uint64 (e.g. array('Q', bytes(8*n))) that receives rip after every step.
         """
+        return self._native_step_loop(max_steps=n, rips=rips)
 
-        #Maybe punt a max stept or a timeout
-        while True:
-            self.step()
-            if self.rip == rip:
-                break
+    def step_until(self, rip, max_steps=None, timeout=None):
+        """
+        Execute using single step until the value of rip is equal to the argument.
+        Stop after max_steps steps or timeout seconds if given. Return the number of steps executed.
+        Only the current thread is stepped.
+        """
+        return self._native_step_loop(max_steps, rip, timeout)
 
-    def cont(self, blocking=True):
+    def run_until(self, predicate, max_steps=None, timeout=None):
         """
-        Continue the execution until the next breakpoint is hitted or the program is stopped
+        Execute using single step until predicate(debugger) is true.
+        Registers read by the predicate come from the GETREGS done for the step. Return the number of steps executed.
         """
+        return self._step_loop(lambda: predicate(self), max_steps, timeout)
 
-        #I need to execute at least another instruction otherwise I get always in the same bp
-        self.step()
-        self._set_breakpoints()
-        self.running = True
-        # Probably should implement a timeout
-        for tid, t in self.threads.items():
-            t.cont()
-        if blocking:
-            self._wait_process()
-            self._retore_breakpoints()
-            logging.debug("Continue Stopped")
+    def trace(self, path, registers=(), mem_access=False, until=None, max_steps=None, timeout=None, compression=None):
+        """
+        Single step the current thread recording every stop into the trace file path, starting from the current one.
+        Each record contains rip, the registers listed in registers and, with mem_access, the address and size of
+        the memory operand of the instruction (0 if there is none).
+        Stop when rip is equal to until, after max_steps steps or timeout seconds. compression can be None, "zlib" or "zstd".
+        Use libdebug.trace.TraceReader to read the file. Return the number of steps executed.
+        """
+        self._enforce_stop()
+        regs = self.threads[self.cur_tid].get_regs()
+        decoder = MemAccessDecoder(self._read_mem) if mem_access else None
+        fields = ["rip"] + list(registers) + (["mem_addr", "mem_size"] if mem_access else [])
+        record = record_getter(registers, decoder)
+        with TraceWriter(path, fields, compression) as w:
+            append = w.append
+            append(record(regs))
+            def stop():
+                append(record(regs))
+                return regs.rip == until
+            return self._step_loop(stop, max_steps, timeout)
+
+    def block_trace(self, until=None, max_blocks=None, timeout=None, coverage=None):
+        """
+        Execute the current thread with step_block and return the list of the addresses of the blocks entered.
+        Stop when a block starts at until, after max_blocks blocks, timeout seconds or when the thread stops for
+        anything else (signals, events). coverage, a libdebug.coverage.CoverageMap, records every block.
+        """
+        self._enforce_stop()
+        self._in_syscall.clear()
+        t = self.threads[self.cur_tid]
+        self._settle(t)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        blocks = []
+        try:
+            while max_blocks is None or len(blocks) < max_blocks:
+                if not self._step_block(t):
+                    logging.info("Block trace interrupted after %d blocks", len(blocks))
+                    break
+                rip = t.rip
+                blocks.append(rip)
+                if coverage is not None:
+                    coverage.add(rip)
+                if rip == until:
+                    break
+                if deadline is not None and time.monotonic() > deadline:
+                    logging.info("Block trace timeout after %d blocks", len(blocks))
+                    break
+        finally:
+            self._stops += 1
+        return blocks
 
-    def finish(self, blocking=True):
+    def cont(self, blocking=True):
         """
-        Execute until the end of the current function.
-        This works only if the program use the rbp register as base address.
+        Continue the execution until the next breakpoint is hitted or the program is stopped.
+        Breakpoints with a callback are handled here: the execution goes on until a callback returns a true value,
+        a breakpoint without callback is hit or the process stops for something else.
+        Non blocking continue runs the callback of the breakpoint found when the process is stopped, but it does not
+        continue again.
         """
-        # This works only if the binary use the baseptr for the frames
-        if not self._check_mem_address(self.rbp):
-            logging.error("rbp %#x is not a valid frame. Impossible to execute finish", self.rbp)
+        self._enforce_stop()
+        while True:
+            # A stop found while stopping the threads for the previous one is reported without resuming anything
+            tid = self._pending_tid()
+            if tid is not None:
+                status = self.threads[tid].pending
+            else:
+                # Probably should implement a timeout
+                self._cont_resume()
+                if not blocking:
+                    return
+                tid, status = self._wait_event()
+                self._stop_all()
+            if self._report(tid, status):
+                break
+        logging.debug("Continue Stopped")
+
+    def _cont_resume(self):
+        # Breakpoints are already in memory. Only the ones we are stopped on must be stepped over
+        self._step_over_breakpoints()
+        self._resume_all()
+
+    def _return_address(self):
+        frames = self.backtrace(2)
+        if len(frames) < 2:
+            logging.error("no caller found at %#x. Impossible to execute finish", frames[0].address)
             raise DebugFail("Finish Failed. Frame not found")
-        ret_addr = u64(self.mem[self.rbp+0x8: self.rbp+0x10])
+        ret_addr = frames[1].address
         logging.info("finish executing until Return Address found at %#x", ret_addr)
-        self.bp(ret_addr)
-        self.cont(blocking)
-        self.del_bp(ret_addr)
+        return ret_addr
+
+    def finish(self, blocking=True):
+        """
+        Execute until the end of the current function, the return address is found by backtrace.
+        """
+        ret_addr = self._return_address()
+        if not blocking:
+            self.bp(ret_addr)
+            self.cont(blocking)
+            return
+        with self._temporary_bp(ret_addr):
+            self.cont()
 
     def bp(self, addr):
         """
-        Set a breakpoint to specific address
+        Set a breakpoint to specific address. The int3 is written immediately and stays in memory.
         """
         if addr not in self.breakpoints:
             self._check_mem_address(addr)
             logging.info("new BreakPoint at %#x", addr)
-            self.breakpoints[addr] = None
-        return addr
+            self.breakpoints[addr] = Breakpoint(addr)
+            self._insert_int3(addr)
+        return self.breakpoints[addr]
 
     def _resolve_relative_address(self, addr, name):
+        if isinstance(addr, str):
+            return self._resolve_symbol(addr, name)
         if name is None and self._check_mem_address(addr, warn=False):
             return addr
         # BP not found as valid address.
         if name is None:
             name = "main"
         #Look for the lib that start with that name
+        if name not in self.bases and len(self.map.library(name)) == 0 and self._maps_stop != self._stops:
+            # It may have been loaded after the last parse of the maps
+            self._retrieve_maps()
         if name not in self.bases:
-            for x in self.bases:
-                if x.startwith(name):
-                    name = x
-                    break
+            segments = self.map.library(name)
+            if len(segments) > 0:
+                name = segments[0]['file']
         # did not find any valid region. Try standard bp
         if name not in self.bases:
             return addr
@@ -760,6 +1761,44 @@ class Debugger:
         logging.info("relative address, region: %s, start:%#x", name, self.bases[name])
         return self.bases[name] + addr
 
+    def _hw_used(self):
+        for b in self.hw_breakpoints.values():
+            if b is not None:
+                return True
+        return False
+
+    def _install_hw(self, t):
+        # Give the thread the debug registers of the process
+        for r, b in self.hw_breakpoints.items():
+            if b is not None:
+                t.set_hw_bp(r, b.address, b.cond, b.length)
+
+    def _set_hw(self, b):
+        # Put b in a free debug register of every thread. Return False if they are all used
+        for r in self.hw_breakpoints:
+            if self.hw_breakpoints[r] is None:
+                break
+        else:
+            logging.error("Failed to set hw_bp %#lx. All hw register are used!", b.address)
+            return False
+        self._enforce_stop()
+        for t in self.threads.values():
+            t.set_hw_bp(r, b.address, b.cond, b.length)
+        self.hw_breakpoints[r] = b
+        return True
+
+    def _del_hw(self, b):
+        for r in self.hw_breakpoints:
+            if self.hw_breakpoints[r] is b:
+                break
+        else:
+            logging.error("Failed to find a hw_bp for %#lx.", b.address)
+            return
+        self._enforce_stop()
+        for t in self.threads.values():
+            t.clear_hw_bp(r)
+        self.hw_breakpoints[r] = None
+
     def watch(self, addr, cond='W', length=8, name=None):
         #normalize the condition
         if "W" in cond or "w" in cond:
@@ -768,57 +1807,322 @@ class Debugger:
             cond = "RW"
 
         real_address = self._resolve_relative_address(addr, name)
+        if real_address in self.breakpoints:
+            # breakpoints are keyed by address, the one there would be lost
+            raise DebugFail("A breakpoint is already set at %#x" % real_address)
         logging.info("Watchpoint: %#lx, cond %s", real_address, cond)
-        if len(self.threads) > 1:
-            logging.warning("There are more threads. I am setting the BP only for the main thread.")
-        t = self.threads[self.pid]
-        if t.hw_bp(real_address, cond=cond, length=length):
-            return real_address
+        b = Breakpoint(real_address, hw=True, cond=cond, length=length)
+        if self._set_hw(b):
+            self.breakpoints[real_address] = b
+            return b
         logging.info("Failed to set hw breakpoint. Watchpoint was not setup")
 
     def del_watch(self, addr):
         self.del_bp(addr)
 
-    def breakpoint(self, addr, name=None, hw=False):
+    def breakpoint(self, addr, name=None, hw=False, callback=None, condition=None):
+        """
+        Set a breakpoint. addr is relative to the library matching name if it is not a valid address.
+        addr can be a symbol name, looked for in the library matching name or, without name, in every mapped file.
+        callback(d, bp) is called on every hit during cont, the execution continues unless it returns a true value.
+        condition is an expression on the registers or a callable(d, bp), hits are ignored when it is false.
+        Return the Breakpoint.
+        """
         real_address = self._resolve_relative_address(addr, name)
         logging.info("Breakpoint: %#lx", real_address)
-        if hw:
-            if len(self.threads) > 1:
-                logging.warning("There are more threads. I am setting the BP only for the main thread.")
-            t = self.threads[self.pid]
-            if t.hw_bp(real_address, cond='X'):
-                return real_address
-            logging.info("Failed to set hw breakpoint. Fall back to memory bp.")
-        return self.bp(real_address)
+        b = self.breakpoints.get(real_address)
+        if b is None and hw:
+            b = Breakpoint(real_address, hw=True)
+            if self._set_hw(b):
+                self.breakpoints[real_address] = b
+            else:
+                b = None
+                logging.info("Failed to set hw breakpoint. Fall back to memory bp.")
+        if b is None:
+            b = self.bp(real_address)
+        if callback is not None:
+            b.callback = callback
+        if condition is not None:
+            b.condition = condition
+        return b
 
     def del_bp(self, addr):
         """
-        Remove the breakpoint
+        Remove the breakpoint. addr can be the Breakpoint or its address
+        """
+        if isinstance(addr, Breakpoint):
+            addr = addr.address
+        b = self.breakpoints.pop(addr, None)
+        if b is None:
+            logging.error("Failed to find a breakpoint for %#lx.", addr)
+            return
+        logging.info("delete BreakPoint at %#x", addr)
+        if b.hw:
+            if b.enabled:
+                self._del_hw(b)
+        elif addr in self._shadow:
+            self._remove_int3(addr)
+
+    def disable_bp(self, addr):
+        """
+        Disable the breakpoint without deleting it. addr can be the Breakpoint or its address
+        """
+        if isinstance(addr, Breakpoint):
+            addr = addr.address
+        b = self.breakpoints[addr]
+        if not b.enabled:
+            return
+        b.enabled = False
+        if b.hw:
+            self._del_hw(b)
+        elif addr in self._shadow:
+            self._remove_int3(addr)
+
+    def enable_bp(self, addr):
+        """
+        Enable a breakpoint disabled with disable_bp. addr can be the Breakpoint or its address
+        """
+        if isinstance(addr, Breakpoint):
+            addr = addr.address
+        b = self.breakpoints[addr]
+        if b.enabled:
+            return
+        b.enabled = True
+        if b.hw:
+            # the debug register may be taken meanwhile
+            b.enabled = self._set_hw(b)
+        else:
+            self._insert_int3(addr)
+
+    def _module(self, name):
+        # (path on disk, base address) of the mapped file name, "main" is the binary
+        if name not in self.bases and len(self.map.library(name)) == 0 and self._maps_stop != self._stops:
+            self._retrieve_maps()
+        if name == "main" and "main" in self.bases:
+            s = self.map.find(self.bases["main"])
+        else:
+            segments = self.map.library(name)
+            s = self.map.find(self.bases.get(segments[0]['file'], segments[0]['start'])) if len(segments) > 0 else None
+        if s is None or s['pathname'] is None:
+            raise DebugFail("Module %s not found in the memory maps" % name)
+        return s['pathname'], s['start']
+
+    def _resolve_symbol(self, symbol, name):
+        # Look for symbol in the library matching name, or in the binary and then in every mapped file
+        if name is not None:
+            modules = [name]
+        else:
+            if self._maps_stale:
+                self._retrieve_maps()
+            modules = ["main"] + [f for f in self.bases if f != "main"]
+        for m in modules:
+            try:
+                path, base = self._module(m)
+            except DebugFail:
+                continue
+            if not os.path.isfile(path):
+                continue
+            table = symbols_of(path)
+            vaddr = table.address(symbol)
+            if vaddr is not None:
+                logging.info("symbol %s found in %s", symbol, path)
+                return base - table.load_base + vaddr
+        raise DebugFail("Symbol %s not found" % symbol)
+
+    def symbols(self, module="main"):
+        """
+        Return the SymbolTable of module ("main" or the name of a library). Its addresses are the ones of the ELF file.
+        """
+        return symbols_of(self._module(module)[0])
+
+    def _find_map(self, addr):
+        # the mapping of addr, the maps are read again if they may have changed since the last read
+        s = self.map.find(addr)
+        if s is None and self._maps_stop != self._stops:
+            self._retrieve_maps()
+            s = self._map.find(addr)
+        return s
+
+    def symbol(self, addr):
+        """
+        Return the Location (module, symbol name and offset) of the address addr, None if it is not in a mapped file.
+        The name is None if no symbol contains the address.
+        """
+        s = self._find_map(addr)
+        if s is None or s['pathname'] is None or not os.path.isfile(s['pathname']):
+            return None
+        base = self.bases.get(s['file'], s['start'] - s['offset'])
+        table = symbols_of(s['pathname'])
+        vaddr = addr - base + table.load_base
+        found = table.lookup(vaddr)
+        if found is None:
+            return Location(addr, s['file'], None, addr - base)
+        return Location(addr, s['file'], found[0], found[1])
+
+    def _cfi_row(self, pc):
+        # CFI row of the process address pc, None if no FDE of its file covers it
+        s = self._find_map(pc)
+        if s is None or s['pathname'] is None:
+            return None
+        path = s['pathname']
+        if path not in self._cfi_tables:
+            self._cfi_tables[path] = unwind.cfi_of(path) if os.path.isfile(path) else None
+        table = self._cfi_tables[path]
+        if table is None:
+            return None
+        base = self.bases.get(s['file'], s['start'] - s['offset'])
+        return table.row(pc - base + table.load_base)
+
+    def _executable(self, addr):
+        s = self._find_map(addr)
+        return s is not None and s['perms'] & 1 != 0
+
+    def backtrace(self, max_frames=64):
+        """
+        Return the Frames (index, address, sp, location) of the current thread, innermost first.
+        A frame is unwound with the .eh_frame CFI of its file, tables are parsed once per file. Where there is no CFI
+        (JIT code, files without .eh_frame) the frame pointer chain is followed.
+        The stack is read once, from rsp up to STACK_WINDOW bytes, locations are looked up only when accessed.
+        """
+        self._enforce_stop()
+        r = self.threads[self.cur_tid].get_regs()
+        regs = [getattr(r, name) for name in unwind.DWARF_REGS]
+        sp = regs[unwind.RSP]
+        s = self._find_map(sp)
+        stack = unwind.StackReader(self._read_mem, sp, min(s['stop'], sp + STACK_WINDOW) if s is not None else sp,
+                                   lambda addr: self._find_map(addr) is not None)
+        frames = []
+        while len(frames) < max_frames:
+            pc = regs[unwind.RIP]
+            frames.append(unwind.Frame(len(frames), pc, regs[unwind.RSP], self.symbol))
+            # a return address follows the call, the call is what the caller is executing
+            row = self._cfi_row(pc if len(frames) == 1 else pc - 1)
+            caller = unwind.step(row, regs, stack.read) if row is not None else None
+            if caller is None:
+                caller = unwind.fp_step(regs, stack.read)
+            if caller is None or not caller[unwind.RIP] or caller[unwind.RSP] is None:
+                break
+            if caller[unwind.RSP] <= regs[unwind.RSP] or not self._executable(caller[unwind.RIP]):
+                break
+            regs = caller
+        return frames
+
+    def coverage(self, module="main"):
+        """
+        Collect the coverage of the basic blocks of module ("main" or the name of a library, as for breakpoint).
+        A one-shot int3 is put on every block found in the ELF file of the module, written with one write per page.
+        The first execution of a block records it in the returned BlockCoverage and removes its int3 for good: cont
+        goes on without stopping and without stepping over it. Blocks with a breakpoint already are not collected.
+        stop_coverage removes the int3 left.
+        """
+        self._enforce_stop()
+        path, base = self._module(module)
+        f = elf.load(path)
+        bias = base - f.load_base
+        blocks = f.block_starts()
+        cov = BlockCoverage(module, blocks, bias)
+        addrs = [a + bias for a in blocks if a + bias not in self._shadow]
+        self._insert_int3_bulk(addrs)
+        for a in addrs:
+            self._oneshot[a] = cov
+        self._coverages.append(cov)
+        logging.info("coverage of %s: %d blocks", path, len(addrs))
+        return cov
+
+    def stop_coverage(self, cov):
+        """
+        Remove the int3 of the blocks of cov not executed yet. cov keeps what it collected.
         """
-        if addr in self.breakpoints:
-            logging.info("delete BreakPoint at %#x", addr)
-            del self.breakpoints[addr]
-        t = self.threads[self.pid]
-        t.del_hw_bp(addr)
+        self._enforce_stop()
+        addrs = sorted(a for a, c in self._oneshot.items() if c is cov)
+        for a in addrs:
+            del self._oneshot[a]
+        self._remove_int3_bulk(addrs)
+        self._coverages.remove(cov)
 
 
+    ## Snapshot
+    def snapshot(self, incremental=False):
+        """
+        Save the registers of all the threads and the content of the writable memory of the stopped process.
+        Return a Snapshot to pass to restore.
+        With incremental the soft-dirty bits of the process are cleared, restore will write back only the pages
+        written after the snapshot. Only the last incremental snapshot is restored incrementally.
+        """
+        self._enforce_stop()
+        snap = Snapshot(self.pid)
+        for tid, t in self.threads.items():
+            t._flush_regs()
+            snap.threads[tid] = (bytes(t.get_regs()), bytes(t.get_fpregs()))
+        # The layout may have changed since the last stop without an event telling us
+        memory_map = self.refresh_maps()
+        snap.layout = layout_of(memory_map)
+        for s in saved_mappings(memory_map):
+            snap.memory.append((s['start'], self._read_mem_raw(s['start'], s['stop'] - s['start'])))
+        if incremental and clear_soft_dirty(self.pid):
+            snap.incremental = True
+            self._soft_dirty_snap = snap
+        logging.info("%r", snap)
+        return snap
+
+    def _restore_dirty_pages(self, snap):
+        # Write back only the pages with the soft-dirty bit set
+        written = 0
+        fd = os.open("/proc/%d/pagemap" % self.pid, os.O_RDONLY)
+        try:
+            for start, data in snap.memory:
+                for run_start, run_stop in dirty_runs(fd, start, start + len(data)):
+                    self._write_mem_raw(run_start, data[run_start-start: run_stop-start])
+                    written += run_stop - run_start
+        finally:
+            os.close(fd)
+        logging.debug("restored %#x dirty bytes of %#x", written, snap.size)
+
+    def restore(self, snap):
+        """
+        Bring the process back to the state saved in snap.
+        Mappings created or removed after the snapshot are not undone, only the content of the saved ones is restored.
+        """
+        if snap.pid != self.pid:
+            raise DebugFail("The snapshot belongs to the process %d" % snap.pid)
+        self._enforce_stop()
+        for tid, (regs, fpregs) in snap.threads.items():
+            t = self.threads.get(tid)
+            if t is None:
+                logging.warning("Thread %d of the snapshot does not exist anymore", tid)
+                continue
+            memmove(addressof(t.regs), regs, sizeof(t.regs))
+            memmove(addressof(t.fpregs), fpregs, sizeof(t.fpregs))
+            t.regs_valid = t.regs_dirty = True
+            t.fpregs_valid = t.fpregs_dirty = True
+        for tid in self.threads:
+            if tid not in snap.threads:
+                logging.warning("Thread %d was created after the snapshot, it is not restored", tid)
+        self._insns.clear()
+        if snap.incremental and self._soft_dirty_snap is snap:
+            self._restore_dirty_pages(snap)
+        else:
+            for start, data in snap.memory:
+                self._write_mem_raw(start, data)
+        if snap.incremental:
+            # Our writes made the pages dirty, from now on only the pages written by the process count
+            clear_soft_dirty(self.pid)
+            self._soft_dirty_snap = snap
+        if self._maps_stale or layout_of(self.map) != snap.layout:
+            self._retrieve_maps()
+            if layout_of(self._map) != snap.layout:
+                logging.warning("The memory layout changed after the snapshot. New mappings are left as they are")
+
     ## THREADS
     # https://stackoverflow.com/questions/7290018/ptrace-and-threads
     # https://stackoverflow.com/questions/18577956/how-to-use-ptrace-to-get-a-consistent-view-of-multiple-threads
     def _get_thread_area(self, tid):
-        
+        """
+        Return the TLS descriptor (user_desc) with GDT entry tid of the current thread.
+        """
         self._enforce_stop()
-
-        self.libc.ptrace.argtypes = self.args_ptr
-
-        #clean buffer. Probably there is a better way.
-        for x in range(100):
-             self.buf[x] = b"\x00"
-
-        set_errno(0)
-        if (self.libc.ptrace(PTRACE_GET_THREAD_AREA, self.pid, tid, self.buf) == -1):
-            for x in range(100):
-                print(self.buf[x])
+        desc = user_desc()
+        if self.ptrace.get_thread_area(self.cur_tid, tid, desc) is None:
             err = get_errno()
             #We use geT_regs as test for the process if it is running we may stoppit before executing something
             # ether the process is dead or is running
@@ -828,7 +2132,6 @@ class Debugger:
             elif err == errno.ESRCH and not self.running:
                 logging.critical("The proccess is dead!")
             else:
-                logging.debug("getregs error: %d", err)
+                logging.debug("get_thread_area error: %d", err)
                 raise DebugFail("GetThreadArea Failed. is tid correct?")
-        print(self.buf)
-        return self.buf
+        return desc
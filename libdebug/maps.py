@@ -0,0 +1,115 @@
+import bisect
+import collections
+import logging
+import os
+
+logging = logging.getLogger("libdebug")
+
+# map file example
+# 560df069c000-560df069d000 r--p 00000000 fe:01 4859834                    /usr/bin/python3.10
+# 55c1b7eaf000-55c1b7eb0000 r--p 00000000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test
+# 7f7fd6d47000-7f7fd6d56000 rw-p 00000000 00:00 0
+# 7ffcc2eef000-7ffcc2f10000 rw-p 00000000 00:00 0                          [stack]
+# ffffffffff600000-ffffffffff601000 --xp 00000000 00:00 0                  [vsyscall]
+
+
+class MemoryMap(collections.abc.Mapping):
+    """
+    Sorted index of the segments of /proc/pid/maps.
+    It behaves as the dict {start: segment} it replaces, and adds address and range lookups in O(log n).
+    """
+
+    def __init__(self, segments=()):
+        self._segments = sorted(segments, key=lambda s: s['start'])
+        self._starts = [s['start'] for s in self._segments]
+        self._by_start = {s['start']: s for s in self._segments}
+        self._by_file = {}
+        for s in self._segments:
+            if s['file'] is not None:
+                self._by_file.setdefault(s['file'], []).append(s)
+        # Accesses are very local. Most lookups hit the same segment as the previous one
+        self._last = None
+
+    @classmethod
+    def parse(cls, lines):
+        # The format is fixed, split is much faster than a regex.
+        # The pathname is the only field that can contain spaces, so it takes whatever is left
+        segments = []
+        for l in lines:
+            fields = l.split(None, 5)
+            if len(fields) < 5:
+                logging.warning("Failed loading map table: %s", l)
+                continue
+            addrs, perms, offset = fields[0], fields[1], fields[2]
+            start, _, stop = addrs.partition("-")
+            pathname = fields[5].rstrip("\n") if len(fields) == 6 else None
+            perm = (4 if perms[0] == 'r' else 0) \
+                 | (2 if perms[1] == 'w' else 0) \
+                 | (1 if perms[2] == 'x' else 0)
+            segments.append({"start": int(start, 16),
+                             "stop": int(stop, 16),
+                             "perms": perm,
+                             "offset": int(offset, 16),
+                             "pathname": pathname,
+                             "file": os.path.basename(pathname) if pathname is not None else None})
+        return cls(segments)
+
+    def __getitem__(self, start):
+        return self._by_start[start]
+
+    def __iter__(self):
+        return iter(self._starts)
+
+    def __len__(self):
+        return len(self._starts)
+
+    def find(self, addr):
+        """
+        Return the segment containing addr, None if the address is not mapped
+        """
+        last = self._last
+        if last is not None and last['start'] <= addr < last['stop']:
+            return last
+        i = bisect.bisect_right(self._starts, addr) - 1
+        if i >= 0 and addr < self._segments[i]['stop']:
+            self._last = self._segments[i]
+            return self._last
+        return None
+
+    def range(self, start, stop):
+        """
+        Return the segments overlapping [start, stop)
+        """
+        i = max(bisect.bisect_right(self._starts, start) - 1, 0)
+        segments = []
+        for s in self._segments[i:]:
+            if s['start'] >= stop:
+                break
+            if s['stop'] > start:
+                segments.append(s)
+        return segments
+
+    def library(self, name):
+        """
+        Return the segments of the file called name. If there is not such a file, the first one starting with name is used.
+        """
+        if name in self._by_file:
+            return self._by_file[name]
+        for f in self._by_file:
+            if f.startswith(name):
+                return self._by_file[f]
+        return []
+
+    def bases(self):
+        """
+        Guess the load address of each mapped file. The lowest one is the main binary.
+        """
+        bases = {}
+        if len(self._by_file) == 0:
+            return bases
+        bases["main"] = min(s[0]['start'] for s in self._by_file.values())
+        for f, segments in self._by_file.items():
+            for s in segments:
+                if s['offset'] == 0:
+                    bases[f] = s['start']
+        return bases
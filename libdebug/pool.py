@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+from .aio import AsyncDebugger
+from .libdebug import DebugFail
+from .ptrace import PtraceFail, WIFEXITED, WIFSIGNALED, WIFSTOPPED, WEXITSTATUS, WTERMSIG, WSTOPSIG
+
+logging = logging.getLogger("libdebug")
+
+# A stop of a job: a breakpoint hit or a signal (address and tid are the ones of the thread that stopped)
+Hit = collections.namedtuple("Hit", "address tid signal registers memory")
+
+
+class Job():
+    """
+    A binary to run under the debugger in a DebuggerPool.
+    breakpoints are addresses (relative to the binary if they are not valid addresses, as Debugger.breakpoint).
+    At every hit, and at every signal received by the process, the registers listed in registers are collected and
+    the memory listed in memory: (where, size) pairs where where is an address or a register name.
+    The job ends when the process exits, after max_hits hits or after timeout seconds.
+    """
+
+    def __init__(self, path, args=(), stdin=None, breakpoints=(), registers=("rip",), memory=(), max_hits=None,
+                 timeout=None, seccomp=None):
+        self.path = path
+        self.args = list(args)
+        self.stdin = stdin
+        self.breakpoints = list(breakpoints)
+        self.registers = list(registers)
+        self.memory = list(memory)
+        self.max_hits = max_hits
+        self.timeout = timeout
+        self.seccomp = seccomp
+        self.id = None
+
+
+class JobResult():
+    """
+    What a job left: hits, how the process ended (exit_code or term_signal, None if it was killed by the job)
+    and error if the job failed.
+    """
+
+    def __init__(self, job_id, worker):
+        self.job_id = job_id
+        self.worker = worker
+        self.hits = []
+        self.exit_code = None
+        self.term_signal = None
+        self.timed_out = False
+        self.error = None
+        self.elapsed = 0
+
+    def __repr__(self):
+        if self.error is not None:
+            end = "error %r" % self.error
+        elif self.exit_code is not None:
+            end = "exit %d" % self.exit_code
+        elif self.term_signal is not None:
+            end = "signal %d" % self.term_signal
+        else:
+            end = "timeout" if self.timed_out else "stopped"
+        return "<JobResult %d worker:%d hits:%d %s %.3fs>" % (self.job_id, self.worker, len(self.hits), end, self.elapsed)
+
+
+def _collect(d, job, address, sig=None):
+    regs = d.threads[d.cur_tid].get_regs()
+    memory = []
+    for where, size in job.memory:
+        addr = getattr(regs, where) if isinstance(where, str) else where
+        try:
+            memory.append(d.mem[addr:addr+size])
+        except (PtraceFail, DebugFail):
+            memory.append(None)
+    return Hit(address, d.cur_tid, sig, {r: getattr(regs, r) for r in job.registers}, memory)
+
+
+async def _session(job, result):
+    d = AsyncDebugger()
+    hits = result.hits
+    def callback(d, bp):
+        hits.append(_collect(d, job, bp.address))
+        return job.max_hits is not None and len(hits) >= job.max_hits
+    try:
+        d.run(job.path, job.args, seccomp=job.seccomp, stdin=job.stdin)
+        for addr in job.breakpoints:
+            d.breakpoint(addr, callback=callback)
+        while job.max_hits is None or len(hits) < job.max_hits:
+            await d.cont()
+            status = d._last_status
+            if WIFSTOPPED(status) and status >> 16 == 0 and WSTOPSIG(status) != signal.SIGTRAP:
+                # a signal, the next cont delivers it
+                hits.append(_collect(d, job, d.rip, WSTOPSIG(status)))
+    except DebugFail:
+        # the process is gone
+        status = d._last_status
+        if WIFEXITED(status):
+            result.exit_code = WEXITSTATUS(status)
+        elif WIFSIGNALED(status):
+            result.term_signal = WTERMSIG(status)
+    finally:
+        d.shutdown()
+
+
+async def _run_job(job, worker, results):
+    result = JobResult(job.id, worker)
+    start = time.monotonic()
+    try:
+        await asyncio.wait_for(_session(job, result), job.timeout)
+    except asyncio.TimeoutError:
+        result.timed_out = True
+    except Exception as e:
+        logging.info("job %d failed: %r", job.id, e)
+        result.error = repr(e)
+    result.elapsed = time.monotonic() - start
+    results.put(result)
+
+
+async def _serve(worker, jobs, results, sessions):
+    # Up to sessions jobs at the same time, all the tracees of the worker are driven by its event loop
+    loop = asyncio.get_running_loop()
+    running = set()
+    closing = False
+    while not closing or len(running) > 0:
+        if not closing and len(running) < sessions:
+            job = await loop.run_in_executor(None, jobs.get)
+            if job is None:
+                closing = True
+            else:
+                running.add(asyncio.ensure_future(_run_job(job, worker, results)))
+            continue
+        _, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+
+
+def _worker(worker, jobs, results, sessions):
+    asyncio.run(_serve(worker, jobs, results, sessions))
+
+
+class DebuggerPool():
+    """
+    Run Jobs in worker processes, each one debugging up to sessions targets at the same time.
+    ptrace ties a tracee to its tracer, every job is debugged from start to end by one worker.
+    """
+
+    def __init__(self, workers=None, sessions=1):
+        self.n_workers = workers if workers is not None else os.cpu_count()
+        self.jobs = multiprocessing.Queue()
+        self.results = multiprocessing.Queue()
+        self.workers = [multiprocessing.Process(target=_worker, args=(i, self.jobs, self.results, sessions), daemon=True)
+                        for i in range(self.n_workers)]
+        for w in self.workers:
+            w.start()
+        self.start = time.monotonic()
+        self.pending = 0
+        self._next_id = 0
+        # worker -> [jobs, hits, busy seconds]
+        self.stats = {i: [0, 0, 0.0] for i in range(self.n_workers)}
+
+    def submit(self, job):
+        """
+        Queue a Job. Return its id, the one of its JobResult.
+        """
+        job.id = self._next_id
+        self._next_id += 1
+        self.pending += 1
+        self.jobs.put(job)
+        return job.id
+
+    def results_iter(self):
+        """
+        Yield the JobResult of the submitted jobs as soon as they are done, in completion order.
+        """
+        while self.pending > 0:
+            try:
+                r = self.results.get(timeout=1)
+            except queue.Empty:
+                if not any(w.is_alive() for w in self.workers):
+                    raise DebugFail("All the workers of the pool are dead")
+                continue
+            self.pending -= 1
+            stats = self.stats[r.worker]
+            stats[0] += 1
+            stats[1] += len(r.hits)
+            stats[2] += r.elapsed
+            yield r
+
+    def map(self, jobs):
+        """
+        Submit jobs and yield their results in completion order.
+        """
+        for job in jobs:
+            self.submit(job)
+        return self.results_iter()
+
+    def throughput(self):
+        """
+        Return worker -> {"jobs", "hits", "busy", "jobs_per_s"} for the results received so far.
+        jobs_per_s is computed on the wall time of the pool.
+        """
+        wall = time.monotonic() - self.start
+        return {w: {"jobs": jobs, "hits": hits, "busy": busy, "jobs_per_s": jobs / wall if wall > 0 else 0}
+                for w, (jobs, hits, busy) in self.stats.items()}
+
+    def close(self):
+        """
+        Let the workers finish the queued jobs and stop them.
+        """
+        for _ in self.workers:
+            self.jobs.put(None)
+        for w in self.workers:
+            w.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,7 +1,11 @@
-from ctypes import CDLL, create_string_buffer, POINTER, c_void_p, c_int, c_long, c_char_p, get_errno, set_errno
-import struct
+from ctypes import CDLL, CFUNCTYPE, POINTER, c_void_p, c_int, c_uint, c_long, c_ulong, c_size_t, c_ssize_t, Structure, byref, get_errno
+from array import array
 import logging
 import errno
+import os
+import signal
+import struct
+import time
 
 NULL = 0
 PTRACE_TRACEME = 0
@@ -25,10 +29,13 @@ PTRACE_SETFPXREGS = 19
 PTRACE_SYSCALL = 24
 PTRACE_GET_THREAD_AREA = 25
 PTRACE_SET_THREAD_AREA = 26
+# x86: step until the next taken branch (BTF)
+PTRACE_SINGLEBLOCK = 33
 PTRACE_SETOPTIONS = 0x4200
 PTRACE_GETEVENTMSG = 0x4201
 PTRACE_GETSIGINFO = 0x4202
 PTRACE_SETSIGINFO = 0x4203
+PTRACE_SEIZE = 0x4206
 PTRACE_INTERRUPT =  0x4207
 PTRACE_O_TRACESYSGOOD        = 0x00000001
 PTRACE_O_TRACEFORK        = 0x00000002
@@ -37,15 +44,38 @@ PTRACE_O_TRACECLONE        = 0x00000008
 PTRACE_O_TRACEEXEC        = 0x00000010
 PTRACE_O_TRACEVFORKDONE = 0x00000020
 PTRACE_O_TRACEEXIT        = 0x00000040
-PTRACE_O_MASK                = 0x0000007f
+PTRACE_O_TRACESECCOMP        = 0x00000080
+PTRACE_O_MASK                = 0x000000ff
 PTRACE_EVENT_FORK        = 1
 PTRACE_EVENT_VFORK        = 2
 PTRACE_EVENT_CLONE        = 3
 PTRACE_EVENT_EXEC        = 4
-PTRACE_EVENT_VFORK_DONE = 5,
+PTRACE_EVENT_VFORK_DONE = 5
 PTRACE_EVENT_EXIT        = 6
+PTRACE_EVENT_SECCOMP        = 7
+# stop of a PTRACE_SEIZE tracee for PTRACE_INTERRUPT, a group-stop or the first stop of a new thread
+PTRACE_EVENT_STOP        = 128
 
 WNOHANG = 1
+WUNTRACED = 2
+WALL = 0x40000000
+
+# si_code of a SIGTRAP: an int3 is SI_KERNEL, a single or block step TRAP_TRACE, a debug register TRAP_HWBKPT
+SI_KERNEL = 0x80
+TRAP_BRKPT = 1
+TRAP_TRACE = 2
+TRAP_BRANCH = 3
+TRAP_HWBKPT = 4
+
+MASK64 = 0xffffffffffffffff
+
+# Why Ptrace.step_loop returned
+STEP_COUNT = 0
+STEP_UNTIL = 1
+STEP_BREAKPOINT = 2
+STEP_STOPPED = 3
+STEP_EXITED = 4
+STEP_TIMEOUT = 5
 
 
 # /* If WIFEXITED(STATUS), the low-order 8 bits of the status.  */
@@ -72,143 +102,284 @@ def WIFSIGNALED(status):
 def WIFSTOPPED(status):
     return (((status) & 0xff) == 0x7f)
 class PtraceFail(Exception):
-    pass
+    """
+    A ptrace request failed. errno is the error returned by the kernel, None when it is not known.
+    """
+    def __init__(self, msg, err=None):
+        if err is not None:
+            msg = "%s [%s: %s]" % (msg, errno.errorcode.get(err, err), os.strerror(err))
+        super().__init__(msg)
+        self.errno = err
+
+
+class iovec(Structure):
+    _fields_ = [("iov_base", c_void_p), ("iov_len", c_size_t)]
+
+
+class user_desc(Structure):
+    # struct user_desc of PTRACE_GET_THREAD_AREA, flags holds the seg_32bit ... useable bitfield
+    _fields_ = [("entry_number", c_uint), ("base_addr", c_uint), ("limit", c_uint), ("flags", c_uint)]
+
+
+SYS_ptrace = 101
+
+# syscall(SYS_ptrace, request, pid, addr, data)
+# ptrace is called through syscall() and not through the libc wrapper. The wrapper turns PEEK requests into a
+# return value that is ambiguous with the error -1, the syscall writes the word in *data and returns 0 or -1 with errno.
+# Every kind of request has its own prototype, so argtypes are never changed between calls.
+_ptrace_int = CFUNCTYPE(c_long, c_long, c_long, c_int, c_ulong, c_ulong, use_errno=True)
+_ptrace_ptr = CFUNCTYPE(c_long, c_long, c_long, c_int, c_ulong, c_void_p, use_errno=True)
+_waitpid = CFUNCTYPE(c_int, c_int, c_void_p, c_int, use_errno=True)
+_vm_rw = CFUNCTYPE(c_ssize_t, c_int, POINTER(iovec), c_ulong, POINTER(iovec), c_ulong, c_ulong, use_errno=True)
 
 
 class Ptrace():
     def __init__(self):
         self.libc = CDLL("libc.so.6", use_errno=True)
-        self.args_ptr = [c_int, c_long, c_long, c_char_p]
-        self.args_int = [c_int, c_long, c_long, c_long]
-        self.libc.ptrace.argtypes = self.args_ptr
-        self.libc.ptrace.restype = c_long
-        self.buf = create_string_buffer(1000)
-
+        self.ptrace_int = _ptrace_int(("syscall", self.libc))
+        self.ptrace_ptr = _ptrace_ptr(("syscall", self.libc))
+        self.libc_waitpid = _waitpid(("waitpid", self.libc))
+        self.process_vm_readv = _vm_rw(("process_vm_readv", self.libc))
+        self.process_vm_writev = _vm_rw(("process_vm_writev", self.libc))
+        self.local_iov = iovec()
+        self.remote_iov = iovec()
+        self.local_iov_ref = byref(self.local_iov)
+        self.remote_iov_ref = byref(self.remote_iov)
+        # siginfo_t is 128 bytes, si_code is the third int
+        self.siginfo = (c_int * 32)()
+        self.siginfo_ref = byref(self.siginfo)
+        # PEEK requests write the word here
+        self.word = c_long()
+        self.word_ref = byref(self.word)
+
+
+    def _fail(self, msg):
+        raise PtraceFail(msg, get_errno())
 
     def waitpid(self, tid, buf, options):
-        return self.libc.waitpid(tid, buf, options)
+        return self.libc_waitpid(tid, buf, options)
 
-    def setregs(self, tid, data):
-        bdata = create_string_buffer(data)
-        self.libc.ptrace.argtypes = self.args_ptr
-        if (self.libc.ptrace(PTRACE_SETREGS, tid, NULL, bdata) == -1):
-            raise PtraceFail("SetRegs Failed. Do you have permisio? Running as sudo?")
+    def setregs(self, tid, regs):
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_SETREGS, tid, NULL, byref(regs)) == -1:
+            self._fail("SetRegs Failed. Do you have permisio? Running as sudo?")
 
 
-    def getregs(self, tid):
-        buf = create_string_buffer(1000)
-        self.libc.ptrace.argtypes = self.args_ptr
-        set_errno(0)
-        if (self.libc.ptrace(PTRACE_GETREGS, tid, NULL, buf) == -1):
+    def getregs(self, tid, regs):
+        # regs is a RegisterFile filled in place
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_GETREGS, tid, NULL, byref(regs)) == -1:
             return None
-
-        return buf
+        return regs
 
 
-    def setfpregs(self, tid, data):
-        bdata = create_string_buffer(data)
-        self.libc.ptrace.argtypes = self.args_ptr
-        if (self.libc.ptrace(PTRACE_SETFPREGS, tid, NULL, bdata) == -1):
-            raise PtraceFail("SetRegs Failed. Do you have permisio? Running as sudo?")
+    def setfpregs(self, tid, fpregs):
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_SETFPREGS, tid, NULL, byref(fpregs)) == -1:
+            self._fail("SetFpRegs Failed. Do you have permisio? Running as sudo?")
 
 
-    def getfpregs(self, tid):
-        buf = create_string_buffer(1000)
-        self.libc.ptrace.argtypes = self.args_ptr
-        set_errno(0)
-        if (self.libc.ptrace(PTRACE_GETFPREGS, tid, NULL, self.buf) == -1):
+    def getfpregs(self, tid, fpregs):
+        # fpregs is a FpRegisterFile filled in place
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_GETFPREGS, tid, NULL, byref(fpregs)) == -1:
             return None
-        return buf
+        return fpregs
 
 
     def singlestep(self, tid):
-        self.libc.ptrace.argtypes = self.args_int
-        if (self.libc.ptrace(PTRACE_SINGLESTEP, tid, NULL, NULL) == -1):
-            raise PtraceFail("Step Failed. Do you have permisions? Running as sudo?")
+        if self.ptrace_int(SYS_ptrace, PTRACE_SINGLESTEP, tid, NULL, NULL) == -1:
+            self._fail("Step Failed. Do you have permisions? Running as sudo?")
 
 
-    def cont(self, tid):
-        self.libc.ptrace.argtypes = self.args_int
-        if (self.libc.ptrace(PTRACE_CONT, tid, NULL, NULL) == -1):
-            raise PtraceFail("[%d] Continue Failed. Do you have permisions? Running as sudo?" % tid)
+    def singleblock(self, tid):
+        if self.ptrace_int(SYS_ptrace, PTRACE_SINGLEBLOCK, tid, NULL, NULL) == -1:
+            self._fail("Block Step Failed. Do you have permisions? Running as sudo?")
 
 
-    def poke(self, tid, addr, value):
-        set_errno(0)
-        self.libc.ptrace.argtypes = self.args_int
-        data = self.libc.ptrace(PTRACE_POKEDATA, tid, addr, value)
+    def cont(self, tid, sig=0):
+        # sig is the signal delivered to the thread when it resumes, 0 for none
+        if self.ptrace_int(SYS_ptrace, PTRACE_CONT, tid, NULL, sig) == -1:
+            self._fail("[%d] Continue Failed. Do you have permisions? Running as sudo?" % tid)
+
 
-        # This errno is a libc artifact. The syscall return errno as return value and the value in the data parameter
-        # We may considere to do direct syscall to avoid errno of libc
-        err = get_errno()
-        if err == errno.EIO:
-            raise PtraceFail("Poke Failed. Are you accessing a valid address?")
+    def syscall(self, tid, sig=0):
+        # continue until the next syscall entry or exit
+        if self.ptrace_int(SYS_ptrace, PTRACE_SYSCALL, tid, NULL, sig) == -1:
+            self._fail("[%d] Continue to syscall Failed. Do you have permisions? Running as sudo?" % tid)
+
+
+    def poke(self, tid, addr, value):
+        if self.ptrace_int(SYS_ptrace, PTRACE_POKEDATA, tid, addr, value & MASK64) == -1:
+            self._fail("Poke Failed. Are you accessing a valid address?")
 
 
     def peek(self, tid, addr):
-        set_errno(0)
-        self.libc.ptrace.argtypes = self.args_int
-        data = self.libc.ptrace(PTRACE_PEEKDATA, tid, addr, NULL)
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_PEEKDATA, tid, addr, self.word_ref) == -1:
+            self._fail("Peek Failed. Are you accessing a valid address?")
+        return self.word.value
+
+
+    def vm_readv(self, pid, addr, buf, size):
+        # Copy up to size bytes from the tracee into the buffer at address buf with a single syscall.
+        # The kernel stops at the first unreadable page, so the return value may be a short read.
+        self.local_iov.iov_base = buf
+        self.local_iov.iov_len = size
+        self.remote_iov.iov_base = addr
+        self.remote_iov.iov_len = size
+        return self.process_vm_readv(pid, self.local_iov_ref, 1, self.remote_iov_ref, 1, 0)
 
-        # This errno is a libc artifact. The syscall return errno as return value and the value in the data parameter
-        # We may considere to do direct syscall to avoid errno of libc
-        err = get_errno()
-        if err == errno.EIO:
-            raise PtraceFail("Peek Failed. Are you accessing a valid address?")
-        return data
+
+    def vm_writev(self, pid, addr, buf, size):
+        # Same as vm_readv in the other direction. Pages that are not writable in the tracee (e.g. .text) are refused.
+        self.local_iov.iov_base = buf
+        self.local_iov.iov_len = size
+        self.remote_iov.iov_base = addr
+        self.remote_iov.iov_len = size
+        return self.process_vm_writev(pid, self.local_iov_ref, 1, self.remote_iov_ref, 1, 0)
 
 
     def setoptions(self, tid, options):
-        self.libc.ptrace.argtypes = self.args_int
-        r = self.libc.ptrace(PTRACE_SETOPTIONS, tid, NULL, options)
-        if (r == -1):
-            raise PtraceFail("Option Setup Failed. Do you have permisions? Running as sudo?")
+        if self.ptrace_int(SYS_ptrace, PTRACE_SETOPTIONS, tid, NULL, options) == -1:
+            self._fail("Option Setup Failed. Do you have permisions? Running as sudo?")
 
 
     def attach(self, tid):
-        self.libc.ptrace.argtypes = self.args_int
-        set_errno(0)
-        r = self.libc.ptrace(PTRACE_ATTACH, tid, NULL, NULL)
+        r = self.ptrace_int(SYS_ptrace, PTRACE_ATTACH, tid, NULL, NULL)
         logging.debug("attached %d", r)
-        if (r == -1):
-            err = get_errno()
-            raise PtraceFail("Attach Failed. Err:%d Do you have permisions? Running as sudo?" % err)
+        if r == -1:
+            self._fail("Attach Failed. Do you have permisions? Running as sudo?")
+
+
+    def detach(self, tid, sig=0):
+        if self.ptrace_int(SYS_ptrace, PTRACE_DETACH, tid, NULL, sig) == -1:
+            self._fail("Detach Failed. Do you have permisio? Running as sudo?")
+
+
+    def seize(self, tid, options):
+        # Attach without stopping the thread. Seized threads can be stopped with interrupt
+        if self.ptrace_int(SYS_ptrace, PTRACE_SEIZE, tid, NULL, options) == -1:
+            self._fail("Seize Failed. Do you have permisions? Running as sudo?")
+
+
+    def interrupt(self, tid):
+        # The thread reports a PTRACE_EVENT_STOP as soon as it can
+        if self.ptrace_int(SYS_ptrace, PTRACE_INTERRUPT, tid, NULL, NULL) == -1:
+            self._fail("[%d] Interrupt Failed." % tid)
+
+
+    def getsiginfo(self, tid):
+        # si_signo and si_code of the signal that stopped the thread
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_GETSIGINFO, tid, NULL, self.siginfo_ref) == -1:
+            self._fail("GetSigInfo Failed.")
+        return self.siginfo[0], self.siginfo[2]
+
 
+    def geteventmsg(self, tid):
+        # the message of the last PTRACE_EVENT stop, e.g. the tid of the new thread for PTRACE_EVENT_CLONE
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_GETEVENTMSG, tid, NULL, self.word_ref) == -1:
+            self._fail("GetEventMsg Failed.")
+        return self.word.value
 
-    def detach(self, tid):
-        self.libc.ptrace.argtypes = self.args_int
-        if (self.libc.ptrace(PTRACE_DETACH, tid, NULL, NULL) == -1):
-            raise PtraceFail("Detach Failed. Do you have permisio? Running as sudo?")
+
+    def get_thread_area(self, tid, index, desc):
+        # desc is a user_desc filled in place
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_GET_THREAD_AREA, tid, index, byref(desc)) == -1:
+            return None
+        return desc
 
 
     def traceme(self):
-        self.libc.ptrace.argtypes = self.args_int
-        r = self.libc.ptrace(PTRACE_TRACEME, NULL, NULL, NULL)
+        self.ptrace_int(SYS_ptrace, PTRACE_TRACEME, NULL, NULL, NULL)
+
+    # Hot loops. They have a native implementation in AccelPtrace
+
+    def peek_many(self, tid, addr, count):
+        # count words starting from addr
+        return struct.pack("<%dq" % count, *(self.peek(tid, addr + 8*i) for i in range(count)))
+
+
+    def wait_getregs(self, tid, options, regs):
+        # waitpid and, if the thread is stopped, GETREGS into regs. Return (tid, status, regs filled)
+        status = c_int()
+        r = self.libc_waitpid(tid, byref(status), options)
+        while r == -1 and get_errno() == errno.EINTR:
+            r = self.libc_waitpid(tid, byref(status), options)
+        if r == -1:
+            self._fail("Waitpid Failed")
+        ok = r > 0 and WIFSTOPPED(status.value) and self.getregs(r, regs) is not None
+        return r, status.value, ok
+
+
+    def step_loop(self, tid, max_steps, until, breaks, regs, status, rips, timeout):
+        # Single step tid until max_steps steps are done (-1 is unlimited), rip is until after a step,
+        # rip is one of the sorted addresses in breaks before a step, the thread stops for anything else than a
+        # SIGTRAP, the thread exits or timeout seconds (-1 is no timeout) are elapsed.
+        # regs hold the registers of the current stop and are updated at every step. status is a c_int that receives
+        # the last waitpid status. rips, if not None, receives the rip after every step. Return (steps, STEP_*)
+        deadline = None if timeout < 0 else time.monotonic() + timeout
+        breaks = set(breaks)
+        status_ref = byref(status)
+        steps = 0
+        while max_steps < 0 or steps < max_steps:
+            if breaks and regs.rip in breaks:
+                return steps, STEP_BREAKPOINT
+            self.singlestep(tid)
+            self.libc_waitpid(tid, status_ref, WALL)
+            steps += 1
+            if not WIFSTOPPED(status.value):
+                return steps, STEP_EXITED
+            if self.getregs(tid, regs) is None:
+                self._fail("GetRegs Failed while stepping")
+            if rips is not None and steps <= len(rips):
+                rips[steps-1] = regs.rip
+            if WSTOPSIG(status.value) != signal.SIGTRAP or status.value >> 16 != 0:
+                return steps, STEP_STOPPED
+            if regs.rip == until:
+                return steps, STEP_UNTIL
+            if deadline is not None and time.monotonic() > deadline:
+                return steps, STEP_TIMEOUT
+        return steps, STEP_COUNT
+
 
     #USER struct
     def poke_user(self, tid, addr, value):
-        set_errno(0)
-        self.libc.ptrace.argtypes = self.args_int
-        data = self.libc.ptrace(PTRACE_POKEUSER, tid, addr, value)
-
-        # This errno is a libc artifact. The syscall return errno as return value and the value in the data parameter
-        # We may considere to do direct syscall to avoid errno of libc
-        err = get_errno()
-        if err == errno.EIO:
-            raise PtraceFail("Poke User Failed. Are you accessing a valid address?")
+        if self.ptrace_int(SYS_ptrace, PTRACE_POKEUSER, tid, addr, value & MASK64) == -1:
+            self._fail("Poke User Failed. Are you accessing a valid address?")
 
 
     def peek_user(self, tid, addr):
-        set_errno(0)
-        self.libc.ptrace.argtypes = self.args_int
-        data = self.libc.ptrace(PTRACE_PEEKUSER, tid, addr, NULL)
+        if self.ptrace_ptr(SYS_ptrace, PTRACE_PEEKUSER, tid, addr, self.word_ref) == -1:
+            self._fail("Peek User Failed. Are you accessing a valid address?")
+        return self.word.value
+
+
+class AccelPtrace(Ptrace):
+    """
+    Ptrace with the hot loops implemented by the _ptrace_accel extension.
+    """
+    def __init__(self):
+        super().__init__()
+        self.peek_many = _ptrace_accel.peek_many
+        self.wait_getregs = _ptrace_accel.wait_getregs
+        self._step_loop = _ptrace_accel.step_loop
+
+    def step_loop(self, tid, max_steps, until, breaks, regs, status, rips, timeout):
+        return self._step_loop(tid, max_steps, until, array('Q', breaks) if breaks else None, regs, status, rips, timeout)
+
+
+# The extension is optional. LIBDEBUG_NO_ACCEL=1 forces the ctypes backend
+_ptrace_accel = None
+if not os.environ.get("LIBDEBUG_NO_ACCEL"):
+    try:
+        from . import _ptrace_accel
+        _ptrace_accel.set_error_class(PtraceFail)
+    except ImportError:
+        _ptrace_accel = None
 
-        # This errno is a libc artifact. The syscall return errno as return value and the value in the data parameter
-        # We may considere to do direct syscall to avoid errno of libc
-        err = get_errno()
-        if err == errno.EIO:
-            raise PtraceFail("Peek User Failed. Are you accessing a valid address?")
-        return data
+def ptrace_backend():
+    """
+    Return a Ptrace instance, the accelerated one when the extension is available.
+    """
+    if _ptrace_accel is not None:
+        return AccelPtrace()
+    return Ptrace()
 
 
 AMD64_REGS = ["r15", "r14", "r13", "r12", "rbp", "rbx", "r11", "r10", "r9", "r8", "rax", "rcx", "rdx", "rsi", "rdi", "orig_rax", "rip", "cs", "eflags", "rsp", "ss", "fs_base", "gs_base", "ds", "es", "fs", "gs"]
@@ -218,6 +389,7 @@ FPREGS_INT   = ["mxcsr", "mxcr_mask"]
 FPREGS_80    = ["st%d" %i for i in range(8)]
 FPREGS_128   = ["xmm%d" %i for i in range(16)]
 AMD64_DBGREGS_OFF = {'DR0': 0x350, 'DR1': 0x358, 'DR2': 0x360, 'DR3': 0x368, 'DR4': 0x370, 'DR5': 0x378, 'DR6': 0x380, 'DR7': 0x388}
+AMD64_DBGREGS_HW = ('DR0', 'DR1', 'DR2', 'DR3')
 AMD64_DBGREGS_CTRL_LOCAL = {'DR0': 1<<0, 'DR1': 1<<2, 'DR2': 1<<4, 'DR3': 1<<6}
 AMD64_DBGREGS_CTRL_COND  = {'DR0': 16, 'DR1': 20, 'DR2': 24, 'DR3': 28}
 AMD64_DBGREGS_CTRL_COND_VAL  = {'X': 0, 'W': 1, 'IO': 2, 'RW': 3}
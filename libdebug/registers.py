@@ -0,0 +1,86 @@
+from ctypes import Structure, c_uint16, c_uint32, c_uint64
+import collections
+import struct
+from .ptrace import AMD64_REGS, FPREGS_SHORT, FPREGS_LONG, FPREGS_INT, FPREGS_80, FPREGS_128
+
+# Immutable copies of the register files, cheap to keep around for logging and tracing
+RegsSnapshot = collections.namedtuple("RegsSnapshot", AMD64_REGS)
+FpRegsSnapshot = collections.namedtuple("FpRegsSnapshot", FPREGS_SHORT + FPREGS_LONG + FPREGS_INT + FPREGS_80 + FPREGS_128)
+
+MASK64 = 0xffffffffffffffff
+
+
+class RegisterFile(Structure):
+    """
+    struct user_regs_struct. PTRACE_GETREGS writes directly into it, the instance is reused for every stop.
+    """
+    _fields_ = [(name, c_uint64) for name in AMD64_REGS]
+    _layout = struct.Struct("<%dQ" % len(AMD64_REGS))
+    _names = frozenset(AMD64_REGS)
+
+    # Dict-like access kept for the code that used the old dict of registers
+    def __getitem__(self, name):
+        if name not in self._names:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __iter__(self):
+        return iter(AMD64_REGS)
+
+    def keys(self):
+        return AMD64_REGS
+
+    def snapshot(self):
+        return RegsSnapshot._make(self._layout.unpack_from(self))
+
+
+class FpRegisterFile(Structure):
+    """
+    struct user_fpregs_struct (the fxsave area). st and xmm registers are exposed as 128 bits integers.
+    """
+    _fields_ = [("cwd", c_uint16), ("swd", c_uint16), ("ftw", c_uint16), ("fop", c_uint16),
+                ("rip", c_uint64), ("rdp", c_uint64),
+                ("mxcsr", c_uint32), ("mxcr_mask", c_uint32),
+                ("st_space", c_uint64 * 16),
+                ("xmm_space", c_uint64 * 32),
+                ("padding", c_uint32 * 24)]
+    _layout = struct.Struct("<4H2Q2I16Q32Q")
+    _n_fixed = len(FPREGS_SHORT + FPREGS_LONG + FPREGS_INT)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def __iter__(self):
+        return iter(FpRegsSnapshot._fields)
+
+    def keys(self):
+        return FpRegsSnapshot._fields
+
+    def snapshot(self):
+        values = self._layout.unpack_from(self)
+        fixed = values[:self._n_fixed]
+        wide = values[self._n_fixed:]
+        return FpRegsSnapshot._make(fixed + tuple((wide[i+1] << 64) | wide[i] for i in range(0, len(wide), 2)))
+
+
+def _wide_reg(name, field, index):
+    #This is an helping function to generate properties to access 128 bits registers
+    def getter(self):
+        space = getattr(self, field)
+        return (space[2*index+1] << 64) | space[2*index]
+    def setter(self, value):
+        space = getattr(self, field)
+        space[2*index] = value & MASK64
+        space[2*index+1] = (value >> 64) & MASK64
+    return property(getter, setter, None, name)
+
+for i, r in enumerate(FPREGS_80):
+    setattr(FpRegisterFile, r, _wide_reg(r, "st_space", i))
+for i, r in enumerate(FPREGS_128):
+    setattr(FpRegisterFile, r, _wide_reg(r, "xmm_space", i))
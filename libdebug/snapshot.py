@@ -0,0 +1,143 @@
+import ctypes
+import logging
+import mmap
+import os
+import re
+
+logging = logging.getLogger("libdebug")
+
+PAGE_SIZE = 0x1000
+PAGEMAP_ENTRY = 8
+# bit 55 of a pagemap entry is the soft-dirty bit: the page was written since the last clear_refs
+_SOFT_DIRTY = bytes(1 if b & 0x80 else 0 for b in range(256))
+_DIRTY_RUN = re.compile(b"\x01+")
+
+# Mappings that belong to the kernel. They are writable or special but can not (and must not) be restored
+SKIP_MAPPINGS = ("[vvar]", "[vvar_vclock]", "[vsyscall]", "[vdso]")
+
+
+class Snapshot():
+    """
+    Checkpoint of a stopped process: the registers of every thread and the content of every writable mapping.
+    Created by Debugger.snapshot() and applied with Debugger.restore(), as many times as needed.
+    """
+
+    def __init__(self, pid, incremental=False):
+        self.pid = pid
+        # the soft-dirty bits were cleared when the snapshot was taken
+        self.incremental = incremental
+        # tid -> (user_regs_struct, user_fpregs_struct) as raw bytes
+        self.threads = {}
+        # (start, content) of the writable mappings
+        self.memory = []
+        # (start, stop, perms, pathname) of every mapping, to detect changes of the layout
+        self.layout = []
+
+    @property
+    def size(self):
+        """
+        Bytes of memory saved.
+        """
+        return sum(len(data) for _, data in self.memory)
+
+    def __repr__(self):
+        return "<Snapshot pid:%d threads:%d mappings:%d size:%#x%s>" % (self.pid, len(self.threads), len(self.memory), self.size,
+                                                                       " incremental" if self.incremental else "")
+
+
+def layout_of(memory_map):
+    return [(s['start'], s['stop'], s['perms'], s['pathname']) for s in memory_map.values()]
+
+
+def saved_mappings(memory_map):
+    # the mappings whose content is part of the snapshot
+    return [s for s in memory_map.values() if s['perms'] & 2 and s['pathname'] not in SKIP_MAPPINGS]
+
+
+_soft_dirty = None
+
+def soft_dirty_supported():
+    """
+    Check once if the kernel tracks soft-dirty pages (CONFIG_MEM_SOFT_DIRTY). Without it clear_refs accepts "4" and
+    the bit is never set, so it is tested on a page of a short-lived child: clearing the bits of this process would
+    break the tracking of whoever else uses them.
+    """
+    global _soft_dirty
+    if _soft_dirty is None:
+        _soft_dirty = False
+        try:
+            _soft_dirty = _probe_soft_dirty()
+        except (OSError, ValueError) as e:
+            logging.debug("soft-dirty test failed: %r", e)
+        if not _soft_dirty:
+            logging.warning("Soft-dirty tracking is not available. Incremental snapshots are restored completely")
+    return _soft_dirty
+
+
+def _probe_soft_dirty():
+    # The child writes its copy of the page, waits for its bits to be cleared, writes it again and waits for the end
+    # of the test to exit
+    page = mmap.mmap(-1, PAGE_SIZE, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS)
+    go_r, go_w = os.pipe()
+    done_r, done_w = os.pipe()
+    pid = None
+    try:
+        # the ctypes object would keep the buffer exported and close would fail
+        start = ctypes.c_char.from_buffer(page)
+        addr = ctypes.addressof(start)
+        del start
+        pid = os.fork()
+        if pid == 0:
+            try:
+                # the last read ends when the parent closes go_w
+                os.close(go_w)
+                page[0] = 1
+                os.write(done_w, b"1")
+                os.read(go_r, 1)
+                page[0] = 2
+                os.write(done_w, b"2")
+                os.read(go_r, 1)
+            finally:
+                os._exit(0)
+        os.read(done_r, 1)
+        with open("/proc/%d/clear_refs" % pid, "w") as f:
+            f.write("4")
+        os.write(go_w, b"1")
+        os.read(done_r, 1)
+        fd = os.open("/proc/%d/pagemap" % pid, os.O_RDONLY)
+        try:
+            return dirty_runs(fd, addr, addr + PAGE_SIZE) != []
+        finally:
+            os.close(fd)
+    finally:
+        for fd in (go_r, go_w, done_r, done_w):
+            os.close(fd)
+        if pid is not None:
+            os.waitpid(pid, 0)
+        page.close()
+
+
+def clear_soft_dirty(pid):
+    """
+    Clear the soft-dirty bits of all the pages of pid. Return False if the kernel does not support it.
+    """
+    if not soft_dirty_supported():
+        return False
+    try:
+        with open("/proc/%d/clear_refs" % pid, "w") as f:
+            f.write("4")
+    except OSError as e:
+        logging.warning("Soft-dirty tracking is not available: %r", e)
+        return False
+    return True
+
+
+def dirty_runs(pagemap_fd, start, stop):
+    """
+    Return the (start, stop) ranges of consecutive soft-dirty pages in [start, stop).
+    """
+    size = (stop - start) // PAGE_SIZE * PAGEMAP_ENTRY
+    entries = os.pread(pagemap_fd, size, start // PAGE_SIZE * PAGEMAP_ENTRY)
+    # The bit is the highest one of the 7th byte of each entry. translate and the regex scan all the pages in C
+    flags = entries[6::PAGEMAP_ENTRY].translate(_SOFT_DIRTY)
+    return [(start + m.start() * PAGE_SIZE, start + m.end() * PAGE_SIZE) for m in _DIRTY_RUN.finditer(flags)]
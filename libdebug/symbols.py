@@ -0,0 +1,149 @@
+import bisect
+import logging
+import os
+import struct
+from array import array
+from . import elf
+
+logging = logging.getLogger("libdebug")
+
+CACHE_MAGIC = b"LDSYM1\0\0"
+CACHE_HEADER = struct.Struct("<8sQQ")
+
+
+def cache_dir():
+    """
+    Directory of the symbol tables parsed by previous sessions: $LIBDEBUG_CACHE or ~/.cache/libdebug.
+    """
+    path = os.environ.get("LIBDEBUG_CACHE")
+    if path is None:
+        path = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "libdebug")
+    return path
+
+
+class Location():
+    """
+    Where a process address is: symbol name and offset inside module.
+    """
+    __slots__ = ("address", "module", "name", "offset")
+
+    def __init__(self, address, module, name, offset):
+        self.address = address
+        self.module = module
+        self.name = name
+        self.offset = offset
+
+    def __str__(self):
+        if self.name is None:
+            return "%s+%#x" % (self.module, self.offset)
+        return "%s+%#x" % (self.name, self.offset) if self.offset else self.name
+
+    def __repr__(self):
+        return "<%#x %s!%s>" % (self.address, self.module, self)
+
+
+class SymbolTable():
+    """
+    Functions and objects of an ELF file, by name and by address (vaddr of the file).
+    Addresses are sorted: looking up the symbol of an address is a bisect.
+    """
+
+    def __init__(self, addrs, sizes, names, load_base=0):
+        self.addrs = addrs
+        self.sizes = sizes
+        self.names = names
+        self.load_base = load_base
+        self._by_name = None
+
+    @classmethod
+    def from_elf(cls, f):
+        symbols = {}
+        for name, value, size, _ in sorted(f.symbols(), key=lambda s: not s[3]):
+            # .symtab first, it has sizes and names of the local symbols too
+            symbols.setdefault(name, (value, size))
+        # of the aliases of an address the public one goes first (mmap before __mmap)
+        entries = sorted((value, name.startswith("_"), name, size) for name, (value, size) in symbols.items())
+        return cls(array('Q', (e[0] for e in entries)), array('Q', (e[3] for e in entries)), [e[2] for e in entries],
+                   f.load_base)
+
+    def address(self, name):
+        """
+        Return the vaddr of the symbol name, None if there is not such a symbol.
+        """
+        if self._by_name is None:
+            self._by_name = {}
+            for i, n in enumerate(self.names):
+                self._by_name.setdefault(n, i)
+        i = self._by_name.get(name)
+        return None if i is None else self.addrs[i]
+
+    def lookup(self, vaddr):
+        """
+        Return (name, offset) of the symbol containing vaddr, None if there is none.
+        Symbols without size contain everything up to the next one.
+        """
+        i = bisect.bisect_right(self.addrs, vaddr) - 1
+        if i < 0:
+            return None
+        start = self.addrs[i]
+        # the first of the aliases
+        i = bisect.bisect_left(self.addrs, start, 0, i)
+        offset = vaddr - start
+        if self.sizes[i] != 0 and offset >= self.sizes[i]:
+            return None
+        return self.names[i], offset
+
+    def __len__(self):
+        return len(self.names)
+
+    def save(self, path):
+        # written aside and renamed, concurrent sessions never read half a file
+        names = "\0".join(self.names).encode()
+        tmp = "%s.%d" % (path, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(CACHE_HEADER.pack(CACHE_MAGIC, len(self.names), self.load_base))
+            f.write(self.addrs.tobytes())
+            f.write(self.sizes.tobytes())
+            f.write(names)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, n, load_base = CACHE_HEADER.unpack_from(data)
+        if magic != CACHE_MAGIC:
+            raise ValueError("%s is not a symbol table" % path)
+        start = CACHE_HEADER.size
+        addrs, sizes = array('Q'), array('Q')
+        addrs.frombytes(data[start: start + 8 * n])
+        sizes.frombytes(data[start + 8 * n: start + 16 * n])
+        names = data[start + 16 * n:].decode().split("\0") if n > 0 else []
+        return cls(addrs, sizes, names, load_base)
+
+
+_tables = {}
+
+
+def symbols_of(path):
+    """
+    Return the SymbolTable of the ELF file path. A file is parsed once, the table is kept in memory and in cache_dir,
+    keyed by inode, size and modification time: later sessions load it without reading the ELF.
+    """
+    st = os.stat(path)
+    key = "%s-%x-%x-%x-%x" % (os.path.basename(path), st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+    table = _tables.get(key)
+    if table is not None:
+        return table
+    cached = os.path.join(cache_dir(), key + ".sym")
+    try:
+        table = SymbolTable.load(cached)
+    except (OSError, ValueError, struct.error):
+        table = SymbolTable.from_elf(elf.load(path))
+        try:
+            os.makedirs(cache_dir(), exist_ok=True)
+            table.save(cached)
+        except OSError as e:
+            logging.debug("symbols of %s not cached: %r", path, e)
+    _tables[key] = table
+    return table
@@ -0,0 +1,259 @@
+from array import array
+import mmap
+import operator
+import struct
+import zlib
+import logging
+from capstone.x86 import X86_OP_MEM, X86_REG_RIP, X86_REG_FS, X86_REG_GS
+from .ptrace import AMD64_REGS, PtraceFail
+from .disasm import capstone
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logging = logging.getLogger("libdebug")
+
+# Trace file layout. Everything is little endian.
+# header: magic, compression, number of fields, records per chunk, then the field names separated by '\0'
+# chunk:  number of records, raw size, stored size, then the payload (records of uint64, one per field)
+# Chunks are only appended, so a trace interrupted in the middle is still readable up to the last chunk.
+TRACE_MAGIC = b"LDTRACE1"
+TRACE_HEADER = struct.Struct("<8sBBHII")
+CHUNK_HEADER = struct.Struct("<III")
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+COMPRESSIONS = {None: COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "zstd": COMPRESSION_ZSTD}
+
+MASK64 = 0xffffffffffffffff
+PAGE_SIZE = 0x1000
+
+
+def _compressor(compression):
+    if compression == COMPRESSION_NONE:
+        return None
+    if compression == COMPRESSION_ZLIB:
+        return lambda data: zlib.compress(data, 1)
+    if zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+    return zstandard.ZstdCompressor(level=1).compress
+
+
+def _decompressor(compression):
+    if compression == COMPRESSION_NONE:
+        return None
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress
+    if zstandard is None:
+        raise ImportError("zstd compression requires the zstandard package")
+    return zstandard.ZstdDecompressor().decompress
+
+
+class TraceWriter():
+    """
+    Append fixed size records of uint64 to a trace file. Records are buffered in an array and written in chunks.
+    """
+
+    def __init__(self, path, fields, compression=None, chunk_records=0x10000):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %r" % compression)
+        self.fields = list(fields)
+        self.compression = COMPRESSIONS[compression]
+        self.compress = _compressor(self.compression)
+        self.chunk_records = chunk_records
+        self.chunk_size = chunk_records * len(self.fields)
+        self.records = 0
+        self.buf = array('Q')
+        self.f = open(path, "wb")
+        names = b"\0".join(f.encode() for f in self.fields)
+        self.f.write(TRACE_HEADER.pack(TRACE_MAGIC, self.compression, len(self.fields), 0, chunk_records, len(names)))
+        self.f.write(names)
+
+    def append(self, values):
+        self.buf.extend(values)
+        if len(self.buf) >= self.chunk_size:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        if len(self.buf) == 0:
+            return
+        count = len(self.buf) // len(self.fields)
+        raw = self.buf.tobytes()
+        data = raw if self.compress is None else self.compress(raw)
+        self.f.write(CHUNK_HEADER.pack(count, len(raw), len(data)))
+        self.f.write(data)
+        self.records += count
+        self.buf = array('Q')
+
+    def flush(self):
+        self._write_chunk()
+        self.f.flush()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TraceReader():
+    """
+    Read a trace file. The file is mapped in memory, chunks are decoded only when a record inside them is accessed.
+    """
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.compression, n_fields, _, self.chunk_records, names_len = TRACE_HEADER.unpack_from(self.mm, 0)
+        if magic != TRACE_MAGIC:
+            raise ValueError("%s is not a libdebug trace" % path)
+        self.decompress = _decompressor(self.compression)
+        off = TRACE_HEADER.size
+        self.fields = [n.decode() for n in bytes(self.mm[off:off+names_len]).split(b"\0")]
+        self.n_fields = n_fields
+        off += names_len
+        # index of the chunks: (first record, number of records, payload offset, stored size)
+        self.chunks = []
+        self.records = 0
+        while off + CHUNK_HEADER.size <= len(self.mm):
+            count, raw_size, size = CHUNK_HEADER.unpack_from(self.mm, off)
+            off += CHUNK_HEADER.size
+            if off + size > len(self.mm):
+                logging.warning("Truncated chunk in trace %s", path)
+                break
+            self.chunks.append((self.records, count, off, size))
+            self.records += count
+            off += size
+        self._cached = (None, None)
+
+    def _chunk(self, i):
+        if self._cached[0] == i:
+            return self._cached[1]
+        _, _, off, size = self.chunks[i]
+        if self.decompress is None:
+            data = memoryview(self.mm)[off:off+size].cast('Q')
+        else:
+            data = array('Q')
+            data.frombytes(self.decompress(self.mm[off:off+size]))
+        self._cached = (i, data)
+        return data
+
+    def __len__(self):
+        return self.records
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.records
+        if not 0 <= index < self.records:
+            raise IndexError("record index out of range")
+        # chunks are full except the last one, the chunk is found without searching
+        i = min(index // self.chunk_records, len(self.chunks) - 1)
+        while self.chunks[i][0] > index:
+            i -= 1
+        data = self._chunk(i)
+        off = (index - self.chunks[i][0]) * self.n_fields
+        return tuple(data[off:off+self.n_fields])
+
+    def __iter__(self):
+        n = self.n_fields
+        for i in range(len(self.chunks)):
+            data = self._chunk(i)
+            for off in range(0, len(data), n):
+                yield tuple(data[off:off+n])
+
+    def column(self, name):
+        """
+        Return all the values of a field as an array
+        """
+        idx = self.fields.index(name)
+        values = array('Q')
+        for i in range(len(self.chunks)):
+            values.extend(self._chunk(i)[idx::self.n_fields])
+        return values
+
+    def close(self):
+        self._cached = (None, None)
+        self.mm.close()
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class MemAccessDecoder():
+    """
+    Compute the address of the memory operand of the instruction about to be executed.
+    Instructions are decoded once per address.
+    """
+
+    def __init__(self, read):
+        self.read = read
+        self.md = capstone(detail=True)
+        self.cache = {}
+
+    def _decode(self, rip):
+        try:
+            code = self.read(rip, 16)
+        except PtraceFail:
+            # the instruction is at the end of a mapping, fetch only what is there
+            code = self.read(rip, PAGE_SIZE - (rip & (PAGE_SIZE - 1)))
+        insn = next(self.md.disasm(code, rip, 1), None)
+        if insn is None or insn.mnemonic in ("lea", "nop"):
+            return None
+        for op in insn.operands:
+            if op.type != X86_OP_MEM:
+                continue
+            m = op.mem
+            base = None if m.base == 0 or m.base == X86_REG_RIP else insn.reg_name(m.base)
+            index = None if m.index == 0 else insn.reg_name(m.index)
+            if (base is not None and base not in AMD64_REGS) or (index is not None and index not in AMD64_REGS):
+                return None
+            seg = {X86_REG_FS: "fs_base", X86_REG_GS: "gs_base"}.get(m.segment)
+            disp = m.disp + insn.size if m.base == X86_REG_RIP else m.disp
+            return (m.base == X86_REG_RIP, base, index, m.scale, disp, seg, op.size)
+        return None
+
+    def access(self, regs):
+        rip = regs.rip
+        if rip in self.cache:
+            op = self.cache[rip]
+        else:
+            op = self.cache[rip] = self._decode(rip)
+        if op is None:
+            return (0, 0)
+        rip_rel, base, index, scale, disp, seg, size = op
+        addr = disp
+        if rip_rel:
+            addr += rip
+        if base is not None:
+            addr += getattr(regs, base)
+        if index is not None:
+            addr += getattr(regs, index) * scale
+        if seg is not None:
+            addr += getattr(regs, seg)
+        return (addr & MASK64, size)
+
+
+def record_getter(registers, decoder=None):
+    # Build the function that turns the register file into a record: rip, the registers asked, [mem_addr, mem_size]
+    names = ["rip"] + list(registers)
+    get = operator.attrgetter(*names)
+    if len(names) == 1:
+        regs_get = lambda regs: (get(regs),)
+    else:
+        regs_get = get
+    if decoder is None:
+        return regs_get
+    return lambda regs: regs_get(regs) + decoder.access(regs)
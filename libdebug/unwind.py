@@ -0,0 +1,486 @@
+import bisect
+import collections
+import logging
+import os
+import struct
+from array import array
+from . import elf
+
+logging = logging.getLogger("libdebug")
+
+# DWARF numbers of the amd64 registers, 16 is the return address column
+DWARF_REGS = ("rax", "rdx", "rcx", "rbx", "rsi", "rdi", "rbp", "rsp",
+              "r8", "r9", "r10", "r11", "r12", "r13", "r14", "r15", "rip")
+RBP = 6
+RSP = 7
+RIP = 16
+
+# pointer encodings of .eh_frame
+DW_EH_PE_omit = 0xff
+DW_EH_PE_pcrel = 0x10
+DW_EH_PE_indirect = 0x80
+
+_FIXED = {0x0: "<Q", 0x2: "<H", 0x3: "<I", 0x4: "<Q", 0xa: "<h", 0xb: "<i", 0xc: "<q"}
+MASK = (1 << 64) - 1
+
+Cie = collections.namedtuple("Cie", "code_align data_align ra fde_encoding augmented instructions signal")
+
+
+def _uleb(data, off):
+    value = shift = 0
+    while True:
+        b = data[off]
+        off += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            return value, off
+
+
+def _sleb(data, off):
+    value = shift = 0
+    while True:
+        b = data[off]
+        off += 1
+        value |= (b & 0x7f) << shift
+        shift += 7
+        if b < 0x80:
+            if b & 0x40:
+                value -= 1 << shift
+            return value, off
+
+
+def _pointer(data, off, encoding, addr):
+    # Read a pointer encoded with encoding at off of a section loaded at addr. Return (value, next offset)
+    if encoding == DW_EH_PE_omit:
+        return None, off
+    fmt = encoding & 0x0f
+    if fmt == 0x1:
+        value, end = _uleb(data, off)
+    elif fmt == 0x9:
+        value, end = _sleb(data, off)
+    else:
+        s = _FIXED.get(fmt)
+        if s is None:
+            raise ValueError("Unknown pointer encoding %#x" % encoding)
+        value = struct.unpack_from(s, data, off)[0]
+        end = off + struct.calcsize(s)
+    if encoding & 0x70 == DW_EH_PE_pcrel:
+        value += addr + off
+    return value & MASK, end
+
+
+# DWARF expression opcodes, the ones compilers put in .eh_frame (the PLT rules use them)
+DW_OP_deref = 0x06
+DW_OP_const1u = 0x08
+DW_OP_const1s = 0x09
+DW_OP_constu = 0x10
+DW_OP_consts = 0x11
+DW_OP_dup = 0x12
+DW_OP_and = 0x1a
+DW_OP_minus = 0x1c
+DW_OP_plus = 0x22
+DW_OP_plus_uconst = 0x23
+DW_OP_shl = 0x24
+DW_OP_ge = 0x2a
+DW_OP_lit0 = 0x30
+DW_OP_breg0 = 0x70
+
+
+def evaluate(expr, regs, read, push=None):
+    """
+    Evaluate the DWARF expression expr with the register values regs, read(addr) returns 8 bytes of memory as int.
+    Return None if it uses an unknown register, memory or opcode.
+    """
+    stack = [] if push is None else [push]
+    off = 0
+    while off < len(expr):
+        op = expr[off]
+        off += 1
+        if DW_OP_lit0 <= op < DW_OP_lit0 + 32:
+            stack.append(op - DW_OP_lit0)
+        elif DW_OP_breg0 <= op <= DW_OP_breg0 + RIP:
+            value = regs[op - DW_OP_breg0]
+            n, off = _sleb(expr, off)
+            if value is None:
+                return None
+            stack.append((value + n) & MASK)
+        elif op == DW_OP_const1u:
+            stack.append(expr[off])
+            off += 1
+        elif op == DW_OP_const1s:
+            stack.append(struct.unpack_from("<b", expr, off)[0] & MASK)
+            off += 1
+        elif op == DW_OP_constu:
+            n, off = _uleb(expr, off)
+            stack.append(n)
+        elif op == DW_OP_consts:
+            n, off = _sleb(expr, off)
+            stack.append(n & MASK)
+        elif op == DW_OP_plus_uconst:
+            n, off = _uleb(expr, off)
+            stack.append((stack.pop() + n) & MASK)
+        elif op == DW_OP_dup:
+            stack.append(stack[-1])
+        elif op == DW_OP_deref:
+            value = read(stack.pop())
+            if value is None:
+                return None
+            stack.append(value)
+        elif op in (DW_OP_and, DW_OP_minus, DW_OP_plus, DW_OP_shl, DW_OP_ge):
+            b, a = stack.pop(), stack.pop()
+            if op == DW_OP_and:
+                stack.append(a & b)
+            elif op == DW_OP_minus:
+                stack.append((a - b) & MASK)
+            elif op == DW_OP_plus:
+                stack.append((a + b) & MASK)
+            elif op == DW_OP_shl:
+                stack.append((a << b) & MASK)
+            else:
+                # signed comparison
+                stack.append(int((a ^ (1 << 63)) >= (b ^ (1 << 63))))
+        else:
+            logging.debug("unsupported DWARF expression opcode %#x", op)
+            return None
+    return stack[-1] if len(stack) > 0 else None
+
+
+# A row of the CFI table: how to compute the CFA and the registers of the caller.
+# cfa is (reg, offset) or bytes, an expression. rules are reg -> (kind, value), see step
+Row = collections.namedtuple("Row", "cfa rules")
+
+
+class CallFrameInfo():
+    """
+    The .eh_frame of an ELF file: for every function the rules to get the registers of its caller.
+    FDEs are indexed by address at load, the rows of an address are computed on the first lookup and kept.
+    Addresses are the ones of the ELF file.
+    """
+
+    def __init__(self, f):
+        s = f.section(".eh_frame")
+        self.data = bytes(f.section_data(s)) if s is not None else b""
+        self.addr = s.addr if s is not None else 0
+        self.load_base = f.load_base
+        self.cies = {}
+        fdes = []
+        off = 0
+        data = self.data
+        while off + 4 <= len(data):
+            length = struct.unpack_from("<I", data, off)[0]
+            start = off + 4
+            if length == 0:
+                break
+            if length == 0xffffffff:
+                length = struct.unpack_from("<Q", data, start)[0]
+                start += 8
+            end = start + length
+            cie_id = struct.unpack_from("<I", data, start)[0]
+            if cie_id == 0:
+                self._cie(off, start + 4, end)
+            else:
+                fdes.append(self._fde(start - cie_id, start + 4, end))
+            off = end
+        fdes = [fde for fde in fdes if fde is not None]
+        fdes.sort()
+        self.starts = array('Q', (fde[0] for fde in fdes))
+        self.ends = array('Q', (fde[1] for fde in fdes))
+        self.fdes = [fde[2:] for fde in fdes]
+        self._rows = {}
+
+    def _cie(self, offset, off, end):
+        data = self.data
+        version = data[off]
+        aug_end = data.index(b"\0", off + 1)
+        augmentation = data[off + 1: aug_end].decode(errors="replace")
+        off = aug_end + 1
+        if "eh" in augmentation:
+            off += 8
+        code_align, off = _uleb(data, off)
+        data_align, off = _sleb(data, off)
+        if version == 1:
+            ra = data[off]
+            off += 1
+        else:
+            ra, off = _uleb(data, off)
+        fde_encoding = 0
+        signal = False
+        augmented = augmentation.startswith("z")
+        if augmented:
+            aug_len, off = _uleb(data, off)
+            instructions = off + aug_len
+            for c in augmentation[1:]:
+                if c == "R":
+                    fde_encoding = data[off]
+                    off += 1
+                elif c == "P":
+                    _, off = _pointer(data, off + 1, data[off] & ~DW_EH_PE_indirect, self.addr)
+                elif c == "L":
+                    off += 1
+                elif c == "S":
+                    signal = True
+            off = instructions
+        self.cies[offset] = Cie(code_align, data_align, ra, fde_encoding, augmented, (off, end), signal)
+
+    def _fde(self, cie_offset, off, end):
+        cie = self.cies.get(cie_offset)
+        if cie is None:
+            logging.debug("FDE at %#x without CIE", off)
+            return None
+        start, off = _pointer(self.data, off, cie.fde_encoding, self.addr)
+        size, off = _pointer(self.data, off, cie.fde_encoding & 0x0f, self.addr)
+        if cie.augmented:
+            aug_len, off = _uleb(self.data, off)
+            off += aug_len
+        return start, start + size, cie_offset, off, end
+
+    def row(self, vaddr):
+        """
+        Return the Row of vaddr, None if no FDE covers it.
+        """
+        row = self._rows.get(vaddr)
+        if row is None and vaddr not in self._rows:
+            i = bisect.bisect_right(self.starts, vaddr) - 1
+            if i >= 0 and vaddr < self.ends[i]:
+                cie_offset, off, end = self.fdes[i]
+                row = self._execute(self.cies[cie_offset], self.starts[i], off, end, vaddr)
+            self._rows[vaddr] = row
+        return row
+
+    def _execute(self, cie, loc, off, end, target):
+        # run the CIE initial instructions and the ones of the FDE up to the row containing target
+        state = [None, {}]
+        self._run(cie, state, *cie.instructions, None, None, None)
+        initial = dict(state[1])
+        self._run(cie, state, off, end, loc, target, initial)
+        return Row(state[0], state[1])
+
+    def _run(self, cie, state, off, end, loc, target, initial):
+        data = self.data
+        rules = state[1]
+        saved = []
+        while off < end:
+            op = data[off]
+            off += 1
+            high, low = op & 0xc0, op & 0x3f
+            advance = None
+            if high == 0x40:
+                advance = low
+            elif high == 0x80:
+                n, off = _uleb(data, off)
+                rules[low] = ("offset", n * cie.data_align)
+            elif high == 0xc0:
+                self._restore(rules, initial, low)
+            elif op == 0x00:
+                pass
+            elif op == 0x01:
+                new, off = _pointer(data, off, cie.fde_encoding, self.addr)
+                if target is not None and new > target:
+                    break
+                loc = new
+            elif op in (0x02, 0x03, 0x04):
+                s = {0x02: "<B", 0x03: "<H", 0x04: "<I"}[op]
+                advance = struct.unpack_from(s, data, off)[0]
+                off += struct.calcsize(s)
+            elif op in (0x05, 0x11, 0x14, 0x15, 0x2f):
+                # offset_extended, offset_extended_sf, val_offset, val_offset_sf, GNU_negative_offset_extended
+                reg, off = _uleb(data, off)
+                if op in (0x11, 0x15):
+                    n, off = _sleb(data, off)
+                else:
+                    n, off = _uleb(data, off)
+                n = -n if op == 0x2f else n
+                rules[reg] = ("val_offset" if op in (0x14, 0x15) else "offset", n * cie.data_align)
+            elif op == 0x06:
+                reg, off = _uleb(data, off)
+                self._restore(rules, initial, reg)
+            elif op == 0x07:
+                reg, off = _uleb(data, off)
+                rules[reg] = ("undefined", None)
+            elif op == 0x08:
+                reg, off = _uleb(data, off)
+                rules.pop(reg, None)
+            elif op == 0x09:
+                reg, off = _uleb(data, off)
+                other, off = _uleb(data, off)
+                rules[reg] = ("register", other)
+            elif op == 0x0a:
+                saved.append((state[0], dict(rules)))
+            elif op == 0x0b:
+                if len(saved) > 0:
+                    state[0], restored = saved.pop()
+                    rules.clear()
+                    rules.update(restored)
+            elif op in (0x0c, 0x12):
+                reg, off = _uleb(data, off)
+                if op == 0x0c:
+                    n, off = _uleb(data, off)
+                else:
+                    n, off = _sleb(data, off)
+                    n *= cie.data_align
+                state[0] = (reg, n)
+            elif op == 0x0d:
+                reg, off = _uleb(data, off)
+                state[0] = (reg, state[0][1] if isinstance(state[0], tuple) else 0)
+            elif op in (0x0e, 0x13):
+                if op == 0x0e:
+                    n, off = _uleb(data, off)
+                else:
+                    n, off = _sleb(data, off)
+                    n *= cie.data_align
+                state[0] = (state[0][0] if isinstance(state[0], tuple) else RSP, n)
+            elif op == 0x0f:
+                size, off = _uleb(data, off)
+                state[0] = data[off: off + size]
+                off += size
+            elif op in (0x10, 0x16):
+                reg, off = _uleb(data, off)
+                size, off = _uleb(data, off)
+                rules[reg] = ("expression" if op == 0x10 else "val_expression", data[off: off + size])
+                off += size
+            elif op == 0x2e:
+                _, off = _uleb(data, off)
+            else:
+                logging.debug("unsupported CFA instruction %#x", op)
+                state[0] = None
+                break
+            if advance is not None and loc is not None:
+                loc += advance * cie.code_align
+                if target is not None and loc > target:
+                    break
+
+    @staticmethod
+    def _restore(rules, initial, reg):
+        if initial is not None and reg in initial:
+            rules[reg] = initial[reg]
+        else:
+            rules.pop(reg, None)
+
+    def __len__(self):
+        return len(self.fdes)
+
+
+def step(row, regs, read):
+    """
+    Unwind one frame with the CFI row: return the registers of the caller (RIP is the return address),
+    None if they can not be computed. read(addr) returns 8 bytes of memory as int, None if it fails.
+    """
+    cfa = row.cfa
+    if cfa is None:
+        return None
+    if isinstance(cfa, tuple):
+        base = regs[cfa[0]] if cfa[0] < len(regs) else None
+        if base is None:
+            return None
+        cfa = (base + cfa[1]) & MASK
+    else:
+        cfa = evaluate(cfa, regs, read)
+        if cfa is None:
+            return None
+    caller = list(regs)
+    # the CFA is the stack pointer before the call
+    caller[RSP] = cfa
+    caller[RIP] = None
+    for reg, (kind, value) in row.rules.items():
+        if reg >= len(caller):
+            continue
+        if kind == "offset":
+            caller[reg] = read((cfa + value) & MASK)
+        elif kind == "val_offset":
+            caller[reg] = (cfa + value) & MASK
+        elif kind == "register":
+            caller[reg] = regs[value] if value < len(regs) else None
+        elif kind == "undefined":
+            caller[reg] = None
+        elif kind == "expression":
+            addr = evaluate(value, regs, read, cfa)
+            caller[reg] = None if addr is None else read(addr)
+        elif kind == "val_expression":
+            caller[reg] = evaluate(value, regs, read, cfa)
+    return caller
+
+
+def fp_step(regs, read):
+    """
+    Unwind one frame with the frame pointer: [rbp] is the rbp of the caller and [rbp+8] the return address.
+    Return None if rbp can not be a frame.
+    """
+    rbp = regs[RBP]
+    if rbp is None or regs[RSP] is None or rbp < regs[RSP] or rbp & 7:
+        return None
+    caller = list(regs)
+    caller[RBP] = read(rbp)
+    caller[RIP] = read(rbp + 8)
+    caller[RSP] = rbp + 16
+    return caller
+
+
+class StackReader():
+    """
+    Reads of the stack of an unwind: the window above the stack pointer is read once, the reads inside it are
+    slices. read_mem(addr, size) is called for the window and for the reads outside of it.
+    """
+
+    def __init__(self, read_mem, sp, stop, valid):
+        self.read_mem = read_mem
+        self.valid = valid
+        self.start = sp
+        try:
+            self.window = read_mem(sp, stop - sp) if stop > sp else b""
+        except Exception as e:
+            logging.debug("stack window %#x-%#x not read: %r", sp, stop, e)
+            self.window = b""
+
+    def read(self, addr):
+        off = addr - self.start
+        if 0 <= off <= len(self.window) - 8:
+            return struct.unpack_from("<Q", self.window, off)[0]
+        if not self.valid(addr):
+            return None
+        try:
+            return struct.unpack("<Q", self.read_mem(addr, 8))[0]
+        except Exception as e:
+            logging.debug("stack read at %#x failed: %r", addr, e)
+            return None
+
+
+class Frame():
+    """
+    A frame of a backtrace: the address executed (the return address for the callers) and the stack pointer.
+    location is the symbol of address, looked up on the first access.
+    """
+    __slots__ = ("index", "address", "sp", "_symbol", "_location")
+
+    def __init__(self, index, address, sp, symbol):
+        self.index = index
+        self.address = address
+        self.sp = sp
+        self._symbol = symbol
+        self._location = False
+
+    @property
+    def location(self):
+        if self._location is False:
+            self._location = self._symbol(self.address)
+        return self._location
+
+    def __repr__(self):
+        loc = self.location
+        where = "" if loc is None else " in %s (%s)" % (loc, loc.module)
+        return "#%d %#x%s" % (self.index, self.address, where)
+
+
+_tables = {}
+
+
+def cfi_of(path):
+    """
+    Return the CallFrameInfo of the ELF file path. Every file is parsed once, until it changes on disk.
+    """
+    st = os.stat(path)
+    key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+    table = _tables.get(key)
+    if table is None:
+        table = _tables[key] = CallFrameInfo(elf.load(path))
+    return table
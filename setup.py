@@ -6,7 +6,14 @@ setuptools.setup(
     author="JinBlack",
     description="A library to debug binary programs",
     packages=["libdebug"],
+    # Native hot loops. If it does not build libdebug falls back to ctypes
+    ext_modules=[
+        setuptools.Extension("libdebug._ptrace_accel", ["libdebug/_ptrace_accel.c"], optional=True),
+    ],
     install_requires=[
         'capstone',
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard'],
+    }
 )
\ No newline at end of file
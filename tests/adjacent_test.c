@@ -0,0 +1,30 @@
+/* Target of the block step tests: b starts right after the ret of a, which is a branch target */
+
+int a(int n);
+int b(int n, int *p);
+
+__asm__(
+    ".text\n"
+    ".globl a\n"
+    ".type a, @function\n"
+    "a:\n"
+    "    mov %edi, %eax\n"
+    "    test %edi, %edi\n"
+    "    js 1f\n"
+    "    add $1, %eax\n"
+    "1:  ret\n"
+    ".size a, .-a\n"
+    ".globl b\n"
+    ".type b, @function\n"
+    "b:\n"
+    "    mov (%rsi), %eax\n"
+    "    add %edi, %eax\n"
+    "    ret\n"
+    ".size b, .-b\n"
+);
+
+int main(int argc, char **argv){
+    /* with an argument b faults on its first instruction */
+    int r = b(argc, argc > 1 ? 0 : (int *)argv);
+    return r + a(argc);
+}
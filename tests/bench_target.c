@@ -0,0 +1,40 @@
+#include <sys/mman.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <unistd.h>
+
+/* Target of benchmarks/bench.py
+ * bench_target [maps]: maps extra pages are mapped, then bench_tick is called forever */
+
+#define BUF_ADDRESS 0x3aabbcc0000
+#define BUF_SIZE 0x100000
+#define handle_error(msg) \
+    do { perror(msg); exit(EXIT_FAILURE); } while (0)
+
+__attribute__((noinline)) void bench_tick(void){
+    __asm__ volatile("");
+}
+
+/* Never called, room for breakpoints that are never hit */
+__attribute__((noinline)) void bench_cold(void){
+    __asm__ volatile(".rept 4096\n\tnop\n\t.endr");
+}
+
+int main(int argc, char **argv){
+    int maps = argc > 1 ? atoi(argv[1]) : 0;
+    char *p = mmap((void *)BUF_ADDRESS, BUF_SIZE, PROT_READ | PROT_WRITE,
+                   MAP_PRIVATE | MAP_ANONYMOUS | MAP_FIXED_NOREPLACE, -1, 0);
+    if (p == MAP_FAILED)
+        handle_error("mmap");
+    for (int i = 0; i < BUF_SIZE; i++)
+        p[i] = i & 0xff;
+    /* alternating protections, so the kernel does not merge the mappings */
+    for (int i = 0; i < maps; i++)
+        if (mmap(NULL, 0x1000, i % 2 ? PROT_READ : PROT_READ | PROT_WRITE,
+                 MAP_PRIVATE | MAP_ANONYMOUS, -1, 0) == MAP_FAILED)
+            handle_error("mmap");
+    if (argc > 2)
+        bench_cold();
+    while(1)
+        bench_tick();
+}
@@ -0,0 +1,17 @@
+#include <stdlib.h>
+
+/* Target of the coverage tests: the blocks executed depend on the argument */
+
+__attribute__((noinline)) int classify(int n){
+    if (n < 0)
+        return 1;
+    if (n == 0)
+        return 2;
+    if (n > 100)
+        return 3;
+    return 4;
+}
+
+int main(int argc, char **argv){
+    return classify(argc > 1 ? atoi(argv[1]) : 0);
+}
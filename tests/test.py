@@ -1,7 +1,30 @@
 import unittest
-from libdebug import Debugger
-from subprocess import TimeoutExpired
-from pwn import process
+from libdebug import Debugger, AsyncDebugger, DebuggerPool, Job
+from libdebug.maps import MemoryMap
+from libdebug.trace import TraceReader
+from libdebug.disasm import InstructionCache
+from libdebug.coverage import CoverageMap, BlockCoverage
+import libdebug.symbols
+import libdebug.snapshot
+from libdebug.symbols import symbols_of, SymbolTable
+from libdebug import unwind
+from libdebug.utils import u64
+from libdebug.snapshot import dirty_runs, soft_dirty_supported
+from libdebug.syscalls import SYSCALLS
+from libdebug.libdebug import DebugFail
+from libdebug.ptrace import PtraceFail, Ptrace, AccelPtrace, STEP_COUNT, STEP_UNTIL, WEXITSTATUS, WSTOPSIG, WALL
+import libdebug.ptrace
+from array import array
+from ctypes import c_int
+import asyncio
+import errno
+import signal
+import os
+import tempfile
+import threading
+import struct
+from subprocess import TimeoutExpired, Popen
+from pwn import process, ELF
 import time
 class Debugger_read(unittest.TestCase):
     def setUp(self):
@@ -30,9 +53,64 @@ class Debugger_read(unittest.TestCase):
         self.assertEqual(self.d.r14, 0xaa99887766554433)
         self.assertEqual(self.d.r15, 0x9988776655443322)
 
+    def test_register_cache(self):
+        t = self.d.threads[self.d.cur_tid]
+        self.d.r12 = 0x4142434445464748
+        self.d.r13 = 0x4142434445464749
+        self.assertTrue(t.regs_dirty)
+        self.assertEqual(self.d.r12, 0x4142434445464748)
+        t._flush_regs()
+        self.assertFalse(t.regs_dirty)
+        t._invalidate_regs()
+        self.assertEqual(self.d.r12, 0x4142434445464748)
+        self.assertEqual(self.d.r13, 0x4142434445464749)
+
+    def test_register_snapshot(self):
+        t = self.d.threads[self.d.cur_tid]
+        snap = t.get_regs().snapshot()
+        self.assertEqual(snap.rax, 0x0011223344556677)
+        self.assertEqual(snap.rip, self.d.rip)
+        self.d.rax = 0
+        self.assertEqual(snap.rax, 0x0011223344556677)
+
+    def test_fpregs(self):
+        t = self.d.threads[self.d.cur_tid]
+        self.d.xmm1 = 0x00112233445566778899aabbccddeeff
+        t._flush_regs()
+        t._invalidate_regs()
+        self.assertEqual(self.d.xmm1, 0x00112233445566778899aabbccddeeff)
+        self.assertEqual(t.get_fpregs().snapshot().xmm1, 0x00112233445566778899aabbccddeeff)
+
     def test_read_memory(self):
         self.assertEqual(self.d.mem[self.mem_addr: self.mem_addr+10], b"\xff\xfe\xfd\xfc\xfb\xfa\xf9\xf8\xf7\xf6")
 
+    def test_peek_error(self):
+        with self.assertRaises(PtraceFail) as cm:
+            self.d.peek(0x10)
+        self.assertEqual(cm.exception.errno, errno.EIO)
+
+    def test_read_memory_bulk(self):
+        expected = bytes(0xff - (i % 0x100) for i in range(0x1000))
+        self.assertEqual(self.d.mem[self.mem_addr: self.mem_addr+0x1000], expected)
+        self.assertEqual(self.d.mem[self.mem_addr+3: self.mem_addr+0x803], expected[3:0x803])
+        self.assertEqual(self.d.mem[self.mem_addr+5], b"\xfa")
+
+    def test_write_memory_bulk(self):
+        payload = bytes(range(0x100)) * 0x10
+        self.d.mem[self.mem_addr+3: self.mem_addr+3+len(payload)-6] = payload[:-6]
+        data = self.d.mem[self.mem_addr: self.mem_addr+0x1000]
+        self.assertEqual(data[:3], b"\xff\xfe\xfd")
+        self.assertEqual(data[3:-3], payload[:-6])
+        self.assertEqual(data[-3:], b"\x02\x01\x00")
+
+    def test_write_memory_readonly(self):
+        text = self.d.bases['main'] + 0x10e2
+        orig = self.d.mem[text: text+3]
+        self.d.mem[text: text+3] = b"\x90\x90\x90"
+        self.assertEqual(self.d.mem[text: text+3], b"\x90\x90\x90")
+        self.d.mem[text: text+3] = orig
+        self.assertEqual(self.d.mem[text: text+3], orig)
+
     def test_brekpoint_relative(self):
         b = self.d.breakpoint(0x10e2)
         self.d.cont()
@@ -48,6 +126,49 @@ class Debugger_read(unittest.TestCase):
         value = self.d.bases['main'] + 0x10e2
         self.assertEqual (rip, value)
 
+    def test_breakpoint_persistent(self):
+        b = self.d.breakpoint(0x10e2)
+        value = self.d.bases['main'] + 0x10e2
+        self.assertEqual(b.address, value)
+        # the int3 is hidden from memory reads
+        self.assertNotEqual(self.d.mem[value: value+1], b"\xcc")
+        self.d.cont()
+        self.d.cont()
+        self.assertEqual(self.d.rip, value)
+        self.assertEqual(b.hit_count, 2)
+
+    def test_breakpoint_disable(self):
+        b = self.d.breakpoint(0x10e2)
+        orig = self.d._read_mem_raw(b.address, 1)
+        self.assertEqual(orig, b"\xcc")
+        self.d.disable_bp(b)
+        self.assertEqual(self.d._read_mem_raw(b.address, 1), self.d.mem[b.address: b.address+1])
+        self.d.enable_bp(b)
+        self.d.cont()
+        self.assertEqual(self.d.rip, b.address)
+        self.d.del_bp(b)
+        self.assertNotEqual(self.d._read_mem_raw(b.address, 1), b"\xcc")
+        self.assertNotIn(b.address, self.d.breakpoints)
+
+    def test_breakpoint_callback(self):
+        hits = []
+        def callback(d, bp):
+            hits.append(d.rip)
+            return len(hits) == 100
+        b = self.d.breakpoint(0x10e2, callback=callback)
+        self.d.cont()
+        self.assertEqual(b.hit_count, 100)
+        self.assertEqual(set(hits), {b.address})
+        self.assertEqual(self.d.rip, b.address)
+
+    def test_breakpoint_condition(self):
+        b = self.d.breakpoint(0x10e2, condition="rax == 0")
+        c = self.d.breakpoint(0x10ec, callback=lambda d, bp: bp.hit_count == 3, condition="rax == 0x0011223344556677")
+        self.d.cont()
+        self.assertEqual(self.d.rip, c.address)
+        self.assertEqual(b.hit_count, 0)
+        self.assertEqual(c.hit_count, 3)
+
     def test_step(self):
         b = self.d.breakpoint(0x10e2)
         self.d.cont()
@@ -57,6 +178,106 @@ class Debugger_read(unittest.TestCase):
         rip = self.d.rip
         self.assertEqual (rip, value)
 
+    def test_step_n(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        self.assertEqual(self.d.step_n(1), 1)
+        self.assertEqual(self.d.rip, self.d.bases['main'] + 0x10ec)
+
+    def test_step_until(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        self.d.del_bp(b)
+        start = self.d.rip
+        steps = self.d.step_until(start, max_steps=1000)
+        self.assertTrue(0 < steps < 1000)
+        self.assertEqual(self.d.rip, start)
+        self.assertEqual(self.d.step_until(0, max_steps=50), 50)
+        self.assertEqual(self.d.run_until(lambda d: d.rip == start), steps - 50 % steps)
+
+    def test_step_until_breakpoint(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        steps = self.d.step_until(b.address, max_steps=1000)
+        self.assertTrue(0 < steps < 1000)
+        self.assertEqual(self.d.rip, b.address)
+        self.assertEqual(self.d._read_mem_raw(b.address, 1), b"\xcc")
+
+    def test_step_n_rips(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        rips = array('Q', bytes(8*4))
+        self.assertEqual(self.d.step_n(4, rips), 4)
+        self.assertEqual(rips[0], self.d.bases['main'] + 0x10ec)
+        self.assertEqual(rips[3], self.d.rip)
+
+    def test_snapshot_restore(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        snap = self.d.snapshot()
+        data = self.d.mem[self.mem_addr: self.mem_addr+0x10]
+        rsp = self.d.rsp
+        for i in range(3):
+            self.d.mem[self.mem_addr: self.mem_addr+4] = b"AAAA"
+            self.d.rax = 0x4141
+            self.d.xmm0 = 0x42
+            self.d.step_n(3)
+            self.d.restore(snap)
+            self.assertEqual(self.d.rip, b.address)
+            self.assertEqual(self.d.rsp, rsp)
+            self.assertNotEqual(self.d.rax, 0x4141)
+            self.assertNotEqual(self.d.xmm0, 0x42)
+            self.assertEqual(self.d.mem[self.mem_addr: self.mem_addr+0x10], data)
+        self.d.cont()
+        self.assertEqual(self.d.rip, b.address)
+
+    def test_snapshot_incremental(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        snap = self.d.snapshot(incremental=True)
+        self.assertEqual(snap.incremental, soft_dirty_supported())
+        data = self.d.mem[self.mem_addr: self.mem_addr+0x10]
+        self.d.mem[self.mem_addr: self.mem_addr+4] = b"AAAA"
+        if snap.incremental:
+            fd = os.open("/proc/%d/pagemap" % self.d.pid, os.O_RDONLY)
+            try:
+                self.assertEqual(dirty_runs(fd, self.mem_addr, self.mem_addr+0x1000), [(self.mem_addr, self.mem_addr+0x1000)])
+                self.d.restore(snap)
+                self.assertEqual(dirty_runs(fd, self.mem_addr, self.mem_addr+0x1000), [])
+            finally:
+                os.close(fd)
+        else:
+            self.d.restore(snap)
+        self.assertEqual(self.d.mem[self.mem_addr: self.mem_addr+0x10], data)
+        self.d.mem[self.mem_addr+8: self.mem_addr+12] = b"BBBB"
+        self.d.restore(snap)
+        self.assertEqual(self.d.mem[self.mem_addr: self.mem_addr+0x10], data)
+
+    def test_trace(self):
+        b = self.d.breakpoint(0x10e2)
+        self.d.cont()
+        self.d.del_bp(b)
+        start = self.d.rip
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for compression in [None, "zlib"]:
+                steps = self.d.trace(path, registers=["rax", "rbx"], mem_access=True, max_steps=100, compression=compression)
+                self.assertEqual(steps, 100)
+                with TraceReader(path) as t:
+                    self.assertEqual(len(t), 101)
+                    self.assertEqual(t.fields, ["rip", "rax", "rbx", "mem_addr", "mem_size"])
+                    self.assertEqual(t[-1][0], self.d.rip)
+                    self.assertEqual(list(t)[50], t[50])
+                    self.assertIn(0x0011223344556677, t.column("rax"))
+                    self.assertEqual(set(t.column("mem_size")), {0})
+            steps = self.d.trace(path, until=start)
+            with TraceReader(path) as t:
+                self.assertEqual(len(t), steps + 1)
+                self.assertEqual(t[-1][0], start)
+        finally:
+            os.unlink(path)
+
 class Debugger_read_mem(unittest.TestCase):
     def setUp(self):
         self.d = Debugger()
@@ -66,6 +287,15 @@ class Debugger_read_mem(unittest.TestCase):
     def tearDown(self):
         self.d.shutdown()
 
+    def test_maps_refresh_on_miss(self):
+        self.assertIsNone(self.d.map.find(self.mem_addr))
+        bp = self.d.breakpoint(0x1088) #aftermmap
+        self.d.cont()
+        self.d.del_bp(bp)
+        self.assertEqual(self.d.mem[self.mem_addr:self.mem_addr+8], b"\x00" * 8)
+        self.assertEqual(self.d.map.find(self.mem_addr)['start'], self.mem_addr)
+        self.assertEqual(self.d.map.find(self.mem_addr)['perms'], 6)
+
     def test_watchpoint_hw(self):
 
         #Probably we should test the bp delete and so on
@@ -156,6 +386,651 @@ class Debugger_write(unittest.TestCase):
         self.assertTrue(test_string in data) 
 
 
+class Debugger_syscall(unittest.TestCase):
+    def setUp(self):
+        self.d = Debugger()
+
+    def tearDown(self):
+        self.d.shutdown()
+
+    def test_syscall_trace(self):
+        self.d.run("/bin/true")
+        events = self.d.syscall_trace()
+        names = [e.name for e in events]
+        self.assertIn("brk", names)
+        self.assertIn("mmap", names)
+        self.assertTrue(all(e.ret is not None for e in events))
+        mmap = events[names.index("mmap")]
+        self.assertEqual(mmap.args[1] & 0xfff, 0)
+
+    def test_catch_syscall(self):
+        self.d.run("/bin/true")
+        c = self.d.catch_syscall("mmap", exit=True)
+        self.d.cont()
+        self.assertEqual(self.d.orig_rax, SYSCALLS["mmap"])
+        self.assertEqual(self.d.rax, 0xffffffffffffffda) # -ENOSYS at the entry
+        self.d.cont()
+        self.assertEqual(self.d.orig_rax, SYSCALLS["mmap"])
+        self.assertNotEqual(self.d.rax, 0xffffffffffffffda)
+        self.assertEqual(c.hit_count, 2)
+        self.d.del_catch(c)
+        self.assertEqual(self.d.syscall_catches, {})
+
+    def test_catch_syscall_callback(self):
+        self.d.run("/bin/true")
+        seen = []
+        self.d.catch_syscall("openat", lambda d, e: seen.append(e) and False)
+        self.d.catch_syscall("exit_group")
+        self.d.cont()
+        self.assertEqual(self.d.orig_rax, SYSCALLS["exit_group"])
+        self.assertTrue(len(seen) > 0)
+        self.assertTrue(all(e.name == "openat" and e.entry for e in seen))
+
+    def test_seccomp(self):
+        self.d.run("/bin/true", seccomp=["mmap"])
+        c = self.d.catch_syscall("mmap", entry=False, exit=True)
+        self.d.cont()
+        self.assertEqual(self.d.orig_rax, SYSCALLS["mmap"])
+        self.assertEqual(self.d.rax & 0xfff, 0)
+        events = self.d.syscall_trace(["mmap"])
+        self.assertTrue(len(events) > 0)
+        self.assertTrue(all(e.name == "mmap" for e in events))
+
+
+class Debugger_thread(unittest.TestCase):
+    def setUp(self):
+        self.d = Debugger()
+        self.elf = ELF("./read_test_thread", checksec=False)
+
+    def tearDown(self):
+        self.d.shutdown()
+
+    def test_clone_events(self):
+        self.d.run("./read_test_thread", sleep=0.1)
+        self.assertEqual(len(self.d.threads), 3)
+        self.assertEqual(sorted(self.d.threads), sorted(map(int, os.listdir("/proc/%d/task" % self.d.pid))))
+        self.assertFalse(any(t.running for t in self.d.threads.values()))
+        self.assertEqual(self.d.mem[0x1aabbcc1000:0x1aabbcc1004], b"\xff\xfe\xfd\xfc")
+        self.assertEqual(self.d.mem[0x2aabbcc1000:0x2aabbcc1004], b"\xff\xfe\xfd\xfc")
+
+    def test_breakpoint_in_thread(self):
+        self.d.run("./read_test_thread")
+        bp = self.d.breakpoint(self.elf.symbols["read_thread_t2"])
+        self.d.cont()
+        self.assertEqual(self.d.rip, bp.address)
+        self.assertNotEqual(self.d.cur_tid, self.d.pid)
+        self.assertEqual(bp.hit_count, 1)
+        self.d.del_bp(bp)
+        self.d.cont(blocking=False)
+        time.sleep(0.05)
+        self.assertEqual(self.d.mem[0x2aabbcc1000:0x2aabbcc1004], b"\xff\xfe\xfd\xfc")
+
+    def test_watch_all_threads(self):
+        self.d.run("./read_test_thread", sleep=0.1)
+        b = self.d.watch(0x2aabbcc1010)
+        self.assertIn(b, self.d.hw_breakpoints.values())
+        for t in self.d.threads.values():
+            self.assertIn(0x2aabbcc1010, t.hw_breakpoints.values())
+        self.d.cont()
+        self.assertNotEqual(self.d.cur_tid, self.d.pid)
+        self.assertEqual(b.hit_count, 1)
+        self.assertNotEqual(self.d.rip, b.address)
+        self.d.del_bp(b)
+        self.assertEqual(list(self.d.hw_breakpoints.values()), [None] * 4)
+
+    def test_foreign_child(self):
+        # a child that is not a tracee keeps its exit status for whoever waits for it
+        p = Popen(["sh", "-c", "exit 3"])
+        time.sleep(0.1)
+        self.d.run("./read_test_thread")
+        bp = self.d.breakpoint(self.elf.symbols["read_thread_t1"])
+        self.d.cont()
+        self.assertEqual(self.d.rip, bp.address)
+        # wait() turns ECHILD into 0
+        self.assertEqual(p.wait(timeout=5), 3)
+
+    def test_foreign_child_latency(self):
+        # while a child that is not a tracee is waitable, the stops are waited for, not polled
+        p = Popen(["sh", "-c", "exit 3"])
+        os.waitid(os.P_PID, p.pid, os.WEXITED | os.WNOWAIT)
+        self.d.run("./read_test_thread")
+        bp = self.d.breakpoint(self.elf.symbols["read_thread_t1"])
+        sleeps = []
+        sleep = time.sleep
+        time.sleep = lambda t: sleeps.append(t)
+        try:
+            self.d.cont()
+        finally:
+            time.sleep = sleep
+        self.assertEqual(self.d.rip, bp.address)
+        self.assertEqual(sleeps, [])
+        self.assertEqual(p.wait(timeout=5), 3)
+
+    def test_watch_on_breakpoint(self):
+        self.d.run("./read_test_thread")
+        bp = self.d.breakpoint(self.elf.symbols["read_thread_t1"])
+        with self.assertRaises(DebugFail):
+            self.d.watch(bp.address)
+        self.assertIs(self.d.breakpoints[bp.address], bp)
+        self.d.del_bp(bp)
+        self.assertNotIn(bp.address, self.d._shadow)
+
+    def test_hw_bp_new_thread(self):
+        self.d.run("./read_test_thread")
+        bp = self.d.breakpoint(self.elf.symbols["read_thread_t1"], hw=True)
+        self.assertTrue(bp.hw)
+        self.d.cont()
+        self.assertNotEqual(self.d.cur_tid, self.d.pid)
+        self.assertEqual(self.d.rip, bp.address)
+        self.assertEqual(bp.hit_count, 1)
+        self.d.del_bp(bp)
+        self.d.cont(blocking=False)
+        time.sleep(0.05)
+        self.assertEqual(self.d.mem[0x1aabbcc1000:0x1aabbcc1004], b"\xff\xfe\xfd\xfc")
+
+    def test_shutdown(self):
+        self.d.run("./read_test_thread", sleep=0.05)
+        pid = self.d.pid
+        self.d.shutdown()
+        self.assertEqual(self.d.threads, {})
+        with self.assertRaises(ChildProcessError):
+            os.waitpid(pid, os.WNOHANG | 0x40000000)
+
+
+class AsyncDebugger_test(unittest.TestCase):
+    def setUp(self):
+        self.ds = []
+        self.elf = ELF("./read_test_thread", checksec=False)
+
+    def tearDown(self):
+        for d in self.ds:
+            d.shutdown()
+
+    def test_concurrent_targets(self):
+        async def session():
+            d = AsyncDebugger()
+            self.ds.append(d)
+            d.run("./read_test_thread")
+            bp = d.breakpoint(self.elf.symbols["read_thread_t2"])
+            await d.cont()
+            return d.rip == bp.address and d.cur_tid != d.pid
+        async def main():
+            return await asyncio.gather(*(session() for _ in range(4)))
+        self.assertEqual(asyncio.run(main()), [True] * 4)
+
+    def test_loop_runs(self):
+        d = AsyncDebugger()
+        self.ds.append(d)
+        d.run("./read_test")
+        ticks = []
+        async def ticker():
+            for i in range(5):
+                ticks.append(i)
+                await asyncio.sleep(0.01)
+        async def main():
+            t = asyncio.ensure_future(ticker())
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(d.cont(), 0.2)
+            await t
+        asyncio.run(main())
+        self.assertEqual(ticks, list(range(5)))
+        self.assertEqual(d.rax, 0x0011223344556677)
+
+    def test_subprocess_in_loop(self):
+        elf = self.elf
+        sigchld = []
+        async def session():
+            d = AsyncDebugger()
+            self.ds.append(d)
+            d.run("./read_test_thread")
+            d.breakpoint(elf.symbols["read_thread_t2"])
+            await d.cont()
+            return d.cur_tid != d.pid
+        async def main():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGCHLD, lambda: sigchld.append(1))
+            ok = await session()
+            # the debugger handles SIGCHLD now, the handler installed before it still runs
+            sigchld.clear()
+            p = await asyncio.create_subprocess_exec("sh", "-c", "exit 3")
+            code = await p.wait()
+            await asyncio.sleep(0.05)
+            return ok, code
+        self.assertEqual(asyncio.run(main()), (True, 3))
+        self.assertGreater(len(sigchld), 0)
+
+    def test_python_sigchld_handler(self):
+        elf = self.elf
+        sigchld = []
+        previous = signal.signal(signal.SIGCHLD, lambda signum, frame: sigchld.append(signum))
+        async def main():
+            d = AsyncDebugger()
+            self.ds.append(d)
+            d.run("./read_test_thread")
+            d.breakpoint(elf.symbols["read_thread_t2"])
+            await d.cont()
+            return d.cur_tid != d.pid
+        try:
+            self.assertTrue(asyncio.run(main()))
+            self.assertGreater(len(sigchld), 0)
+            # the loop is closed: the next SIGCHLD gives the handler back
+            os.kill(os.getpid(), signal.SIGCHLD)
+            self.assertEqual(signal.getsignal(signal.SIGCHLD).__name__, "<lambda>")
+        finally:
+            signal.signal(signal.SIGCHLD, previous)
+
+    def test_cancelled_finish(self):
+        d = AsyncDebugger()
+        self.ds.append(d)
+        d.run("./read_test_thread")
+        d.breakpoint(self.elf.symbols["read_thread_t2"])
+        async def main():
+            await d.cont()
+            ret = d.backtrace(2)[1].address
+            # read_thread_t2 never returns
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(d.finish(), 0.2)
+            return ret
+        ret = asyncio.run(main())
+        self.assertTrue(d.running)
+        self.assertNotIn(ret, d.breakpoints)
+        self.assertNotIn(ret, d._shadow)
+
+
+class DebuggerPool_test(unittest.TestCase):
+    def setUp(self):
+        self.elf = ELF("./read_test_thread", checksec=False)
+
+    def test_breakpoint_jobs(self):
+        addr = self.elf.symbols["read_thread_t2"]
+        job = lambda: Job("./read_test_thread", breakpoints=[addr], registers=["rip", "rsp"], memory=[("rsp", 8)],
+                          max_hits=1, timeout=10)
+        with DebuggerPool(workers=2, sessions=2) as pool:
+            results = list(pool.map(job() for _ in range(6)))
+            stats = pool.throughput()
+        self.assertEqual(sorted(r.job_id for r in results), list(range(6)))
+        for r in results:
+            self.assertIsNone(r.error)
+            self.assertEqual(len(r.hits), 1)
+            hit = r.hits[0]
+            self.assertEqual(hit.registers["rip"], hit.address)
+            self.assertEqual(len(hit.memory[0]), 8)
+        self.assertEqual(sum(s["jobs"] for s in stats.values()), 6)
+        self.assertEqual(sum(s["hits"] for s in stats.values()), 6)
+
+    def test_stdin_exit(self):
+        with DebuggerPool(workers=1) as pool:
+            r, = pool.map([Job("/bin/sh", ["-c", "read x; exit $x"], stdin=b"7\n", timeout=10)])
+        self.assertIsNone(r.error)
+        self.assertEqual(r.exit_code, 7)
+        self.assertEqual(r.hits, [])
+
+
+class Disasm_test(unittest.TestCase):
+    def setUp(self):
+        self.d = Debugger()
+        self.d.run("./read_test_thread")
+        self.elf = ELF("./read_test_thread", checksec=False)
+
+    def tearDown(self):
+        self.d.shutdown()
+
+    def test_disasm(self):
+        d = self.d
+        bp = d.breakpoint(self.elf.symbols["read_thread_t2"])
+        insns = d.disasm(bp.address, 8)
+        self.assertEqual([i.mnemonic for i in insns], ["sub", "xor", "xor", "mov", "mov", "mov", "movabs", "call"])
+        self.assertEqual(insns[0].bytes, b"\x48\x83\xec\x08")
+        self.assertEqual(insns[1].address, bp.address + 4)
+        d.mem[bp.address+4: bp.address+7] = b"\x90" * 3
+        self.assertEqual([i.mnemonic for i in d.disasm(bp.address, 4)], ["sub", "nop", "nop", "nop"])
+
+    def test_next(self):
+        d = self.d
+        call = self.elf.symbols["read_thread_t2"] + 0x23
+        bp = d.breakpoint(call)
+        d.cont()
+        self.assertEqual(d.disasm()[0].mnemonic, "call")
+        d.del_bp(bp)
+        d.next()
+        self.assertEqual(d.rip, bp.address + 5)
+
+    def test_step_block(self):
+        d = self.d
+        t2 = self.elf.symbols["read_thread_t2"]
+        bp = d.breakpoint(t2 + 0x28)
+        d.cont()
+        base = bp.address - t2 - 0x28
+        loop = base + t2 + 0x80
+        # the je after mmap is not taken. Only the fallback stops after it
+        self.assertIn(d.step_block(), (base + t2 + 0x32, loop))
+        inner = d.breakpoint(t2 + 0xb7)
+        cov = CoverageMap()
+        blocks = d.block_trace(max_blocks=10, coverage=cov)
+        self.assertEqual(blocks[1:], [loop] * 9)
+        self.assertEqual(cov.bitmap[cov.index(loop)], 10 if blocks[0] == loop else 9)
+        self.assertEqual(inner.hit_count, 0)
+        self.assertEqual(d.mem[inner.address: inner.address+1], b"\x66")
+        self.assertEqual(d.block_trace(until=loop), [loop])
+
+    def test_step_block_adjacent(self):
+        # the int3 on the ret of a is the byte before b: entering b is not a hit of it
+        elf = ELF("./adjacent_test", checksec=False)
+        d = Debugger()
+        d.run("./adjacent_test")
+        try:
+            main = d.breakpoint(elf.symbols["main"])
+            d.cont()
+            base = main.address - elf.symbols["main"]
+            while d.disasm()[0].mnemonic != "call":
+                d.step()
+            ret = d.bp(base + elf.symbols["b"] - 1)
+            self.assertEqual(d.step_block(), base + elf.symbols["b"])
+            self.assertEqual(ret.hit_count, 0)
+        finally:
+            d.shutdown()
+
+    def test_fault_after_breakpoint(self):
+        # b faults on its first instruction, right after the int3 on the ret of a
+        elf = ELF("./adjacent_test", checksec=False)
+        d = Debugger()
+        d.run("./adjacent_test", ["x"])
+        try:
+            d.breakpoint("main")
+            d.cont()
+            b = d.bases["main"] + elf.symbols["b"]
+            ret = d.bp(b - 1)
+            d.cont()
+            self.assertEqual(WSTOPSIG(d._last_status), signal.SIGSEGV)
+            self.assertEqual(d.rip, b)
+            self.assertEqual(ret.hit_count, 0)
+        finally:
+            d.shutdown()
+
+    def test_coverage(self):
+        a, b = CoverageMap(0x100), CoverageMap(0x100)
+        self.assertTrue(a.add(0x1010))
+        self.assertFalse(a.add(0x1010))
+        b.add(0x1010)
+        b.add(0x2020)
+        self.assertEqual(a.update(b), {0x2020})
+        self.assertEqual(list(a), [0x1010, 0x2020])
+        self.assertEqual(a.bitmap[a.index(0x1010)], 3)
+        with self.assertRaises(ValueError):
+            CoverageMap(100)
+
+    def test_cache(self):
+        code = b"\x90\x90\xc3\x90"
+        reads = []
+        def read(addr, size):
+            reads.append(addr)
+            return code[addr-0x1000:]
+        cache = InstructionCache(read)
+        self.assertEqual(cache.get(0x1001).mnemonic, "nop")
+        self.assertEqual(len(cache), 2)
+        self.assertEqual([i.mnemonic for i in cache.disasm(0x1000, 4)], ["nop", "nop", "ret", "nop"])
+        self.assertEqual(reads, [0x1001, 0x1000, 0x1003])
+        cache.invalidate(0x1001, 0x1002)
+        self.assertEqual(sorted(cache.insns), [0x1000, 0x1002, 0x1003])
+
+
+class Coverage_test(unittest.TestCase):
+    def setUp(self):
+        self.elf = ELF("./coverage_test", checksec=False)
+
+    def collect(self, arg):
+        d = Debugger()
+        d.run("./coverage_test", [arg])
+        try:
+            cov = d.coverage()
+            classify = self.elf.symbols["classify"]
+            self.assertIn(classify, cov.blocks)
+            self.assertEqual(d.mem[cov.bias+classify: cov.bias+classify+1], b"\xb8")
+            with self.assertRaises(DebugFail):
+                d.cont()
+            self.assertEqual(WEXITSTATUS(d._last_status), 1 if arg == "-3" else 4)
+            return cov
+        finally:
+            d.shutdown()
+
+    def test_coverage(self):
+        classify = self.elf.symbols["classify"]
+        blocks = [classify, classify + 0x9, classify + 0x10, classify + 0x1b]
+        cov = self.collect("-3")
+        covered = [a - cov.bias for a in cov.covered()]
+        self.assertIn(classify, covered)
+        self.assertIn(classify + 0x1b, covered)
+        self.assertNotIn(classify + 0x9, covered)
+        self.assertIn(self.elf.symbols["main"], covered)
+        other = self.collect("5")
+        self.assertTrue(all(a + other.bias in other for a in blocks))
+        cov.update(other)
+        self.assertTrue(all(a + cov.bias in cov for a in blocks))
+        with tempfile.NamedTemporaryFile() as f:
+            cov.save(f.name)
+            loaded = BlockCoverage.load(f.name, cov.bias)
+        self.assertEqual(loaded.covered(), cov.covered())
+        self.assertEqual(loaded.module, "main")
+
+    def test_step_block_records(self):
+        d = Debugger()
+        d.run("./coverage_test", ["-3"])
+        try:
+            classify = d.breakpoint(self.elf.symbols["classify"]).address
+            d.cont()
+            cov = d.coverage()
+            # n < 0: classify jumps to the block returning 1
+            ret1 = classify + 0x1b
+            self.assertEqual(d.block_trace(max_blocks=2)[0], ret1)
+            self.assertIn(ret1, cov)
+            self.assertNotIn(ret1, d._oneshot)
+            self.assertNotIn(ret1, d._shadow)
+        finally:
+            d.shutdown()
+
+    def test_stop_after_oneshot(self):
+        # the ret of a is a block right before b: stopping on b must not take it
+        elf = ELF("./adjacent_test", checksec=False)
+        d = Debugger()
+        d.run("./adjacent_test")
+        try:
+            d.breakpoint("main")
+            d.cont()
+            b = d.breakpoint("b", hw=True)
+            cov = d.coverage()
+            d.cont()
+            self.assertEqual(d.rip, b.address)
+            self.assertEqual(b.hit_count, 1)
+            ret = b.address - 1
+            self.assertIn(ret, d._oneshot)
+            self.assertNotIn(ret, cov)
+        finally:
+            d.shutdown()
+
+    def test_stop_coverage(self):
+        d = Debugger()
+        d.run("./coverage_test", ["5"])
+        try:
+            cov = d.coverage()
+            d.stop_coverage(cov)
+            self.assertEqual(d._shadow, {})
+            with self.assertRaises(DebugFail):
+                d.cont()
+            self.assertEqual(len(cov), 0)
+        finally:
+            d.shutdown()
+
+
+class Symbols_test(unittest.TestCase):
+    def setUp(self):
+        self.elf = ELF("./read_test_thread", checksec=False)
+        self.d = Debugger()
+        self.d.run("./read_test_thread")
+
+    def tearDown(self):
+        self.d.shutdown()
+
+    def test_symbol_breakpoint(self):
+        d = self.d
+        bp = d.breakpoint("read_thread_t2")
+        self.assertEqual(bp.address, d.bases["main"] + self.elf.symbols["read_thread_t2"])
+        d.cont()
+        self.assertEqual(d.rip, bp.address)
+        loc = d.symbol(d.rip + 5)
+        self.assertEqual((loc.module, loc.name, loc.offset), ("read_test_thread", "read_thread_t2", 5))
+        self.assertEqual(str(loc), "read_thread_t2+0x5")
+        mmap = d.breakpoint("mmap", "libc")
+        d.del_bp(bp)
+        d.cont()
+        self.assertEqual(d.rip, mmap.address)
+        self.assertEqual(d.symbol(d.rip).name, "mmap")
+        self.assertEqual(d.symbol(d.rip).offset, 0)
+        with self.assertRaises(DebugFail):
+            d.breakpoint("no_such_symbol")
+
+    def test_disk_cache(self):
+        with tempfile.TemporaryDirectory() as cache:
+            os.environ["LIBDEBUG_CACHE"] = cache
+            try:
+                libdebug.symbols._tables.clear()
+                table = symbols_of("./read_test_thread")
+                self.assertEqual(len(os.listdir(cache)), 1)
+                loaded = SymbolTable.load(os.path.join(cache, os.listdir(cache)[0]))
+            finally:
+                del os.environ["LIBDEBUG_CACHE"]
+                libdebug.symbols._tables.clear()
+        self.assertEqual(loaded.names, table.names)
+        self.assertEqual(loaded.address("main"), self.elf.symbols["main"])
+        self.assertEqual(loaded.lookup(self.elf.symbols["main"] + 1), ("main", 1))
+
+
+class Unwind_test(unittest.TestCase):
+    def setUp(self):
+        self.d = Debugger()
+        self.d.run("./unwind_test")
+
+    def tearDown(self):
+        self.d.shutdown()
+
+    def test_backtrace(self):
+        d = self.d
+        d.breakpoint("inner")
+        d.cont()
+        frames = d.backtrace()
+        self.assertEqual([f.location.name for f in frames[:4]], ["inner", "middle", "outer", "main"])
+        # at the entry the return address is on top of the stack
+        self.assertEqual(frames[1].address, u64(d.mem[d.rsp: d.rsp+8]))
+        self.assertEqual(frames[1].sp, d.rsp + 8)
+        self.assertLess(len(frames), 64)
+        self.assertEqual(len(d.backtrace(2)), 2)
+        self.assertIn("in middle+", repr(frames[1]))
+
+    def test_finish(self):
+        d = self.d
+        d.breakpoint("inner")
+        d.cont()
+        ret = d.backtrace(2)[1].address
+        d.finish()
+        self.assertEqual(d.rip, ret)
+        self.assertEqual(d.symbol(d.rip).name, "middle")
+        # middle keeps a frame pointer: the frame pointer chain and the CFI agree
+        r = d.threads[d.cur_tid].get_regs()
+        regs = [getattr(r, name) for name in unwind.DWARF_REGS]
+        read = lambda addr: u64(d.mem[addr: addr+8])
+        by_fp = unwind.fp_step(regs, read)
+        by_cfi = unwind.step(d._cfi_row(d.rip - 1), regs, read)
+        self.assertEqual(by_fp[unwind.RIP], by_cfi[unwind.RIP])
+        self.assertEqual(by_fp[unwind.RSP], by_cfi[unwind.RSP])
+        self.assertEqual(d.symbol(by_cfi[unwind.RIP]).name, "outer")
+
+    def test_plt_expression(self):
+        # CFA of a PLT entry: rsp+8, +8 more after the push of the lazy binding stub
+        expr = bytes([0x77, 8, 0x80, 0, 0x3f, 0x1a, 0x3b, 0x2a, 0x33, 0x24, 0x22])
+        regs = [0] * 17
+        regs[unwind.RSP] = 0x1000
+        regs[unwind.RIP] = 0x4020
+        self.assertEqual(unwind.evaluate(expr, regs, None), 0x1008)
+        regs[unwind.RIP] = 0x402b
+        self.assertEqual(unwind.evaluate(expr, regs, None), 0x1010)
+
+
+class Ptrace_backend(unittest.TestCase):
+    def setUp(self):
+        self.d = Debugger()
+        self.d.run("./read_test", sleep=0.1)
+        self.d._enforce_stop()
+
+    def tearDown(self):
+        self.d.shutdown()
+
+    def test_peek_many(self):
+        rip = self.d.rip
+        data = self.d.mem[rip: rip+32]
+        self.assertEqual(Ptrace().peek_many(self.d.pid, rip, 4), data)
+        if libdebug.ptrace._ptrace_accel is not None:
+            self.assertEqual(AccelPtrace().peek_many(self.d.pid, rip, 4), data)
+
+    def test_vm_readv(self):
+        # the whole range comes from a single process_vm_readv, not from the /proc/pid/mem fallback
+        calls = []
+        vm_readv = self.d.ptrace.vm_readv
+        def spy(pid, addr, buf, size):
+            calls.append((size, vm_readv(pid, addr, buf, size)))
+            return calls[-1][1]
+        self.d.ptrace.vm_readv = spy
+        rip = self.d.rip
+        data = self.d.mem[rip: rip+0x100]
+        self.assertEqual(calls, [(0x100, 0x100)])
+        self.assertEqual(data[:32], Ptrace().peek_many(self.d.pid, rip, 4))
+
+    def test_vm_writev(self):
+        # writable pages take a single process_vm_writev, not the /proc/pid/mem fallback
+        calls = []
+        vm_writev = self.d.ptrace.vm_writev
+        def spy(pid, addr, buf, size):
+            calls.append((size, vm_writev(pid, addr, buf, size)))
+            return calls[-1][1]
+        self.d.ptrace.vm_writev = spy
+        addr = next(s['start'] for s in self.d.map.values() if s['perms'] & 2)
+        data = bytes(range(0x40))
+        self.d.mem[addr: addr+0x40] = data
+        self.assertEqual(calls, [(0x40, 0x40)])
+        self.assertEqual(self.d.mem[addr: addr+0x40], data)
+
+    def test_wait_getregs_eintr(self):
+        # a signal that interrupts the wait is not a failure
+        pid = self.d.pid
+        backends = [Ptrace()]
+        if libdebug.ptrace._ptrace_accel is not None:
+            backends.append(AccelPtrace())
+        previous = signal.signal(signal.SIGALRM, lambda signum, frame: None)
+        try:
+            for backend in backends:
+                regs = self.d.threads[pid].get_regs()
+                backend.cont(pid)
+                timer = threading.Timer(0.1, os.kill, (pid, signal.SIGSTOP))
+                timer.start()
+                signal.setitimer(signal.ITIMER_REAL, 0.02)
+                r, status, ok = backend.wait_getregs(pid, WALL, regs)
+                timer.join()
+                self.assertEqual((r, WSTOPSIG(status), ok), (pid, signal.SIGSTOP, True))
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous)
+
+    @unittest.skipIf(libdebug.ptrace._ptrace_accel is None, "the accelerated backend is not built")
+    def test_step_loop(self):
+        rip = self.d.rip
+        status = c_int()
+        results = []
+        for backend in (Ptrace(), AccelPtrace()):
+            regs = self.d.threads[self.d.pid].get_regs()
+            rips = array('Q', bytes(8*16))
+            results.append((backend.step_loop(self.d.pid, 16, None, [], regs, status, rips, -1), rips))
+            self.assertEqual(backend.step_loop(self.d.pid, -1, rip, [], regs, status, None, -1)[1], STEP_UNTIL)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0][0], (16, STEP_COUNT))
+
+
 class Debugger_cf(unittest.TestCase):
     def setUp(self):
         self.d = Debugger()
@@ -177,5 +1052,65 @@ class Debugger_cf(unittest.TestCase):
         self.assertTrue(False)
 
 
+class DirtyPages_test(unittest.TestCase):
+    def test_dirty_runs(self):
+        # fake pagemap: pages 0x10..0x17, soft-dirty 0x11, 0x12 and 0x15
+        entries = [(1 << 63) | ((1 << 55) if i in (0x11, 0x12, 0x15) else 0) for i in range(0x10, 0x18)]
+        with tempfile.TemporaryFile() as f:
+            f.write(bytes(0x10 * 8) + struct.pack("<8Q", *entries))
+            f.flush()
+            self.assertEqual(dirty_runs(f.fileno(), 0x10000, 0x18000), [(0x11000, 0x13000), (0x15000, 0x16000)])
+            self.assertEqual(dirty_runs(f.fileno(), 0x13000, 0x15000), [])
+
+    def test_soft_dirty_probe(self):
+        # the probe page is closed, whatever the kernel supports
+        pages = []
+        def spy(*args, **kwargs):
+            pages.append(mmap(*args, **kwargs))
+            return pages[-1]
+        mmap = libdebug.snapshot.mmap.mmap
+        cached = libdebug.snapshot._soft_dirty
+        libdebug.snapshot._soft_dirty = None
+        libdebug.snapshot.mmap.mmap = spy
+        try:
+            self.assertIn(soft_dirty_supported(), (True, False))
+        finally:
+            libdebug.snapshot.mmap.mmap = mmap
+            libdebug.snapshot._soft_dirty = cached
+        self.assertEqual(len(pages), 1)
+        self.assertTrue(pages[0].closed)
+
+
+class MemoryMap_test(unittest.TestCase):
+    maps = [
+        "55c1b7eaf000-55c1b7eb0000 r--p 00000000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test\n",
+        "55c1b7eb0000-55c1b7eb1000 r-xp 00001000 00:19 28246290                   /home/jinblack/Projects/libdebug/tests/test\n",
+        "7f7fd6b48000-7f7fd6b4a000 rw-p 00000000 00:00 0 \n",
+        "7f7fd6b4a000-7f7fd6b76000 r--p 00000000 00:19 9051255                    /usr/lib/libc.so.6\n",
+        "7f7fd6b76000-7f7fd6cec000 r-xp 0002c000 00:19 9051255                    /usr/lib/libc.so.6\n",
+        "7ffcc2eef000-7ffcc2f10000 rw-p 00000000 00:00 0                          [stack]\n",
+    ]
+
+    def setUp(self):
+        self.map = MemoryMap.parse(self.maps)
+
+    def test_find(self):
+        self.assertEqual(len(self.map), 6)
+        self.assertEqual(self.map.find(0x55c1b7eb0010)['start'], 0x55c1b7eb0000)
+        self.assertEqual(self.map.find(0x7f7fd6b4a000)['file'], "libc.so.6")
+        self.assertIsNone(self.map.find(0x55c1b7eb1000))
+        self.assertIsNone(self.map.find(0x1000))
+
+    def test_range(self):
+        segments = self.map.range(0x55c1b7eaffff, 0x7f7fd6b48001)
+        self.assertEqual([s['start'] for s in segments], [0x55c1b7eaf000, 0x55c1b7eb0000, 0x7f7fd6b48000])
+
+    def test_library(self):
+        self.assertEqual(len(self.map.library("libc")), 2)
+        bases = self.map.bases()
+        self.assertEqual(bases["main"], 0x55c1b7eaf000)
+        self.assertEqual(bases["libc.so.6"], 0x7f7fd6b4a000)
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,23 @@
+#include <stdio.h>
+#include <stdlib.h>
+
+/* Target of the unwind tests: main -> outer -> middle -> inner. Only middle keeps a frame pointer */
+
+__attribute__((noinline)) int inner(int n){
+    volatile int x = n;
+    return x * 3;
+}
+
+__attribute__((noinline, optimize("no-omit-frame-pointer"))) int middle(int n){
+    int r = inner(n + 1);
+    return r + 1;
+}
+
+__attribute__((noinline)) int outer(int n){
+    return middle(n * 2) + 5;
+}
+
+int main(int argc, char **argv){
+    printf("%d\n", outer(argc > 1 ? atoi(argv[1]) : 1));
+    return 0;
+}